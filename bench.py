@@ -0,0 +1,287 @@
+"""Headless load generator for the chat server.
+
+By default it starts ``server.py`` on a throwaway SQLite database, connects
+``--clients`` websocket clients, and has each one run ``--requests`` actions
+drawn from ``--mix``. It then reports throughput and p50/p95/p99 latency
+per action. Runs are reproducible for a given ``--seed``. ``--baseline``
+compares against an earlier ``--json`` report and exits non-zero on a
+latency regression, so it can gate CI.
+
+    python bench.py --clients 1000 --requests 50
+    python bench.py --json bench.json
+    python bench.py --baseline bench.json --tolerance 0.25
+    python bench.py --url ws://localhost:8765   # an already running server
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+
+DEFAULT_MIX = "send=30,show=20,mark_read=15,send_group_message=20,show_group_messages=15"
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, action, seconds, ok):
+        self.latencies.setdefault(action, []).append(seconds)
+        if not ok:
+            self.errors[action] = self.errors.get(action, 0) + 1
+
+    def report(self, elapsed):
+        report = {}
+        for action, samples in sorted(self.latencies.items()):
+            samples.sort()
+            report[action] = {
+                "count": len(samples),
+                "errors": self.errors.get(action, 0),
+                "per_second": round(len(samples) / elapsed, 1) if elapsed else 0.0,
+                "p50_ms": round(percentile(samples, 50) * 1000, 3),
+                "p95_ms": round(percentile(samples, 95) * 1000, 3),
+                "p99_ms": round(percentile(samples, 99) * 1000, 3),
+                "max_ms": round(samples[-1] * 1000, 3)
+            }
+        return report
+
+
+def percentile(sorted_samples, pct):
+    #Nearest-rank, so small runs still report a real sample
+    rank = max(1, -(-len(sorted_samples) * pct // 100))
+    return sorted_samples[int(rank) - 1]
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+class BenchClient:
+    """One simulated user: a connection, its unread inbox and its group."""
+
+    def __init__(self, index, username, group_name, peers, rng, recorder):
+        self.index = index
+        self.username = username
+        self.group_name = group_name
+        self.peers = peers
+        self.rng = rng
+        self.recorder = recorder
+        self.unread = []
+        self.websocket = None
+
+    async def request(self, payload, record=True):
+        started = time.perf_counter()
+        await self.websocket.send(json.dumps(payload))
+        while True:
+            data = json.loads(await self.websocket.recv())
+            if "event" not in data:
+                break
+            if data["event"] == "message":
+                self.unread.append(data["id"])
+        if record:
+            self.recorder.add(payload["action"], time.perf_counter() - started, data.get("status") == "ok")
+        return data
+
+    async def run_action(self, name):
+        if name == "send":
+            await self.request({"action": "send", "receiver": self.rng.choice(self.peers),
+                                "message": f"bench message from {self.username}"})
+        elif name == "show":
+            await self.request({"action": "show", "limit": 20})
+        elif name == "mark_read":
+            if not self.unread:
+                return await self.run_action("show")
+            message_id = self.unread.pop(self.rng.randrange(len(self.unread)))
+            await self.request({"action": "mark_read", "message_id": message_id})
+        elif name == "send_group_message":
+            await self.request({"action": "send_group_message", "group_name": self.group_name,
+                                "message": f"bench group message from {self.username}"})
+        elif name == "show_group_messages":
+            await self.request({"action": "show_group_messages", "group_name": self.group_name, "limit": 20})
+        elif name == "search_messages":
+            await self.request({"action": "search_messages", "query": self.rng.choice(("bench", "group", "message"))})
+        else:
+            await self.request({"action": name})
+
+
+async def connect_all(url, usernames, recorder, rng, args):
+    clients = []
+    for i, username in enumerate(usernames):
+        group_name = f"{args.prefix}_group_{i // args.group_size}"
+        peers = [u for u in rng.sample(usernames, min(len(usernames), 11)) if u != username][:10]
+        clients.append(BenchClient(i, username, group_name, peers, random.Random(args.seed + i), recorder))
+
+    #Connect and register in waves so the listen backlog is not overrun
+    async def open_client(client):
+        client.websocket = await websockets.connect(url, max_size=None, open_timeout=60)
+        await client.request({"action": "register", "username": client.username,
+                              "password": client.username})
+
+    for start in range(0, len(clients), args.connect_batch):
+        await asyncio.gather(*(open_client(c) for c in clients[start:start + args.connect_batch]))
+
+    #The first client of each group creates it and adds the rest
+    for start in range(0, len(clients), args.group_size):
+        owner, members = clients[start], clients[start + 1:start + args.group_size]
+        await owner.request({"action": "create_group", "group_name": owner.group_name}, record=False)
+        for member in members:
+            await owner.request({"action": "add_member", "group_name": owner.group_name,
+                                 "username": member.username}, record=False)
+    return clients
+
+
+async def run_load(url, args):
+    mix = parse_mix(args.mix)
+    names, weights = list(mix), list(mix.values())
+    setup_recorder = Recorder()
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    usernames = [f"{args.prefix}_user_{i}" for i in range(args.clients)]
+
+    started = time.perf_counter()
+    clients = await connect_all(url, usernames, setup_recorder, rng, args)
+    setup_elapsed = time.perf_counter() - started
+
+    async def drive(client):
+        client.recorder = recorder
+        for name in client.rng.choices(names, weights, k=args.requests):
+            await client.run_action(name)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(drive(c) for c in clients))
+    elapsed = time.perf_counter() - started
+
+    await asyncio.gather(*(c.websocket.close() for c in clients), return_exceptions=True)
+    report = setup_recorder.report(setup_elapsed)
+    report.update(recorder.report(elapsed))
+    total = sum(len(samples) for samples in recorder.latencies.values())
+    return {
+        "clients": args.clients,
+        "requests_per_client": args.requests,
+        "seed": args.seed,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_second": round(total / elapsed, 1) if elapsed else 0.0,
+        "actions": report
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_server(url, process, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}.")
+        try:
+            async with websockets.connect(url):
+                return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not start in time.")
+
+
+def start_server(args, port, db_path):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+               "--storage", "sqlite", "--db-path", db_path, "--port", str(port), "--metrics-port", "0"]
+    command += shlex.split(args.server_args)
+    log = open(args.server_log, "w") if args.server_log else subprocess.DEVNULL
+    return subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+
+
+def raise_fd_limit(clients):
+    #Every client is a socket on both ends when the server runs locally
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = min(hard, max(soft, clients * 2 + 256))
+    if wanted > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+
+
+def print_report(result):
+    print(f"{result['clients']} clients x {result['requests_per_client']} requests, seed {result['seed']}: "
+          f"{result['requests_per_second']} req/s over {result['elapsed_s']} s")
+    print(f"{'action':<22}{'count':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for action, row in result["actions"].items():
+        print(f"{action:<22}{row['count']:>8}{row['errors']:>8}{row['per_second']:>10}"
+              f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}")
+
+
+def compare(result, baseline, tolerance):
+    """Return a line per action whose p95 grew by more than ``tolerance``."""
+    regressions = []
+    for action, row in result["actions"].items():
+        before = baseline["actions"].get(action)
+        if before and before["p95_ms"] > 0 and row["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{action}: p95 {before['p95_ms']} ms -> {row['p95_ms']} ms")
+    return regressions
+
+
+async def main(args):
+    raise_fd_limit(args.clients)
+    if args.url:
+        return await run_load(args.url, args)
+
+    port = free_port()
+    url = f"ws://localhost:{port}"
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = ":memory:" if args.in_memory else os.path.join(tmp, "bench.sqlite3")
+        process = start_server(args, port, db_path)
+        try:
+            await wait_for_server(url, process)
+            return await run_load(url, args)
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the chat server")
+    parser.add_argument("--url", help="Benchmark a running server instead of starting one on SQLite")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=50, help="Requests per client after setup")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Comma separated action=weight pairs")
+    parser.add_argument("--group-size", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--prefix", default="bench", help="Username prefix; change it between runs on a shared database")
+    parser.add_argument("--connect-batch", type=int, default=200, help="Clients connected at a time during setup")
+    parser.add_argument("--in-memory", action="store_true", help="Use :memory: instead of a temporary database file")
+    parser.add_argument("--server-args", default="", help="Extra arguments for server.py, e.g. '--write-batch-size 100'")
+    parser.add_argument("--server-log", help="Write the server's output to this file")
+    parser.add_argument("--json", help="Write the report to this file")
+    parser.add_argument("--baseline", help="Earlier --json report to compare p95 latency against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p95 growth over the baseline")
+    args = parser.parse_args()
+
+    result = asyncio.run(main(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
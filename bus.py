@@ -0,0 +1,115 @@
+"""Fan-out bus between server workers.
+
+Every worker holds one endpoint. ``publish`` sends a JSON-able message to
+every *other* endpoint, whose ``on_message`` coroutine receives it in
+publish order. :class:`MemoryBus` connects endpoints inside one process (a
+single-worker server, or tests). :class:`BusHub` plus
+:class:`SocketEndpoint` connect worker processes over a local TCP socket
+with newline-delimited JSON.
+"""
+import asyncio
+import json
+
+
+class MemoryBus:
+    def __init__(self):
+        self._endpoints = []
+
+    def endpoint(self):
+        endpoint = MemoryEndpoint(self)
+        self._endpoints.append(endpoint)
+        return endpoint
+
+
+class MemoryEndpoint:
+    def __init__(self, bus):
+        self._bus = bus
+        self._inbox = None
+        self._task = None
+
+    async def start(self, on_message):
+        self._inbox = asyncio.Queue()
+
+        async def deliver():
+            while True:
+                await on_message(await self._inbox.get())
+        self._task = asyncio.get_running_loop().create_task(deliver())
+
+    def publish(self, message):
+        for endpoint in self._bus._endpoints:
+            if endpoint is not self and endpoint._inbox is not None:
+                #Round-trip through JSON so tests see exactly what a socket bus would carry
+                endpoint._inbox.put_nowait(json.loads(json.dumps(message)))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._bus._endpoints.remove(self)
+
+
+class BusHub:
+    """Relays every line a worker writes to all the other workers."""
+
+    def __init__(self):
+        self._writers = set()
+        self._server = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def _handle(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                for other in list(self._writers):
+                    if other is not writer:
+                        other.write(line)
+        except ConnectionError:
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for writer in list(self._writers):
+            writer.close()
+
+
+class SocketEndpoint:
+    """A worker's connection to a :class:`BusHub`."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._writer = None
+        self._task = None
+
+    async def start(self, on_message):
+        #Bus lines carry whole chat messages, so lift the default 64 KiB line limit
+        reader, self._writer = await asyncio.open_connection(self.host, self.port, limit=2 ** 24)
+
+        async def receive():
+            while True:
+                line = await reader.readline()
+                if not line:
+                    print("Lost connection to the worker bus.")
+                    return
+                await on_message(json.loads(line))
+        self._task = asyncio.get_running_loop().create_task(receive())
+
+    def publish(self, message):
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(json.dumps(message).encode() + b"\n")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._writer is not None:
+            self._writer.close()
@@ -0,0 +1,210 @@
+import bisect
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Bounded mapping with least-recently-used eviction and a per-entry TTL.
+
+    Only touched from the event loop, so it needs no locking.
+    """
+
+    def __init__(self, max_size=10000, ttl=300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        #Bumped on every invalidation so loads that raced with one are not stored
+        self._generation = 0
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._generation += 1
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+
+    async def get_or_load(self, key, load):
+        """Return the cached value for ``key`` or await ``load()`` and cache it.
+
+        ``None`` results are not cached, so a later insert is picked up
+        without an explicit invalidation.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        generation = self._generation
+        value = await load()
+        if value is not None and generation == self._generation:
+            self.set(key, value)
+        return value
+
+
+#Rough per-row cost of a cached message on top of its text
+ROW_OVERHEAD = 200
+
+
+def _row_bytes(row):
+    return ROW_OVERHEAD + sum(len(value) for value in row if isinstance(value, str))
+
+
+class _Buffer:
+    def __init__(self, floor):
+        #Every message of the conversation with an id above floor is in rows
+        self.floor = floor
+        self.ids = []
+        self.rows = []
+        self.size = 0
+
+
+class RecentMessages:
+    """Bounded buffers of each conversation's newest messages, as page rows.
+
+    Rows are tuples whose first value is the message id. A buffer keeps at
+    most ``per_conversation`` rows, dropping the oldest, and all buffers
+    share ``max_bytes``; the least recently used conversations are evicted
+    to stay under it. A page is served only when the buffer is known to
+    hold every row the database would have returned.
+
+    Only touched from the event loop, so it needs no locking.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, per_conversation=200):
+        self.max_bytes = max_bytes
+        self.per_conversation = per_conversation
+        self.hits = 0
+        self.misses = 0
+        self._buffers = OrderedDict()
+        self._bytes = 0
+        #Bumped whenever rows may have disappeared, so fills that raced with it are dropped
+        self._generation = 0
+
+    def size_bytes(self):
+        return self._bytes
+
+    def conversation_count(self):
+        return len(self._buffers)
+
+    def token(self):
+        """Taken before loading a page from the database, and passed back to ``fill``."""
+        return self._generation
+
+    def page(self, key, since_id=None, before_id=None, limit=50):
+        """Return (oldest-first rows, has_more) like a database page, or None on a miss."""
+        result = self._page(self._buffers.get(key), since_id, before_id, limit)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._buffers.move_to_end(key)
+        return result
+
+    def _page(self, buffer, since_id, before_id, limit):
+        if buffer is None:
+            return None
+        end = bisect.bisect_left(buffer.ids, before_id) if before_id is not None else len(buffer.ids)
+        if since_id is not None:
+            if since_id < buffer.floor:
+                return None
+            rows = buffer.rows[bisect.bisect_right(buffer.ids, since_id):end]
+            return rows[:limit], len(rows) > limit
+        if end > limit:
+            return buffer.rows[end - limit:end], True
+        if buffer.floor == 0:
+            return buffer.rows[:end], False
+        return None
+
+    def fill(self, key, rows, complete, token):
+        """Cache the newest page of a conversation, read from the database.
+
+        ``complete`` means the page holds the whole history. Rows appended
+        while the page was loading are kept; anything else that changed in
+        the meantime makes the page stale, and it is dropped.
+        """
+        if token != self._generation:
+            return
+        newer = []
+        old = self._buffers.get(key)
+        if old is not None:
+            last_id = rows[-1][0] if rows else 0
+            newer = old.rows[bisect.bisect_right(old.ids, last_id):]
+            self._remove(key)
+        buffer = _Buffer(0 if complete or not rows else rows[0][0] - 1)
+        for row in list(rows) + newer:
+            self._add_row(buffer, row)
+        self._buffers[key] = buffer
+        self._bytes += buffer.size
+        self._trim(buffer)
+        self._evict()
+
+    def append(self, key, row):
+        """Add a message that was just written."""
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            buffer = self._buffers[key] = _Buffer(row[0] - 1)
+        elif row[0] <= buffer.floor:
+            return
+        before = buffer.size
+        self._add_row(buffer, row)
+        self._bytes += buffer.size - before
+        self._trim(buffer)
+        self._buffers.move_to_end(key)
+        self._evict()
+
+    def invalidate(self, key):
+        self._generation += 1
+        self._remove(key)
+
+    def clear(self):
+        self._generation += 1
+        self._buffers.clear()
+        self._bytes = 0
+
+    def _add_row(self, buffer, row):
+        #Concurrent writers may finish out of id order
+        index = bisect.bisect_left(buffer.ids, row[0])
+        if index < len(buffer.ids) and buffer.ids[index] == row[0]:
+            return
+        buffer.ids.insert(index, row[0])
+        buffer.rows.insert(index, row)
+        buffer.size += _row_bytes(row)
+
+    def _trim(self, buffer):
+        extra = len(buffer.rows) - self.per_conversation
+        if extra > 0:
+            dropped = sum(_row_bytes(row) for row in buffer.rows[:extra])
+            buffer.floor = buffer.ids[extra - 1]
+            del buffer.ids[:extra]
+            del buffer.rows[:extra]
+            buffer.size -= dropped
+            self._bytes -= dropped
+
+    def _remove(self, key):
+        buffer = self._buffers.pop(key, None)
+        if buffer is not None:
+            self._bytes -= buffer.size
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._buffers:
+            self._generation += 1
+            _, buffer = self._buffers.popitem(last=False)
+            self._bytes -= buffer.size
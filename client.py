@@ -1,28 +1,131 @@
 import asyncio
+import getpass
 import websockets
-import json
 import os
+from collections import deque
 from datetime import datetime
 
+from codec import codec_for, rows_from_columns, subprotocols
+
+async def ainput(prompt=""):
+    #Read stdin in a worker thread so pushed messages keep printing meanwhile
+    return await asyncio.to_thread(input, prompt)
+
+def print_event(event):
+    kind = event.get("event")
+    if kind == "message":
+        print(f"\n[New message] [{event['timestamp']}] {event['sender']}: {event['message']} (ID: {event['id']})")
+    elif kind == "group_message":
+        print(f"\n[{event['group_name']}] [{event['timestamp']}] {event['sender']}: {event['message']} (ID: {event['id']})")
+    elif kind == "read":
+        print(f"\n[Read] {event['reader']} read your message {event['message_id']} at {event['read_at']}")
+    elif kind == "read_batch":
+        ids = ", ".join(str(i) for i in event['message_ids'])
+        print(f"\n[Read] {event['reader']} read your messages {ids} at {event['read_at']}")
+    elif kind == "group_read":
+        print(f"\n[Read] {event['reader']} read '{event['group_name']}' up to message {event['up_to_id']}")
+    elif kind == "missed":
+        print(f"\n[Notice] {event['count']} live update(s) were dropped while you were busy; show your messages to catch up.")
+
+class ChatConnection:
+    """Wraps the websocket so pushed events are printed as they arrive and
+    only replies to our own requests come back from recv().
+
+    Every request is tagged with a request_id, so replies are matched to
+    their request even when the server answers pipelined requests out of
+    order. recv() still returns them in the order the requests were sent.
+    """
+
+    CLOSED = {"status": "error", "message": "Connection closed."}
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.codec = codec_for(websocket.subprotocol)
+        self._next_id = 0
+        #request_id -> future for its reply, and the futures recv() still has to return
+        self._pending = {}
+        self._waiting = deque()
+        #Newest message id seen per conversation, so "show" only fetches what is new
+        self.last_seen = {}
+        self.reader = asyncio.create_task(self._read_loop())
+
+    async def _read_loop(self):
+        try:
+            async for frame in self.websocket:
+                data = self.codec.decode(frame)
+                if "event" in data:
+                    print_event(data)
+                else:
+                    self._resolve(data)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_result(dict(self.CLOSED))
+            self._pending.clear()
+
+    def _resolve(self, response):
+        future = self._pending.pop(response.get("request_id"), None)
+        if future is None and self._pending:
+            #Errors about unreadable frames carry no id; they answer the oldest request
+            future = self._pending.pop(next(iter(self._pending)))
+        if future is not None and not future.done():
+            future.set_result(response)
+
+    async def send(self, request, reply=True):
+        """Send a request. Unless ``reply`` is False its response is kept for recv()."""
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        if reply:
+            self._waiting.append(future)
+        if self.reader.done():
+            future.set_result(dict(self.CLOSED))
+            return
+        self._pending[self._next_id] = future
+        await self.websocket.send(self.codec.encode(dict(request, request_id=self._next_id)))
+
+    async def recv(self):
+        response = await self._waiting.popleft()
+        if isinstance(response.get("messages"), dict):
+            response["messages"] = rows_from_columns(response["messages"])
+        return response
+
+    def close(self):
+        self.reader.cancel()
+
 async def chat_client():
     uri = "ws://localhost:8765"
-    async with websockets.connect(uri) as websocket:
+    #Ask for MessagePack when it is installed; permessage-deflate is on by default
+    async with websockets.connect(uri, subprotocols=subprotocols()) as raw_websocket:
+        websocket = ChatConnection(raw_websocket)
         print("\n===== Welcome to the Chat System =====")
         print("=" * 35)
-        username = input("Enter your username to register/login: ").strip()
+        username = (await ainput("Enter your username to register/login: ")).strip()
+        password = await asyncio.to_thread(getpass.getpass, "Enter your password: ")
         
-        reg_msg = {"action": "register", "username": username}
-        await websocket.send(json.dumps(reg_msg))
-        response = json.loads(await websocket.recv())
+        login_msg = {"action": "login", "username": username, "password": password}
+        await websocket.send(login_msg)
+        response = await websocket.recv()
+        #Only an unknown username is registered; a wrong password is reported as such
+        if response.get("message") == f"User '{username}' not found.":
+            reg_msg = {"action": "register", "username": username, "password": password}
+            await websocket.send(reg_msg)
+            response = await websocket.recv()
         print(response.get("message"))
+        if response.get("status") != "ok":
+            websocket.close()
+            return
         
         while True:
             print("\n==== MAIN MENU ====")
             print("1. Personal Chat")
             print("2. Group Chat")
-            print("3. Quit")
+            print("3. Inbox summary")
+            print("4. Search messages")
+            print("5. Quit")
             
-            main_choice = input("\nEnter choice (1/2/3): ").strip()
+            main_choice = (await ainput("\nEnter choice (1-5): ")).strip()
             
             if main_choice == "1":
                 #Personal chat menu
@@ -33,11 +136,68 @@ async def chat_client():
                 await group_chat_menu(websocket, username)
             
             elif main_choice == "3":
+                await inbox_menu(websocket)
+            
+            elif main_choice == "4":
+                await search_menu(websocket)
+            
+            elif main_choice == "5":
                 print("Exiting the chat system. Goodbye!")
+                websocket.close()
                 break
             
             else:
-                print("Invalid choice. Please select 1, 2, or 3.")
+                print("Invalid choice. Please select 1, 2, 3, 4, or 5.")
+
+async def inbox_menu(websocket):
+    await websocket.send({"action": "inbox_summary"})
+    response = await websocket.recv()
+    if response.get("status") != "ok":
+        print(response.get("message"))
+        return
+
+    def describe(last):
+        return f"{last['sender']}: {last['preview']}" if last else "(no messages)"
+
+    print(f"\n=== Inbox ({response['total_unread']} unread) ===")
+    for c in response.get("conversations", []):
+        print(f"[{c['last_activity']}] {c['with']} ({c['unread']} unread) - {describe(c['last_message'])}")
+    for g in response.get("groups", []):
+        print(f"[{g['last_activity']}] Group '{g['group_name']}' ({g['unread']} unread) - {describe(g['last_message'])}")
+    if not response.get("conversations") and not response.get("groups"):
+        print("Nothing here yet.")
+    print("=" * 22)
+
+async def search_menu(websocket):
+    query = (await ainput("Search for: ")).strip()
+    if not query:
+        return
+    group_name = (await ainput("Only in group (leave empty for all chats): ")).strip()
+    search_msg = {"action": "search_messages", "query": query, "limit": 10}
+    if group_name:
+        search_msg["group_name"] = group_name
+
+    while True:
+        await websocket.send(search_msg)
+        response = await websocket.recv()
+        if response.get("status") != "ok":
+            print(response.get("message"))
+            return
+        hits = response.get("hits")
+        if not hits:
+            print("No matching messages.")
+            return
+        print("\n=== Search Results ===")
+        for h in hits:
+            where = f"[{h['group_name']}]" if h['type'] == "group" else "[direct]"
+            print(f"{where} [{h['timestamp']}] {h['sender']}: {h['message']} (ID: {h['id']})")
+        print("=" * 22)
+        if not response.get("has_more"):
+            return
+        more = (await ainput("Show more results? (y/n): ")).strip().lower()
+        if more != "y":
+            return
+        search_msg["offset"] = response["next_offset"]
 
 async def personal_chat_menu(websocket, username):
     while True:
@@ -48,42 +208,48 @@ async def personal_chat_menu(websocket, username):
         print("4. Delete a message")
         print("5. Back to main menu")
         
-        choice = input("\nEnter choice (1-5): ").strip()
+        choice = (await ainput("\nEnter choice (1-5): ")).strip()
         
         if choice == "1":
-            receiver = input("Enter receiver's username: ").strip()
-            message_text = input("Enter your message: ").strip()
+            receiver = (await ainput("Enter receiver's username: ")).strip()
+            message_text = (await ainput("Enter your message: ")).strip()
             send_msg = {
                 "action": "send",
-                "sender": username,
                 "receiver": receiver,
                 "message": message_text
             }
-            await websocket.send(json.dumps(send_msg))
-            response = json.loads(await websocket.recv())
+            await websocket.send(send_msg)
+            response = await websocket.recv()
             print(response.get("message"))
         
         elif choice == "2":
-            show_msg = {"action": "show", "username": username}
-            await websocket.send(json.dumps(show_msg))
-            response = json.loads(await websocket.recv())
+            show_msg = {"action": "show", "columnar": True}
+            if "show" in websocket.last_seen:
+                show_msg["since_id"] = websocket.last_seen["show"]
+            await websocket.send(show_msg)
+            response = await websocket.recv()
             if response.get("status") == "ok":
                 messages = response.get("messages")
+                if response.get("last_id") is not None:
+                    websocket.last_seen["show"] = response["last_id"]
                 if messages:
                     print("\n=== Received Messages ===")
                     for m in messages:
                         print(f"[{m['timestamp']}] {m['sender']}: {m['message']} (ID: {m['id']})")
-                        
-                        if m['sender'] != username:
-                            mark_read_msg = {
-                                "action": "mark_read",
-                                "username": username,
-                                "message_id": m['id']
-                            }
-                            await websocket.send(json.dumps(mark_read_msg))
-                            await websocket.recv()
-                            
                     print("=" * 25)
+                    
+                    unread_ids = [m['id'] for m in messages if m['sender'] != username]
+                    if unread_ids:
+                        mark_read_msg = {
+                            "action": "mark_read_batch",
+                            "message_ids": unread_ids
+                        }
+                        #No need to wait for the receipt; the reply is dropped
+                        await websocket.send(mark_read_msg, reply=False)
+                    if response.get("has_more") and "since_id" in show_msg:
+                        print("More new messages are waiting. Show again to continue.")
+                elif "since_id" in show_msg:
+                    print("No new messages.")
                 else:
                     print("No messages received.")
             else:
@@ -92,11 +258,10 @@ async def personal_chat_menu(websocket, username):
         elif choice == "3":
 
             read_status_msg = {
-                "action": "read_status",
-                "username": username
+                "action": "read_status"
             }
-            await websocket.send(json.dumps(read_status_msg))
-            response = json.loads(await websocket.recv())
+            await websocket.send(read_status_msg)
+            response = await websocket.recv()
             
             if response.get("status") == "ok":
                 read_data = response.get("read_status")
@@ -107,25 +272,26 @@ async def personal_chat_menu(websocket, username):
                     for r in read_data:
                         print(f"{r['message_id']:<10} {r['reader']:<20} {r['read_at']:<25}")
                     print("=" * 55)
+                    if response.get("has_more"):
+                        print("Showing receipts on your newest messages only.")
                 else:
                     print("None of your messages have been read yet.")
             else:
                 print(response.get("message"))
         
         elif choice == "4":
-            message_id = input("Enter message ID to delete: ").strip()
+            message_id = (await ainput("Enter message ID to delete: ")).strip()
             try:
                 message_id = int(message_id)
-                confirm = input(f"Are you sure you want to delete message ID {message_id}? (y/n): ").strip().lower()
+                confirm = (await ainput(f"Are you sure you want to delete message ID {message_id}? (y/n): ")).strip().lower()
                 
                 if confirm == 'y':
                     delete_msg = {
                         "action": "delete_message",
-                        "username": username,
                         "message_id": message_id
                     }
-                    await websocket.send(json.dumps(delete_msg))
-                    response = json.loads(await websocket.recv())
+                    await websocket.send(delete_msg)
+                    response = await websocket.recv()
                     print(response.get("message"))
                 else:
                     print("Message deletion cancelled.")
@@ -152,32 +318,30 @@ async def group_chat_menu(websocket, username):
         print("9. Delete group message")
         print("10. Back to main menu")
         
-        choice = input("\nEnter choice (1-10): ").strip()
+        choice = (await ainput("\nEnter choice (1-10): ")).strip()
         
         if choice == "1":
             # Create new group
-            group_name = input("Enter group name: ").strip()
+            group_name = (await ainput("Enter group name: ")).strip()
             if not group_name:
                 print("Group name cannot be empty.")
                 continue
                 
             create_msg = {
                 "action": "create_group",
-                "group_name": group_name,
-                "creator": username
+                "group_name": group_name
             }
-            await websocket.send(json.dumps(create_msg))
-            response = json.loads(await websocket.recv())
+            await websocket.send(create_msg)
+            response = await websocket.recv()
             print(response.get("message"))
         
         elif choice == "2":
 
             list_msg = {
-                "action": "list_groups",
-                "username": username
+                "action": "list_groups"
             }
-            await websocket.send(json.dumps(list_msg))
-            response = json.loads(await websocket.recv())
+            await websocket.send(list_msg)
+            response = await websocket.recv()
             
             if response.get("status") == "ok":
                 groups = response.get("groups")
@@ -195,33 +359,37 @@ async def group_chat_menu(websocket, username):
         
         elif choice == "3":
 
-            group_name = input("Enter group name: ").strip()
-            message_text = input("Enter your message: ").strip()
+            group_name = (await ainput("Enter group name: ")).strip()
+            message_text = (await ainput("Enter your message: ")).strip()
             
             send_msg = {
                 "action": "send_group_message",
-                "sender": username,
                 "group_name": group_name,
                 "message": message_text
             }
-            await websocket.send(json.dumps(send_msg))
-            response = json.loads(await websocket.recv())
+            await websocket.send(send_msg)
+            response = await websocket.recv()
             print(response.get("message"))
         
         elif choice == "4":
 
-            group_name = input("Enter group name: ").strip()
+            group_name = (await ainput("Enter group name: ")).strip()
             
             show_msg = {
                 "action": "show_group_messages",
-                "username": username,
-                "group_name": group_name
+                "group_name": group_name,
+                "columnar": True
             }
-            await websocket.send(json.dumps(show_msg))
-            response = json.loads(await websocket.recv())
+            seen_key = f"group:{group_name}"
+            if seen_key in websocket.last_seen:
+                show_msg["since_id"] = websocket.last_seen[seen_key]
+            await websocket.send(show_msg)
+            response = await websocket.recv()
             
             if response.get("status") == "ok":
                 messages = response.get("messages")
+                if response.get("last_id") is not None:
+                    websocket.last_seen[seen_key] = response["last_id"]
                 if messages:
                     os.system('cls' if os.name == 'nt' else 'clear')
                     print(f"\n=== Messages in Group: {group_name} ===")
@@ -229,8 +397,12 @@ async def group_chat_menu(websocket, username):
                         timestamp = m['timestamp']
                         print(f"[{timestamp}] {m['sender']}: {m['message']} (ID: {m['id']})")
                     print("=" * 40)
+                    if response.get("has_more") and "since_id" in show_msg:
+                        print("More new messages are waiting. Show again to continue.")
                     print("Note: All messages from others are automatically marked as read")
-                    input("Press Enter to continue...")
+                    await ainput("Press Enter to continue...")
+                elif "since_id" in show_msg:
+                    print(f"No new messages in group '{group_name}'.")
                 else:
                     print(f"No messages in group '{group_name}'.")
             else:
@@ -238,29 +410,28 @@ async def group_chat_menu(websocket, username):
         
         elif choice == "5":
 
-            group_name = input("Enter group name: ").strip()
-            new_member = input("Enter username to add: ").strip()
+            group_name = (await ainput("Enter group name: ")).strip()
+            new_member = (await ainput("Enter username to add: ")).strip()
             
             add_msg = {
                 "action": "add_member",
                 "group_name": group_name,
-                "username": new_member,
-                "adder": username
+                "username": new_member
             }
-            await websocket.send(json.dumps(add_msg))
-            response = json.loads(await websocket.recv())
+            await websocket.send(add_msg)
+            response = await websocket.recv()
             print(response.get("message"))
         
         elif choice == "6":
 
-            group_name = input("Enter group name: ").strip()
+            group_name = (await ainput("Enter group name: ")).strip()
             
             list_msg = {
                 "action": "list_members",
                 "group_name": group_name
             }
-            await websocket.send(json.dumps(list_msg))
-            response = json.loads(await websocket.recv())
+            await websocket.send(list_msg)
+            response = await websocket.recv()
             
             if response.get("status") == "ok":
                 members = response.get("members")
@@ -279,22 +450,21 @@ async def group_chat_menu(websocket, username):
         
         elif choice == "7":
 
-            group_name = input("Enter name of group to leave: ").strip()
-            confirm = input(f"Are you sure you want to leave '{group_name}'? (y/n): ").strip().lower()
+            group_name = (await ainput("Enter name of group to leave: ")).strip()
+            confirm = (await ainput(f"Are you sure you want to leave '{group_name}'? (y/n): ")).strip().lower()
             
             if confirm == 'y':
                 leave_msg = {
                     "action": "leave_group",
-                    "username": username,
                     "group_name": group_name
                 }
-                await websocket.send(json.dumps(leave_msg))
-                response = json.loads(await websocket.recv())
+                await websocket.send(leave_msg)
+                response = await websocket.recv()
                 print(response.get("message"))
         
         elif choice == "8":
 
-            message_id = input("Enter message ID to check: ").strip()
+            message_id = (await ainput("Enter message ID to check: ")).strip()
             try:
                 message_id = int(message_id)
                 
@@ -302,25 +472,30 @@ async def group_chat_menu(websocket, username):
                     "action": "group_read_status",
                     "message_id": message_id
                 }
-                await websocket.send(json.dumps(check_msg))
-                response = json.loads(await websocket.recv())
+                await websocket.send(check_msg)
+                response = await websocket.recv()
                 
                 if response.get("status") == "ok":
                     read_list = response.get("read_by")
                     unread_list = response.get("not_read_by")
                     
                     print("\n=== Message Read Status ===")
+                    print(f"Read: {response.get('read_count')}  Unread: {response.get('unread_count')}")
                     if read_list:
                         print("\nRead by:")
                         print(f"{'Username':<20} {'Read At':<25}")
                         print("-" * 45)
                         for r in read_list:
                             print(f"{r['username']:<20} {r['read_at']:<25}")
+                        if response.get("next_read_cursor"):
+                            print("...")
                     
                     if unread_list:
                         print("\nNot read by:")
                         for username in unread_list:
                             print(f"- {username}")
+                        if response.get("next_unread_cursor"):
+                            print("- ...")
                     
                     if not read_list and not unread_list:
                         print("No read receipt data available for this message.")
@@ -333,19 +508,18 @@ async def group_chat_menu(websocket, username):
         
         elif choice == "9":
 
-            message_id = input("Enter group message ID to delete: ").strip()
+            message_id = (await ainput("Enter group message ID to delete: ")).strip()
             try:
                 message_id = int(message_id)
-                confirm = input(f"Are you sure you want to delete group message ID {message_id}? (y/n): ").strip().lower()
+                confirm = (await ainput(f"Are you sure you want to delete group message ID {message_id}? (y/n): ")).strip().lower()
                 
                 if confirm == 'y':
                     delete_msg = {
                         "action": "delete_group_message",
-                        "username": username,
                         "message_id": message_id
                     }
-                    await websocket.send(json.dumps(delete_msg))
-                    response = json.loads(await websocket.recv())
+                    await websocket.send(delete_msg)
+                    response = await websocket.recv()
                     print(response.get("message"))
                 else:
                     print("Group message deletion cancelled.")
@@ -0,0 +1,74 @@
+"""Wire encodings, chosen per connection with a websocket subprotocol.
+
+A client that asks for no subprotocol gets JSON text frames, as before.
+``chat.msgpack`` switches both directions to MessagePack binary frames when
+the ``msgpack`` package is installed. Independently of the encoding, history
+requests may ask for ``columnar`` message lists, which send the column names
+once instead of repeating the keys in every row.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class DecodeError(ValueError):
+    pass
+
+
+class JsonCodec:
+    name = "JSON"
+    subprotocol = "chat.json"
+
+    def encode(self, obj):
+        return json.dumps(obj)
+
+    def decode(self, frame):
+        try:
+            return json.loads(frame)
+        except (ValueError, TypeError) as err:
+            raise DecodeError(str(err)) from err
+
+
+class MsgpackCodec:
+    name = "MessagePack"
+    subprotocol = "chat.msgpack"
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, frame):
+        try:
+            return msgpack.unpackb(frame, raw=False)
+        except (ValueError, TypeError) as err:
+            raise DecodeError(str(err)) from err
+
+
+JSON = JsonCodec()
+
+#In order of preference
+CODECS = [MsgpackCodec()] if msgpack is not None else []
+CODECS.append(JSON)
+
+
+def subprotocols():
+    return [codec.subprotocol for codec in CODECS]
+
+
+def codec_for(subprotocol):
+    for codec in CODECS:
+        if codec.subprotocol == subprotocol:
+            return codec
+    return JSON
+
+
+def columns(names, rows):
+    return {"columns": list(names), "rows": rows}
+
+
+def rows_from_columns(table):
+    """Turn a columnar message list back into one dict per row."""
+    names = table["columns"]
+    return [dict(zip(names, row)) for row in table["rows"]]
@@ -0,0 +1,168 @@
+import time
+import traceback
+
+
+class Field:
+    """Declarative description of one request field.
+
+    ``kind`` is ``str`` (non-empty string), ``int`` (integer, not bool),
+    ``bool`` or ``list`` (list of ``items``). Optional fields that are absent
+    take ``default``.
+    """
+
+    def __init__(self, kind, required=True, default=None, min_value=None, max_value=None,
+                 items=None, max_items=None):
+        self.kind = kind
+        self.required = required
+        self.default = default
+        self.min_value = min_value
+        self.max_value = max_value
+        self.items = items
+        self.max_items = max_items
+
+    def check(self, name, value):
+        """Return an error message for ``value``, or None if it is valid."""
+        if self.kind is str:
+            if not isinstance(value, str) or not value:
+                return f"'{name}' must be a non-empty string."
+        elif self.kind is int:
+            if isinstance(value, bool) or not isinstance(value, int):
+                return f"'{name}' must be an integer."
+            if self.min_value is not None and value < self.min_value:
+                return f"'{name}' must be at least {self.min_value}."
+            if self.max_value is not None and value > self.max_value:
+                return f"'{name}' must be at most {self.max_value}."
+        elif self.kind is bool:
+            if not isinstance(value, bool):
+                return f"'{name}' must be true or false."
+        elif self.kind is list:
+            if not isinstance(value, list) or not value:
+                return f"'{name}' must be a non-empty list."
+            if self.max_items is not None and len(value) > self.max_items:
+                return f"'{name}' may hold at most {self.max_items} items."
+            if self.items is not None:
+                item_field = Field(self.items, min_value=self.min_value, max_value=self.max_value)
+                for item in value:
+                    if item_field.check(name, item):
+                        return f"'{name}' must only contain {self.items.__name__} values."
+        return None
+
+
+class Action:
+    def __init__(self, name, handler, schema, public, actor):
+        self.name = name
+        self.handler = handler
+        self.schema = schema
+        self.public = public
+        self.actor = actor
+
+    def validate(self, data):
+        """Return (request, error) where request holds only the declared fields."""
+        request = {}
+        missing = []
+        for name, field in self.schema.items():
+            value = data.get(name)
+            if value is None:
+                if field.required:
+                    missing.append(name)
+                request[name] = field.default
+                continue
+            error = field.check(name, value)
+            if error:
+                return None, error
+            request[name] = value
+        if missing:
+            return None, f"Missing {', '.join(missing)}."
+        return request, None
+
+
+class Dispatcher:
+    """Maps action names to handler coroutines.
+
+    Handlers are registered with :meth:`action` together with a schema of
+    :class:`Field` objects, and are called as ``handler(ctx, request)`` with
+    the validated request. They return the response dict. Timing hooks are
+    called as ``hook(action, seconds, status)`` after every request.
+    """
+
+    def __init__(self):
+        self.actions = {}
+        self.timing_hooks = []
+
+    def action(self, name, public=False, actor=None, **schema):
+        """Register a handler. ``public`` actions may run before login; ``actor``
+        names a legacy identity field that must match the session user."""
+        def register(handler):
+            self.actions[name] = Action(name, handler, schema, public, actor)
+            return handler
+        return register
+
+    def can_overlap(self, data):
+        """Whether a request may run alongside others from the same connection.
+
+        ``register`` and ``login`` change who the connection is, so they (and
+        unknown actions) always run alone.
+        """
+        action = self.actions.get(data.get("action"))
+        return action is not None and not action.public
+
+    def add_timing_hook(self, hook):
+        self.timing_hooks.append(hook)
+
+    async def dispatch(self, ctx, data):
+        action = self.actions.get(data.get("action"))
+        if action is None:
+            return {"status": "error", "message": "Unknown action."}
+
+        if not action.public:
+            if ctx.user_id is None:
+                return {"status": "error", "message": "Please log in first."}
+            claimed = data.get(action.actor) if action.actor else None
+            if claimed and claimed != ctx.username:
+                return {"status": "error", "message": f"You are logged in as '{ctx.username}'."}
+
+        request, error = action.validate(data)
+        if error:
+            return {"status": "error", "message": error}
+
+        started = time.perf_counter()
+        try:
+            response = await action.handler(ctx, request)
+        except Exception:
+            traceback.print_exc()
+            response = {"status": "error", "message": "Internal server error."}
+        elapsed = time.perf_counter() - started
+        for hook in self.timing_hooks:
+            hook(action.name, elapsed, response.get("status"))
+        return response
+
+
+class ActionStats:
+    """Timing hook that keeps request counts and latency per action."""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.actions = {}
+
+    def __call__(self, action, seconds, status):
+        entry = self.actions.get(action)
+        if entry is None:
+            entry = self.actions[action] = {"count": 0, "errors": 0, "total": 0.0, "max": 0.0}
+        entry["count"] += 1
+        if status != "ok":
+            entry["errors"] += 1
+        entry["total"] += seconds
+        entry["max"] = max(entry["max"], seconds)
+
+    def snapshot(self):
+        uptime = time.monotonic() - self.started_at
+        return {
+            name: {
+                "count": entry["count"],
+                "errors": entry["errors"],
+                "per_second": round(entry["count"] / uptime, 3) if uptime else 0.0,
+                "avg_ms": round(entry["total"] / entry["count"] * 1000, 3),
+                "max_ms": round(entry["max"] * 1000, 3)
+            }
+            for name, entry in self.actions.items()
+        }
@@ -0,0 +1,207 @@
+"""In-process metrics in the Prometheus text exposition format.
+
+Counters, gauges and histograms are created on a :class:`MetricsRegistry`
+and updated from the event loop or the database threads. ``serve_metrics``
+exposes the registry on a small HTTP endpoint for a Prometheus scraper (or
+curl).
+"""
+import asyncio
+import bisect
+import threading
+
+#Seconds; from sub-millisecond cache hits up to requests stuck behind a full pool
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=(), function=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        #Read at scrape time instead of being updated, for values kept elsewhere
+        self.function = function
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _default(self):
+        #Unlabelled metrics are used directly instead of through labels()
+        return self.labels()
+
+    def render(self):
+        if self.function is not None:
+            self._default().set(self.function())
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(child.render(self.name, self.label_names, values))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = value
+
+    def render(self, name, label_names, values):
+        return [f"{name}{_format_labels(label_names, values)} {_format_value(self.value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class Gauge(_Metric):
+    """A value that goes up and down."""
+
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def dec(self, amount=1):
+        self._default().dec(amount)
+
+    def set(self, value):
+        self._default().set(value)
+
+
+class _Buckets:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self, name, label_names, values):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float("inf"),), counts):
+            cumulative += count
+            le = _format_labels(label_names, values, [("le", _format_value(float(bound)))])
+            lines.append(f"{name}_bucket{le} {cumulative}")
+        plain = _format_labels(label_names, values)
+        lines.append(f"{name}_sum{plain} {_format_value(total)}")
+        lines.append(f"{name}_count{plain} {cumulative}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        #Unlabelled series are exported as 0 from the start rather than appearing on first use
+        if not metric.label_names:
+            metric.labels()
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=(), function=None):
+        return self._add(Counter(name, help_text, labels, function))
+
+    def gauge(self, name, help_text, labels=(), function=None):
+        return self._add(Gauge(name, help_text, labels, function))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help_text, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+async def serve_metrics(registry, host="localhost", port=9100):
+    """Serve ``GET /metrics`` over plain HTTP; anything else gets a 404."""
+    async def handle(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5.0)
+            #Skip the headers; the request has no body
+            while (await asyncio.wait_for(reader.readline(), 5.0)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found.\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,92 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Thread-safe pool of database connections.
+
+    ``connect`` opens a new connection, ``is_healthy`` tells whether an idle
+    one can still be used. Idle connections that have not been used for
+    ``health_check_interval`` seconds are checked before being handed out and
+    replaced if the server dropped them.
+    """
+
+    def __init__(self, connect, is_healthy, min_size=1, max_size=10,
+                 acquire_timeout=5.0, health_check_interval=30.0):
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError("Pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1.")
+        self._connect = connect
+        self._is_healthy = is_healthy
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+
+        #Idle connections as (conn, last_used); LIFO keeps the warm ones busy
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._closed = False
+
+        for _ in range(min_size):
+            self._idle.put((self._connect(), time.monotonic()))
+
+    def acquire(self):
+        if self._closed:
+            raise PoolTimeout("Connection pool is closed.")
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise PoolTimeout(f"No database connection available after {self.acquire_timeout}s.")
+        try:
+            return self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _checkout(self):
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - last_used < self.health_check_interval or self._is_healthy(conn):
+                return conn
+            self._discard(conn)
+
+    def release(self, conn, discard=False):
+        try:
+            if discard or self._closed:
+                self._discard(conn)
+            else:
+                self._idle.put((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except BaseException:
+            self.release(conn, discard=not self._is_healthy(conn))
+            raise
+        self.release(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
@@ -1,8 +1,28 @@
+import argparse
 import asyncio
+import getpass
+import hashlib
+import hmac
+import multiprocessing
+import os
+import re
+import signal
+import socket
+import sys
 import websockets
-import json
-import mysql.connector
 from datetime import datetime
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+from bus import BusHub, MemoryBus, SocketEndpoint
+from codec import DecodeError, codec_for, columns, subprotocols
+
+from dispatch import ActionStats, Dispatcher, Field
+from metrics import SIZE_BUCKETS, MetricsRegistry, serve_metrics
+from sessions import ClientContext, Outbox, SessionRegistry
+from storage import DuplicateError, StorageError, create_storage
+
+#"mysql" or "sqlite"; can be overridden with --storage
+storage_backend = 'mysql'
 
 db_config = {
     'user': 'root',
@@ -11,600 +31,974 @@ db_config = {
     'database': 'chatdb'
 }
 
-conn = mysql.connector.connect(**db_config)
-cursor = conn.cursor()
-
-def setup_database():
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS groups (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            name VARCHAR(100) NOT NULL UNIQUE,
-            created_by INT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (created_by) REFERENCES users(id)
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS group_members (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            group_id INT NOT NULL,
-            user_id INT NOT NULL,
-            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (group_id) REFERENCES groups(id),
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            UNIQUE KEY unique_member (group_id, user_id)
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS group_messages (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            group_id INT NOT NULL,
-            sender_id INT NOT NULL,
-            message TEXT NOT NULL,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (group_id) REFERENCES groups(id),
-            FOREIGN KEY (sender_id) REFERENCES users(id)
-        )
-    """)
-    
-    #Normal read_receipts
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS read_receipts (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            message_id INT NOT NULL,
-            reader_id INT NOT NULL,
-            read_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (message_id) REFERENCES messages(id),
-            FOREIGN KEY (reader_id) REFERENCES users(id),
-            UNIQUE KEY unique_read (message_id, reader_id)
-        )
-    """)
-    
-    #group_read_receipts
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS group_read_receipts (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            message_id INT NOT NULL,
-            reader_id INT NOT NULL,
-            read_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (message_id) REFERENCES group_messages(id),
-            FOREIGN KEY (reader_id) REFERENCES users(id),
-            UNIQUE KEY unique_group_read (message_id, reader_id)
-        )
-    """)
-    
-    conn.commit()
+pool_config = {
+    'min_size': 2,
+    'max_size': 10,
+    'acquire_timeout': 5.0,
+    'health_check_interval': 30.0
+}
+
+#path may be ':memory:' for a throwaway in-memory database
+sqlite_config = {
+    'path': 'chatdb.sqlite3',
+    'max_size': 4,
+    'busy_timeout': 5.0
+}
+
+#recent_* bound the in-memory buffers of each conversation's newest messages,
+#which answer most show/show_group_messages pages without a query
+cache_config = {
+    'cache_size': 10000,
+    'cache_ttl': 300.0,
+    'recent_cache_bytes': 16 * 1024 * 1024,
+    'recent_per_conversation': 200
+}
+
+#Group commit for message inserts: up to write_batch_size messages, or whatever
+#arrived within write_batch_delay seconds, share one transaction. 0 disables it.
+write_batch_config = {
+    'write_batch_size': 0,
+    'write_batch_delay': 0.005
+}
+
+#permessage-deflate for every connection that offers it. Smaller windows and
+#memLevel cut the zlib state kept per connection at a small cost in ratio.
+compression_config = {
+    'enabled': True,
+    'max_window_bits': 12,
+    'mem_level': 5
+}
+
+#Requests carrying a request_id may run concurrently, up to this many per connection
+pipeline_config = {
+    'max_in_flight': 16
+}
+
+#Outgoing frames queued per connection. Replies wait for room; pushes that do not
+#fit follow the policy: "drop", "coalesce" (one "missed" notice) or "disconnect".
+outbox_config = {
+    'max_frames': 256,
+    'max_bytes': 1048576,
+    'policy': 'coalesce'
+}
+
+#Largest incoming frame accepted (bigger ones close the connection with 1009), and
+#how many received frames are buffered before the server stops reading the socket
+inbound_config = {
+    'max_frame_bytes': 65536,
+    'max_queue': 16
+}
+
+#Passwords are stored as salted PBKDF2-SHA256 hashes of this many iterations.
+#Hashing runs in a thread so logins do not stall the event loop.
+auth_config = {
+    'iterations': 200000,
+    'salt_bytes': 16
+}
+
+#Deletes only tombstone a message. A background task then removes tombstoned
+#messages and their receipts, batch_size per transaction and one batch per
+#interval seconds while any are left, checking again every idle_interval seconds.
+purge_config = {
+    'batch_size': 200,
+    'interval': 0.5,
+    'idle_interval': 30.0
+}
+
+#History older than max_age_days (0 = never) moves out of the database into
+#compressed segment files under path, which still serve old history pages.
+#Batches run like the purge: batch_size messages per table every interval
+#seconds while old ones are left, then a check every idle_interval seconds.
+archive_config = {
+    'path': 'chat_archive',
+    'max_age_days': 0,
+    'segment_bytes': 64 * 1024 * 1024,
+    'batch_size': 1000,
+    'interval': 1.0,
+    'idle_interval': 3600.0
+}
+
+#Prometheus text metrics on http://host:port/metrics; port 0 disables the endpoint
+metrics_config = {
+    'host': 'localhost',
+    'port': 9100
+}
+
+def build_storage(backend, db_path=None):
+    archive_options = {}
+    #Pages only look for archived history when there is, or will be, some
+    if archive_config['max_age_days'] > 0 or os.path.isdir(archive_config['path']):
+        archive_options = {
+            'archive_path': archive_config['path'],
+            'archive_segment_bytes': archive_config['segment_bytes']
+        }
+    if backend == "sqlite":
+        options = dict(sqlite_config)
+        if db_path:
+            options['path'] = db_path
+        return create_storage("sqlite", **options, **cache_config, **write_batch_config, **archive_options)
+    return create_storage("mysql", db_config=db_config, **pool_config, **cache_config, **write_batch_config,
+                          **archive_options)
+
+#Set in __main__ once the backend is chosen
+storage = None
+#Replaced by a connection to the supervisor's hub when running with --workers
+bus = MemoryBus().endpoint()
+sessions = SessionRegistry()
+dispatcher = Dispatcher()
+action_stats = ActionStats()
+dispatcher.add_timing_hook(action_stats)
+action = dispatcher.action
+
+#Metrics
+
+metrics = MetricsRegistry()
+connections_active = metrics.gauge("chat_connections_active", "Open websocket connections.")
+connections_total = metrics.counter("chat_connections_total", "Websocket connections accepted.")
+online_users = metrics.gauge("chat_online_users", "Users with at least one logged-in connection.",
+                             function=lambda: sessions.user_count())
+requests_total = metrics.counter("chat_requests_total", "Requests handled, by action and status.",
+                                 labels=("action", "status"))
+requests_in_flight = metrics.gauge("chat_requests_in_flight", "Requests being handled.")
+request_seconds = metrics.histogram("chat_request_seconds", "Time to handle a request.", labels=("action",))
+db_wait_seconds = metrics.histogram("chat_db_pool_wait_seconds", "Time spent waiting for a pooled connection.",
+                                    labels=("statement",))
+db_query_seconds = metrics.histogram("chat_db_query_seconds", "Time spent running a storage call's statements.",
+                                     labels=("statement",))
+db_commit_seconds = metrics.histogram("chat_db_commit_seconds", "Time spent committing a storage call.",
+                                      labels=("statement",))
+write_queue_depth = metrics.gauge("chat_write_queue_depth", "Messages waiting for a group commit.",
+                                  function=lambda: storage.write_queue_depth() if storage else 0)
+send_buffer_bytes = metrics.gauge("chat_send_buffer_bytes", "Outbound bytes buffered for logged-in sockets.",
+                                  function=lambda: sessions.write_buffer_bytes())
+frame_bytes = metrics.histogram("chat_frame_bytes", "Websocket frame sizes.", labels=("direction",),
+                                buckets=SIZE_BUCKETS)
+pushed_frames = metrics.counter("chat_pushed_frames_total", "Event frames pushed to connected users.")
+outbox_frames = metrics.gauge("chat_outbox_frames", "Frames queued in connection outboxes.",
+                              function=lambda: sessions.queued_frames())
+history_cache_hits = metrics.counter("chat_history_cache_hits_total", "History pages served from memory.",
+                                     function=lambda: storage.history_cache().hits if storage else 0)
+history_cache_misses = metrics.counter("chat_history_cache_misses_total", "History pages read from the database.",
+                                       function=lambda: storage.history_cache().misses if storage else 0)
+history_cache_bytes = metrics.gauge("chat_history_cache_bytes", "Estimated memory held by cached history.",
+                                    function=lambda: storage.history_cache().size_bytes() if storage else 0)
+archived_messages = metrics.counter("chat_archived_messages_total", "Old messages moved to the history archive.")
+purged_messages = metrics.counter("chat_purged_messages_total", "Deleted messages removed by the background purge.")
+outbox_overflows = metrics.counter("chat_outbox_overflows_total", "Pushes that did not fit a connection's outbox.",
+                                   labels=("policy",))
+
+def record_request(action_name, seconds, status):
+    requests_total.labels(action_name, status).inc()
+    request_seconds.labels(action_name).observe(seconds)
+
+def record_db_timing(statement, wait, query, commit):
+    db_wait_seconds.labels(statement).observe(wait)
+    db_query_seconds.labels(statement).observe(query)
+    db_commit_seconds.labels(statement).observe(commit)
+
+def record_overflow(policy):
+    outbox_overflows.labels(policy).inc()
+
+def record_push(size, recipients):
+    frame_bytes.labels("push").observe(size)
+    pushed_frames.inc(recipients)
+
+dispatcher.add_timing_hook(record_request)
+sessions.add_send_hook(record_push)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+MAX_READ_BATCH = 1000
+MAX_SEARCH_PAGE = 100
+MAX_SEARCH_OFFSET = 1000
+MAX_SEARCH_TERMS = 16
+SEARCH_SCOPES = ("all", "direct", "group")
+#"detail" lists who read what a page at a time; "aggregate" gives read/unread counts per message
+READ_STATUS_MODES = ("detail", "aggregate")
+READ_STATUS_LISTS = ("both", "read", "unread")
+
+#Paging fields shared by the history actions
+PAGE_FIELDS = {
+    "since_id": Field(int, required=False, min_value=0),
+    "before_id": Field(int, required=False, min_value=0),
+    "limit": Field(int, required=False, default=DEFAULT_PAGE_SIZE, min_value=1, max_value=MAX_PAGE_SIZE),
+    "columnar": Field(bool, required=False, default=False)
+}
+
+def page_args(req):
+    return {"since_id": req["since_id"], "before_id": req["before_id"], "limit": req["limit"]}
+
+def page_response(names, rows, has_more, req):
+    #rows hold values in the order of names, id first. last_id is the cursor
+    #for the next "since_id" sync, first_id for scrolling back with "before_id".
+    if req["columnar"]:
+        messages_data = columns(names, rows)
+    else:
+        messages_data = [dict(zip(names, row)) for row in rows]
+    return {
+        "status": "ok",
+        "messages": messages_data,
+        "has_more": has_more,
+        "first_id": rows[0][0] if rows else req["before_id"],
+        "last_id": rows[-1][0] if rows else req["since_id"]
+    }
+
+def read_status_mode(req):
+    if req["mode"] not in READ_STATUS_MODES:
+        return f"'mode' must be one of {', '.join(READ_STATUS_MODES)}."
+    return None
+
+def parse_read_cursor(value):
+    #Cursors are opaque to clients: "<last_read_id>:<user_id>" of the last member on a page
+    if value is None:
+        return None
+    try:
+        last_read_id, user_id = value.split(":")
+        return int(last_read_id), int(user_id)
+    except ValueError:
+        raise ValueError("Invalid read status cursor.")
+
+def next_read_cursor(rows, has_more):
+    if not has_more or not rows:
+        return None
+    return f"{rows[-1][2]}:{rows[-1][3]}"
+
+def hash_password(password, salt=None, iterations=None):
+    salt = salt or os.urandom(auth_config['salt_bytes'])
+    iterations = iterations or auth_config['iterations']
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${salt.hex()}${digest.hex()}"
+
+def check_password(password, stored):
+    #Hashed again with the stored salt and iteration count, so raising the count
+    #only affects new passwords
+    _, iterations, salt, _ = stored.split("$")
+    return hmac.compare_digest(hash_password(password, bytes.fromhex(salt), int(iterations)), stored)
+
+def log_in(ctx, user_id, username):
+    ctx.user_id = user_id
+    ctx.username = username
+    sessions.add(username, ctx.websocket)
+
+#Session
+
+@action("register", public=True, username=Field(str), password=Field(str))
+async def register(ctx, req):
+    username = req["username"]
+    password_hash = await asyncio.to_thread(hash_password, req["password"])
+    try:
+        user_id = await storage.register_user(username, password_hash)
+    except StorageError as err:
+        return {"status": "error", "message": f"Registration failed: {err.msg}"}
+    log_in(ctx, user_id, username)
+    return {"status": "ok", "message": f"User '{username}' registered successfully."}
+
+@action("login", public=True, username=Field(str), password=Field(str))
+async def login(ctx, req):
+    username = req["username"]
+    user_id = await storage.get_user_id(username)
+    if user_id is None:
+        return {"status": "error", "message": f"User '{username}' not found."}
+    stored = await storage.get_password_hash(user_id)
+    if stored is None:
+        #Accounts from before passwords cannot log in until an administrator sets one
+        return {"status": "error", "message": f"User '{username}' has no password yet; ask an administrator to set one."}
+    if not await asyncio.to_thread(check_password, req["password"], stored):
+        return {"status": "error", "message": "Incorrect password."}
+    log_in(ctx, user_id, username)
+    return {"status": "ok", "message": f"Logged in as '{username}'."}
+
+#Direct messages
+
+@action("send", actor="sender", receiver=Field(str), message=Field(str))
+async def send(ctx, req):
+    receiver = req["receiver"]
+    msg_text = req["message"]
+    receiver_id = await storage.get_user_id(receiver)
+    if receiver_id is None:
+        return {"status": "error", "message": f"Receiver '{receiver}' not found."}
+
+    try:
+        message_id, timestamp = await storage.send_message(ctx.user_id, receiver_id, msg_text, ctx.username)
+    except StorageError as err:
+        return {"status": "error", "message": f"Failed to send message: {err.msg}"}
+    ctx.defer_push([receiver], {
+        "event": "message",
+        "id": message_id,
+        "sender": ctx.username,
+        "message": msg_text,
+        "timestamp": str(timestamp)
+    })
+    return {"status": "ok", "message": "Message sent."}
+
+@action("show", actor="username", **PAGE_FIELDS)
+async def show(ctx, req):
+    messages_list, has_more = await storage.fetch_messages(ctx.user_id, **page_args(req))
+    rows = [[row[0], row[1], str(row[2]), row[3]] for row in messages_list]
+    return page_response(("id", "message", "timestamp", "sender"), rows, has_more, req)
+
+@action("mark_read", actor="username", message_id=Field(int))
+async def mark_read(ctx, req):
+    message_id = req["message_id"]
+    try:
+        receipt = await storage.mark_read(ctx.user_id, message_id)
+    except StorageError as err:
+        return {"status": "error", "message": f"Failed to mark as read: {err.msg}"}
+    if not receipt:
+        return {"status": "error", "message": "Cannot mark this message as read."}
+
+    sender, read_at = receipt
+    ctx.defer_push([sender], {
+        "event": "read",
+        "message_id": message_id,
+        "reader": ctx.username,
+        "read_at": str(read_at)
+    })
+    return {"status": "ok", "message": "Message marked as read."}
+
+@action("mark_read_batch", actor="username",
+        message_ids=Field(list, required=False, items=int, max_items=MAX_READ_BATCH),
+        sender=Field(str, required=False),
+        up_to_id=Field(int, required=False))
+async def mark_read_batch(ctx, req):
+    message_ids = req["message_ids"]
+    sender = req["sender"]
+    up_to_id = req["up_to_id"]
+    if message_ids is None and not (sender and up_to_id is not None):
+        return {"status": "error", "message": "Provide message_ids, or sender and up_to_id."}
+
+    try:
+        if message_ids is not None:
+            marked, read_at = await storage.mark_read_batch(ctx.user_id, list(set(message_ids)))
+        else:
+            sender_id = await storage.get_user_id(sender)
+            if sender_id is None:
+                return {"status": "error", "message": f"Sender '{sender}' not found."}
+            marked, read_at = await storage.mark_read_up_to(ctx.user_id, sender_id, up_to_id)
+    except StorageError as err:
+        return {"status": "error", "message": f"Failed to mark as read: {err.msg}"}
+
+    by_sender = {}
+    for message_id, message_sender in marked:
+        by_sender.setdefault(message_sender, []).append(message_id)
+    for message_sender, ids in by_sender.items():
+        ctx.defer_push([message_sender], {
+            "event": "read_batch",
+            "message_ids": sorted(ids),
+            "reader": ctx.username,
+            "read_at": str(read_at)
+        })
+
+    marked_ids = sorted(row[0] for row in marked)
+    response = {
+        "status": "ok",
+        "message": f"{len(marked_ids)} message(s) marked as read.",
+        "marked": marked_ids
+    }
+    if message_ids is not None:
+        response["rejected"] = sorted(set(message_ids) - set(marked_ids))
+    return response
+
+@action("read_status", actor="username", mode=Field(str, required=False, default="detail"), **PAGE_FIELDS)
+async def read_status(ctx, req):
+    error = read_status_mode(req)
+    if error:
+        return {"status": "error", "message": error}
+
+    if req["mode"] == "aggregate":
+        counts, has_more = await storage.read_counts(ctx.user_id, **page_args(req))
+        response = page_response(("message_id", "read", "unread"), [list(row) for row in counts], has_more, req)
+        response["read_counts"] = response.pop("messages")
+        return response
+
+    read_list, has_more = await storage.read_status(ctx.user_id, **page_args(req))
+    rows = [[row[0], row[1], str(row[2])] for row in read_list]
+    response = page_response(("message_id", "reader", "read_at"), rows, has_more, req)
+    response["read_status"] = response.pop("messages")
+    return response
+
+@action("delete_message", actor="username", message_id=Field(int))
+async def delete_message(ctx, req):
+    message_id = req["message_id"]
+    sender_id = await storage.get_message_sender(message_id)
+    if sender_id is None:
+        return {"status": "error", "message": "Message not found."}
+    if sender_id != ctx.user_id:
+        return {"status": "error", "message": "You can only delete your own messages."}
+
+    try:
+        if await storage.delete_message(message_id) > 0:
+            return {"status": "ok", "message": "Message deleted successfully."}
+        return {"status": "error", "message": "Failed to delete message."}
+    except StorageError as err:
+        return {"status": "error", "message": f"Failed to delete message: {err.msg}"}
+
+#Groups
+
+@action("create_group", actor="creator", group_name=Field(str))
+async def create_group(ctx, req):
+    group_name = req["group_name"]
+    try:
+        await storage.create_group(group_name, ctx.user_id)
+    except StorageError as err:
+        return {"status": "error", "message": f"Group creation failed: {err.msg}"}
+    return {"status": "ok", "message": f"Group '{group_name}' created successfully."}
+
+@action("add_member", actor="adder", group_name=Field(str), username=Field(str))
+async def add_member(ctx, req):
+    group_name = req["group_name"]
+    new_member = req["username"]
+    group_id = await storage.get_group_id(group_name)
+    if group_id is None:
+        return {"status": "error", "message": f"Group '{group_name}' not found."}
+    if not await storage.is_member(group_id, ctx.user_id):
+        return {"status": "error", "message": f"User '{ctx.username}' is not a member of this group."}
+
+    new_member_id = await storage.get_user_id(new_member)
+    if new_member_id is None:
+        return {"status": "error", "message": f"User '{new_member}' not found."}
+    try:
+        await storage.add_member(group_id, new_member_id)
+    except DuplicateError:
+        return {"status": "error", "message": f"User '{new_member}' is already a member of this group."}
+    except StorageError as err:
+        return {"status": "error", "message": f"Failed to add member: {err.msg}"}
+    return {"status": "ok", "message": f"User '{new_member}' added to group '{group_name}' successfully."}
+
+@action("list_groups", actor="username")
+async def list_groups(ctx, req):
+    groups_list = await storage.list_groups(ctx.user_id)
+    groups_data = [
+        {"id": row[0], "name": row[1], "created_at": str(row[2]), "member_count": row[3]} 
+        for row in groups_list
+    ]
+    return {"status": "ok", "groups": groups_data}
+
+@action("list_members", group_name=Field(str))
+async def list_members(ctx, req):
+    group_name = req["group_name"]
+    group_id = await storage.get_group_id(group_name)
+    if group_id is None:
+        return {"status": "error", "message": f"Group '{group_name}' not found."}
+
+    members_list = await storage.list_members(group_id)
+    members_data = [
+        {"username": row[0], "joined_at": str(row[1]), "is_admin": (row[0] == row[2])} 
+        for row in members_list
+    ]
+    return {"status": "ok", "members": members_data}
+
+@action("leave_group", actor="username", group_name=Field(str))
+async def leave_group(ctx, req):
+    group_name = req["group_name"]
+    group_id = await storage.get_group_id(group_name)
+    if group_id is None:
+        return {"status": "error", "message": f"Group '{group_name}' not found."}
+    if await storage.get_group_creator(group_id) == ctx.user_id:
+        return {"status": "error", "message": "Group creator cannot leave. You must delete the group instead."}
+
+    if await storage.remove_member(group_id, ctx.user_id) > 0:
+        return {"status": "ok", "message": f"Successfully left group '{group_name}'."}
+    return {"status": "error", "message": f"User '{ctx.username}' is not a member of this group."}
+
+#Group messages
+
+@action("send_group_message", actor="sender", group_name=Field(str), message=Field(str))
+async def send_group_message(ctx, req):
+    group_name = req["group_name"]
+    msg_text = req["message"]
+    group_id = await storage.get_group_id(group_name)
+    if group_id is None:
+        return {"status": "error", "message": f"Group '{group_name}' not found."}
+    if not await storage.is_member(group_id, ctx.user_id):
+        return {"status": "error", "message": f"User '{ctx.username}' is not a member of this group."}
+
+    try:
+        message_id, timestamp = await storage.send_group_message(group_id, ctx.user_id, msg_text, ctx.username)
+    except StorageError as err:
+        return {"status": "error", "message": f"Failed to send group message: {err.msg}"}
+    members = await storage.group_member_names(group_id)
+    ctx.defer_push([m for m in members if m != ctx.username], {
+        "event": "group_message",
+        "group_name": group_name,
+        "id": message_id,
+        "sender": ctx.username,
+        "message": msg_text,
+        "timestamp": str(timestamp)
+    })
+    return {"status": "ok", "message": "Group message sent."}
+
+@action("show_group_messages", actor="username", group_name=Field(str), **PAGE_FIELDS)
+async def show_group_messages(ctx, req):
+    group_name = req["group_name"]
+    group_id = await storage.get_group_id(group_name)
+    if group_id is None:
+        return {"status": "error", "message": f"Group '{group_name}' not found."}
+    if not await storage.is_member(group_id, ctx.user_id):
+        return {"status": "error", "message": f"User '{ctx.username}' is not a member of this group."}
+
+    messages_list, has_more, advanced = await storage.fetch_group_messages(group_id, ctx.user_id, **page_args(req))
+    rows = [[row[0], row[3], row[1], str(row[2])] for row in messages_list]
+
+    #Tell each sender how far this reader has got in the group
+    if advanced:
+        last_read = {}
+        for row in messages_list:
+            if row[4] != ctx.user_id:
+                last_read[row[3]] = row[0]
+        for sender, up_to_id in last_read.items():
+            ctx.defer_push([sender], {
+                "event": "group_read",
+                "group_name": group_name,
+                "reader": ctx.username,
+                "up_to_id": up_to_id
+            })
+    return page_response(("id", "sender", "message", "timestamp"), rows, has_more, req)
+
+@action("delete_group_message", actor="username", message_id=Field(int))
+async def delete_group_message(ctx, req):
+    message_id = req["message_id"]
+    message_row = await storage.get_group_message(message_id)
+    if not message_row:
+        return {"status": "error", "message": "Group message not found."}
+    if message_row[0] != ctx.user_id and message_row[2] != ctx.user_id:
+        return {"status": "error", "message": "You can only delete your own messages or messages in groups you created."}
+
+    try:
+        if await storage.delete_group_message(message_id) > 0:
+            return {"status": "ok", "message": "Group message deleted successfully."}
+        return {"status": "error", "message": "Failed to delete group message."}
+    except StorageError as err:
+        return {"status": "error", "message": f"Failed to delete group message: {err.msg}"}
+
+@action("group_read_status", message_id=Field(int, required=False), group_name=Field(str, required=False),
+        mode=Field(str, required=False, default="detail"),
+        list=Field(str, required=False, default="both"),
+        read_cursor=Field(str, required=False), unread_cursor=Field(str, required=False), **PAGE_FIELDS)
+async def group_read_status(ctx, req):
+    error = read_status_mode(req)
+    if error:
+        return {"status": "error", "message": error}
+
+    if req["mode"] == "aggregate":
+        group_name = req["group_name"]
+        if not group_name:
+            return {"status": "error", "message": "'group_name' is required for aggregate read status."}
+        group_id = await storage.get_group_id(group_name)
+        if group_id is None:
+            return {"status": "error", "message": f"Group '{group_name}' not found."}
+        if not await storage.is_member(group_id, ctx.user_id):
+            return {"status": "error", "message": f"User '{ctx.username}' is not a member of this group."}
+        counts, has_more = await storage.group_read_counts(group_id, **page_args(req))
+        response = page_response(("message_id", "sender", "read", "unread"),
+                                 [list(row) for row in counts], has_more, req)
+        response["read_counts"] = response.pop("messages")
+        return response
+
+    if req["message_id"] is None:
+        return {"status": "error", "message": "'message_id' is required for detailed read status."}
+    if req["list"] not in READ_STATUS_LISTS:
+        return {"status": "error", "message": f"'list' must be one of {', '.join(READ_STATUS_LISTS)}."}
+    try:
+        read_after = parse_read_cursor(req["read_cursor"])
+        unread_after = parse_read_cursor(req["unread_cursor"])
+    except ValueError as err:
+        return {"status": "error", "message": str(err)}
+
+    #Non-members get the same answer as for a missing id, so they cannot probe for messages
+    message = await storage.get_group_message(req["message_id"])
+    if message is None or not await storage.is_member(message[1], ctx.user_id):
+        return {"status": "error", "message": "Group message not found."}
+    lists = ("read", "unread") if req["list"] == "both" else (req["list"],)
+    result = await storage.group_read_status(req["message_id"], lists, req["limit"], read_after, unread_after)
+    if result is None:
+        return {"status": "error", "message": "Group message not found."}
+    (_, read_count, unread_count), pages = result
+    response = {"status": "ok", "read_count": read_count, "unread_count": unread_count}
+    if "read" in pages:
+        readers, more = pages["read"]
+        response["read_by"] = [{"username": row[0], "read_at": str(row[1])} for row in readers]
+        response["next_read_cursor"] = next_read_cursor(readers, more)
+    if "unread" in pages:
+        unread, more = pages["unread"]
+        response["not_read_by"] = [row[0] for row in unread]
+        response["next_unread_cursor"] = next_read_cursor(unread, more)
+    return response
+
+#Inbox
+
+def last_message_data(row):
+    #row holds last_message_id, last_sender, preview from an inbox summary row
+    if row[0] is None:
+        return None
+    return {"id": row[0], "sender": row[1], "preview": row[2]}
+
+@action("inbox_summary", actor="username")
+async def inbox_summary(ctx, req):
+    direct, groups = await storage.inbox_summary(ctx.user_id)
+    conversations_data = [
+        {"with": row[0], "unread": row[1], "last_message": last_message_data(row[2:5]),
+         "last_activity": str(row[5])}
+        for row in direct
+    ]
+    groups_data = [
+        {"group_name": row[0], "unread": row[1], "last_message": last_message_data(row[2:5]),
+         "last_activity": str(row[5]), "member_count": row[6]}
+        for row in groups
+    ]
+    return {
+        "status": "ok",
+        "total_unread": sum(c["unread"] for c in conversations_data + groups_data),
+        "conversations": conversations_data,
+        "groups": groups_data
+    }
+
+#Search
+
+@action("search_messages", query=Field(str),
+        group_name=Field(str, required=False),
+        scope=Field(str, required=False, default="all"),
+        limit=Field(int, required=False, default=20, min_value=1, max_value=MAX_SEARCH_PAGE),
+        offset=Field(int, required=False, default=0, min_value=0, max_value=MAX_SEARCH_OFFSET))
+async def search_messages(ctx, req):
+    terms = re.findall(r"\w+", req["query"])[:MAX_SEARCH_TERMS]
+    if not terms:
+        return {"status": "error", "message": "Search query has no words."}
+    if req["scope"] not in SEARCH_SCOPES:
+        return {"status": "error", "message": f"'scope' must be one of {', '.join(SEARCH_SCOPES)}."}
+    if req["scope"] == "direct" and req["group_name"]:
+        return {"status": "error", "message": "'group_name' cannot be combined with scope 'direct'."}
+
+    group_id = None
+    group_name = req["group_name"]
+    if group_name:
+        group_id = await storage.get_group_id(group_name)
+        if group_id is None:
+            return {"status": "error", "message": f"Group '{group_name}' not found."}
+        if not await storage.is_member(group_id, ctx.user_id):
+            return {"status": "error", "message": f"User '{ctx.username}' is not a member of this group."}
+
+    try:
+        hits, has_more = await storage.search_messages(ctx.user_id, terms, group_id, req["scope"],
+                                                       req["limit"], req["offset"])
+    except StorageError as err:
+        return {"status": "error", "message": f"Search failed: {err.msg}"}
+    hits_data = [
+        {"type": row[0], "id": row[1], "message": row[2], "timestamp": str(row[3]),
+         "sender": row[4], "group_name": row[5], "score": float(row[6])}
+        for row in hits
+    ]
+    return {
+        "status": "ok",
+        "hits": hits_data,
+        "has_more": has_more,
+        "next_offset": req["offset"] + len(hits_data) if has_more else None
+    }
+
+#Server
+
+@action("server_stats")
+async def server_stats(ctx, req):
+    return {"status": "ok", "actions": action_stats.snapshot()}
 
 async def handle_message(websocket, path):
     print("New client connected.")
+    connections_active.inc()
+    connections_total.inc()
+    ctx = ClientContext(websocket)
+    codec = codec_for(websocket.subprotocol)
+    outbox = Outbox(websocket, codec, on_overflow=record_overflow, **outbox_config)
+    outbox.start()
+    sessions.connect(websocket, outbox)
+    slots = asyncio.Semaphore(pipeline_config['max_in_flight'])
+    in_flight = set()
+
+    async def process(data, request_id):
+        request_ctx = ctx.request()
+        requests_in_flight.inc()
+        try:
+            response = await dispatcher.dispatch(request_ctx, data)
+        finally:
+            requests_in_flight.dec()
+        if request_id is not None:
+            response["request_id"] = request_id
+        frame = codec.encode(response)
+        frame_bytes.labels("out").observe(len(frame))
+        await outbox.send(frame)
+        for usernames, event in request_ctx.take_pushes():
+            sessions.push(usernames, event)
+            #Recipients may be connected to other workers too
+            bus.publish({"push": [usernames, event]})
+
+    async def process_pipelined(data, request_id):
+        try:
+            await process(data, request_id)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            slots.release()
+
     try:
         async for message in websocket:
+            frame_bytes.labels("in").observe(len(message))
             try:
-                data = json.loads(message)
-            except json.JSONDecodeError:
-                await websocket.send(json.dumps({"status": "error", "message": "Invalid JSON."}))
+                data = codec.decode(message)
+            except DecodeError:
+                await outbox.send(codec.encode({"status": "error", "message": f"Invalid {codec.name}."}))
+                continue
+            if not isinstance(data, dict):
+                await outbox.send(codec.encode({"status": "error", "message": f"Request must be a {codec.name} object."}))
+                continue
+            request_id = data.get("request_id")
+            if request_id is not None and (isinstance(request_id, bool) or not isinstance(request_id, (str, int))):
+                await outbox.send(codec.encode({"status": "error", "message": "'request_id' must be a string or integer."}))
                 continue
 
-            action = data.get("action")
-            
-            if action == "register":
-                username = data.get("username")
-                if not username:
-                    response = {"status": "error", "message": "Username not provided."}
-                else:
-                    try:
-                        cursor.execute("INSERT INTO users (username) VALUES (%s)", (username,))
-                        conn.commit()
-                        response = {"status": "ok", "message": f"User '{username}' registered successfully."}
-                    except mysql.connector.Error as err:
-                        response = {"status": "error", "message": f"Registration failed: {err.msg}"}
-                await websocket.send(json.dumps(response))
-
-            elif action == "send":
-                sender = data.get("sender")
-                receiver = data.get("receiver")
-                msg_text = data.get("message")
-                if not (sender and receiver and msg_text):
-                    response = {"status": "error", "message": "Missing sender, receiver, or message text."}
-                    await websocket.send(json.dumps(response))
-                    continue
-
-                cursor.execute("SELECT id FROM users WHERE username = %s", (sender,))
-                sender_row = cursor.fetchone()
-                cursor.execute("SELECT id FROM users WHERE username = %s", (receiver,))
-                receiver_row = cursor.fetchone()
-                if not sender_row:
-                    response = {"status": "error", "message": f"Sender '{sender}' not found."}
-                elif not receiver_row:
-                    response = {"status": "error", "message": f"Receiver '{receiver}' not found."}
-                else:
-                    sender_id = sender_row[0]
-                    receiver_id = receiver_row[0]
-                    cursor.execute("SELECT id FROM userChats WHERE sender_id = %s AND receiver_id = %s", 
-                                (sender_id, receiver_id))
-                    chat_row = cursor.fetchone()
-                    if chat_row:
-                        chat_id = chat_row[0]
-                    else:
-                        cursor.execute("INSERT INTO userChats (sender_id, receiver_id) VALUES (%s, %s)",
-                                    (sender_id, receiver_id))
-                        conn.commit()
-                        chat_id = cursor.lastrowid
-
-                    cursor.execute("INSERT INTO messages (chat_id, sender_id, message) VALUES (%s, %s, %s)",
-                                (chat_id, sender_id, msg_text))
-                    conn.commit()
-                    response = {"status": "ok", "message": "Message sent."}
-                await websocket.send(json.dumps(response))
-
-            elif action == "show":
-                username = data.get("username")
-                if not username:
-                    response = {"status": "error", "message": "Username not provided."}
-                else:
-                    cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
-                    user_row = cursor.fetchone()
-                    if not user_row:
-                        response = {"status": "error", "message": f"User '{username}' not found."}
-                    else:
-                        user_id = user_row[0]
-                        query = """
-                            SELECT m.id, m.message, m.timestamp, u.username AS sender
-                            FROM messages m
-                            JOIN userChats uc ON m.chat_id = uc.id
-                            JOIN users u ON m.sender_id = u.id
-                            WHERE uc.receiver_id = %s OR (uc.sender_id = %s AND m.sender_id != %s)
-                            ORDER BY m.timestamp ASC
-                        """
-                        cursor.execute(query, (user_id, user_id, user_id))
-                        messages_list = cursor.fetchall()
-                        messages_data = [
-                            {"id": row[0], "message": row[1], "timestamp": str(row[2]), "sender": row[3]} 
-                            for row in messages_list
-                        ]
-                        response = {"status": "ok", "messages": messages_data}
-                await websocket.send(json.dumps(response))
-            
-            elif action == "mark_read":
-                username = data.get("username")
-                message_id = data.get("message_id")
-                if not (username and message_id):
-                    response = {"status": "error", "message": "Missing username or message ID."}
-                else:
-                    cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
-                    user_row = cursor.fetchone()
-                    if not user_row:
-                        response = {"status": "error", "message": f"User '{username}' not found."}
-                    else:
-                        user_id = user_row[0]
-                        try:
-                            #Check if message sent to this user 
-                            cursor.execute("""
-                                SELECT m.sender_id FROM messages m
-                                JOIN userChats uc ON m.chat_id = uc.id
-                                WHERE m.id = %s AND uc.receiver_id = %s AND m.sender_id != %s
-                            """, (message_id, user_id, user_id))
-                            message_check = cursor.fetchone()
-                            
-                            if message_check:
-                                #Insert read receipt 
-                                cursor.execute("""
-                                    INSERT INTO read_receipts (message_id, reader_id)
-                                    VALUES (%s, %s)
-                                    ON DUPLICATE KEY UPDATE read_at = CURRENT_TIMESTAMP
-                                """, (message_id, user_id))
-                                conn.commit()
-                                response = {"status": "ok", "message": "Message marked as read."}
-                            else:
-                                response = {"status": "error", "message": "Cannot mark this message as read."}
-                        except mysql.connector.Error as err:
-                            response = {"status": "error", "message": f"Failed to mark as read: {err.msg}"}
-                await websocket.send(json.dumps(response))
-            
-            elif action == "read_status":
-                username = data.get("username")
-                if not username:
-                    response = {"status": "error", "message": "Username not provided."}
-                else:
-                    cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
-                    user_row = cursor.fetchone()
-                    if not user_row:
-                        response = {"status": "error", "message": f"User '{username}' not found."}
-                    else:
-                        user_id = user_row[0]
-                        query = """
-                            SELECT r.message_id, u.username AS reader, r.read_at
-                            FROM read_receipts r
-                            JOIN users u ON r.reader_id = u.id
-                            JOIN messages m ON r.message_id = m.id
-                            WHERE m.sender_id = %s
-                            ORDER BY r.read_at DESC
-                        """
-                        cursor.execute(query, (user_id,))
-                        read_list = cursor.fetchall()
-                        read_data = [
-                            {"message_id": row[0], "reader": row[1], "read_at": str(row[2])}
-                            for row in read_list
-                        ]
-                        response = {"status": "ok", "read_status": read_data}
-                await websocket.send(json.dumps(response))
-            
-            
-            elif action == "delete_message":
-                username = data.get("username")
-                message_id = data.get("message_id")
-                if not (username and message_id):
-                    response = {"status": "error", "message": "Missing username or message ID."}
-                else:
-                    cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
-                    user_row = cursor.fetchone()
-                    if not user_row:
-                        response = {"status": "error", "message": f"User '{username}' not found."}
-                    else:
-                        user_id = user_row[0]
-                        
-                        cursor.execute("SELECT sender_id FROM messages WHERE id = %s", (message_id,))
-                        message_row = cursor.fetchone()
-                        
-                        if not message_row:
-                            response = {"status": "error", "message": "Message not found."}
-                        elif message_row[0] != user_id:
-                            response = {"status": "error", "message": "You can only delete your own messages."}
-                        else:
-                            try:
-                                cursor.execute("DELETE FROM read_receipts WHERE message_id = %s", (message_id,))
-                                
-                                cursor.execute("DELETE FROM messages WHERE id = %s", (message_id,))
-                                
-                                conn.commit()
-                                
-                                if cursor.rowcount > 0:
-                                    response = {"status": "ok", "message": "Message deleted successfully."}
-                                else:
-                                    response = {"status": "error", "message": "Failed to delete message."}
-                            except mysql.connector.Error as err:
-                                response = {"status": "error", "message": f"Failed to delete message: {err.msg}"}
-                await websocket.send(json.dumps(response))
-            
-            elif action == "create_group":
-                group_name = data.get("group_name")
-                creator = data.get("creator")
-                if not (group_name and creator):
-                    response = {"status": "error", "message": "Missing group name or creator."}
-                else:
-                    cursor.execute("SELECT id FROM users WHERE username = %s", (creator,))
-                    creator_row = cursor.fetchone()
-                    if not creator_row:
-                        response = {"status": "error", "message": f"User '{creator}' not found."}
-                    else:
-                        creator_id = creator_row[0]
-                        try:
-                            cursor.execute("INSERT INTO groups (name, created_by) VALUES (%s, %s)", 
-                                        (group_name, creator_id))
-                            group_id = cursor.lastrowid
-
-                            cursor.execute("INSERT INTO group_members (group_id, user_id) VALUES (%s, %s)",
-                                        (group_id, creator_id))
-                            conn.commit()
-                            response = {"status": "ok", "message": f"Group '{group_name}' created successfully."}
-                        except mysql.connector.Error as err:
-                            response = {"status": "error", "message": f"Group creation failed: {err.msg}"}
-                await websocket.send(json.dumps(response))
-            
-            elif action == "add_member":
-                group_name = data.get("group_name")
-                username = data.get("username")
-                adder = data.get("adder") 
-                if not (group_name and username and adder):
-                    response = {"status": "error", "message": "Missing group name, username, or adder."}
-                else:
-                    cursor.execute("SELECT id FROM groups WHERE name = %s", (group_name,))
-                    group_row = cursor.fetchone()
-                    if not group_row:
-                        response = {"status": "error", "message": f"Group '{group_name}' not found."}
-                    else:
-                        group_id = group_row[0]
-                        
-                        cursor.execute("SELECT u.id FROM users u JOIN group_members gm ON u.id = gm.user_id WHERE u.username = %s AND gm.group_id = %s", 
-                                    (adder, group_id))
-                        adder_row = cursor.fetchone()
-                        if not adder_row:
-                            response = {"status": "error", "message": f"User '{adder}' is not a member of this group."}
-                        else:
-
-                            cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
-                            user_row = cursor.fetchone()
-                            if not user_row:
-                                response = {"status": "error", "message": f"User '{username}' not found."}
-                            else:
-                                user_id = user_row[0]
-                                try:
-                                    cursor.execute("INSERT INTO group_members (group_id, user_id) VALUES (%s, %s)",
-                                                (group_id, user_id))
-                                    conn.commit()
-                                    response = {"status": "ok", "message": f"User '{username}' added to group '{group_name}' successfully."}
-                                except mysql.connector.Error as err:
-                                    if err.errno == 1062:  
-                                        response = {"status": "error", "message": f"User '{username}' is already a member of this group."}
-                                    else:
-                                        response = {"status": "error", "message": f"Failed to add member: {err.msg}"}
-                await websocket.send(json.dumps(response))
-            
-            elif action == "list_groups":
-                username = data.get("username")
-                if not username:
-                    response = {"status": "error", "message": "Username not provided."}
-                else:
-                    cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
-                    user_row = cursor.fetchone()
-                    if not user_row:
-                        response = {"status": "error", "message": f"User '{username}' not found."}
-                    else:
-                        user_id = user_row[0]
-                        query = """
-                            SELECT g.id, g.name, g.created_at, COUNT(gm.user_id) as member_count
-                            FROM groups g
-                            JOIN group_members gm ON g.id = gm.group_id
-                            WHERE EXISTS (
-                                SELECT 1 FROM group_members 
-                                WHERE group_id = g.id AND user_id = %s
-                            )
-                            GROUP BY g.id
-                            ORDER BY g.created_at DESC
-                        """
-                        cursor.execute(query, (user_id,))
-                        groups_list = cursor.fetchall()
-                        groups_data = [
-                            {"id": row[0], "name": row[1], "created_at": str(row[2]), "member_count": row[3]} 
-                            for row in groups_list
-                        ]
-                        response = {"status": "ok", "groups": groups_data}
-                await websocket.send(json.dumps(response))
-            
-            elif action == "list_members":
-                group_name = data.get("group_name")
-                if not group_name:
-                    response = {"status": "error", "message": "Group name not provided."}
-                else:
-                    cursor.execute("SELECT id FROM groups WHERE name = %s", (group_name,))
-                    group_row = cursor.fetchone()
-                    if not group_row:
-                        response = {"status": "error", "message": f"Group '{group_name}' not found."}
-                    else:
-                        group_id = group_row[0]
-                        query = """
-                            SELECT u.username, gm.joined_at, 
-                            (SELECT username FROM users WHERE id = g.created_by) as created_by
-                            FROM group_members gm
-                            JOIN users u ON gm.user_id = u.id
-                            JOIN groups g ON gm.group_id = g.id
-                            WHERE gm.group_id = %s
-                            ORDER BY gm.joined_at ASC
-                        """
-                        cursor.execute(query, (group_id,))
-                        members_list = cursor.fetchall()
-                        members_data = [
-                            {"username": row[0], "joined_at": str(row[1]), "is_admin": (row[0] == row[2])} 
-                            for row in members_list
-                        ]
-                        response = {"status": "ok", "members": members_data}
-                await websocket.send(json.dumps(response))
-            
-            elif action == "send_group_message":
-                sender = data.get("sender")
-                group_name = data.get("group_name")
-                msg_text = data.get("message")
-                if not (sender and group_name and msg_text):
-                    response = {"status": "error", "message": "Missing sender, group name, or message text."}
-                else:
-                    cursor.execute("SELECT id FROM users WHERE username = %s", (sender,))
-                    sender_row = cursor.fetchone()
-                    cursor.execute("SELECT id FROM groups WHERE name = %s", (group_name,))
-                    group_row = cursor.fetchone()
-                    
-                    if not sender_row:
-                        response = {"status": "error", "message": f"Sender '{sender}' not found."}
-                    elif not group_row:
-                        response = {"status": "error", "message": f"Group '{group_name}' not found."}
-                    else:
-                        sender_id = sender_row[0]
-                        group_id = group_row[0]
-                        
-                        cursor.execute("SELECT 1 FROM group_members WHERE group_id = %s AND user_id = %s",
-                                    (group_id, sender_id))
-                        is_member = cursor.fetchone()
-                        if not is_member:
-                            response = {"status": "error", "message": f"User '{sender}' is not a member of this group."}
-                        else:
-                            cursor.execute("INSERT INTO group_messages (group_id, sender_id, message) VALUES (%s, %s, %s)",
-                                        (group_id, sender_id, msg_text))
-                            conn.commit()
-                            response = {"status": "ok", "message": "Group message sent."}
-                await websocket.send(json.dumps(response))
-            
-            elif action == "show_group_messages":
-                group_name = data.get("group_name")
-                username = data.get("username")
-                if not (group_name and username):
-                    response = {"status": "error", "message": "Missing group name or username."}
-                else:
-                    cursor.execute("SELECT id FROM groups WHERE name = %s", (group_name,))
-                    group_row = cursor.fetchone()
-                    cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
-                    user_row = cursor.fetchone()
-                    
-                    if not group_row:
-                        response = {"status": "error", "message": f"Group '{group_name}' not found."}
-                    elif not user_row:
-                        response = {"status": "error", "message": f"User '{username}' not found."}
-                    else:
-                        group_id = group_row[0]
-                        user_id = user_row[0]
-                        
-                        cursor.execute("SELECT 1 FROM group_members WHERE group_id = %s AND user_id = %s",
-                                    (group_id, user_id))
-                        is_member = cursor.fetchone()
-                        if not is_member:
-                            response = {"status": "error", "message": f"User '{username}' is not a member of this group."}
-                        else:
-                            query = """
-                                SELECT gm.id, gm.message, gm.timestamp, u.username AS sender
-                                FROM group_messages gm
-                                JOIN users u ON gm.sender_id = u.id
-                                WHERE gm.group_id = %s
-                                ORDER BY gm.timestamp ASC
-                            """
-                            cursor.execute(query, (group_id,))
-                            messages_list = cursor.fetchall()
-                            messages_data = [
-                                {"id": row[0], "sender": row[3], "message": row[1], "timestamp": str(row[2])} 
-                                for row in messages_list
-                            ]
-                            
-                            for msg in messages_list:
-                                if msg[3] != username:  
-                                    try:
-                                        cursor.execute("""
-                                            INSERT INTO group_read_receipts (message_id, reader_id)
-                                            VALUES (%s, %s)
-                                            ON DUPLICATE KEY UPDATE read_at = CURRENT_TIMESTAMP
-                                        """, (msg[0], user_id))
-                                    except mysql.connector.Error:
-                                        pass  
-                            conn.commit()
-                            
-                            response = {"status": "ok", "messages": messages_data}
-                await websocket.send(json.dumps(response))
-            
-            elif action == "delete_group_message":
-                username = data.get("username")
-                message_id = data.get("message_id")
-                if not (username and message_id):
-                    response = {"status": "error", "message": "Missing username or message ID."}
-                else:
-                    cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
-                    user_row = cursor.fetchone()
-                    if not user_row:
-                        response = {"status": "error", "message": f"User '{username}' not found."}
-                    else:
-                        user_id = user_row[0]
-                        
-                        cursor.execute("""
-                            SELECT gm.sender_id, gm.group_id, g.created_by 
-                            FROM group_messages gm
-                            JOIN groups g ON gm.group_id = g.id
-                            WHERE gm.id = %s
-                        """, (message_id,))
-                        message_row = cursor.fetchone()
-                        
-                        if not message_row:
-                            response = {"status": "error", "message": "Group message not found."}
-                        elif message_row[0] != user_id and message_row[2] != user_id:
-                            response = {"status": "error", "message": "You can only delete your own messages or messages in groups you created."}
-                        else:
-                            try:
-                                cursor.execute("DELETE FROM group_read_receipts WHERE message_id = %s", (message_id,))
-                                
-                                cursor.execute("DELETE FROM group_messages WHERE id = %s", (message_id,))
-                                
-                                conn.commit()
-                                
-                                if cursor.rowcount > 0:
-                                    response = {"status": "ok", "message": "Group message deleted successfully."}
-                                else:
-                                    response = {"status": "error", "message": "Failed to delete group message."}
-                            except mysql.connector.Error as err:
-                                response = {"status": "error", "message": f"Failed to delete group message: {err.msg}"}
-                await websocket.send(json.dumps(response))
-            
-            elif action == "leave_group":
-                username = data.get("username")
-                group_name = data.get("group_name")
-                if not (username and group_name):
-                    response = {"status": "error", "message": "Missing username or group name."}
-                else:
-                    cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
-                    user_row = cursor.fetchone()
-                    cursor.execute("SELECT id FROM groups WHERE name = %s", (group_name,))
-                    group_row = cursor.fetchone()
-                    
-                    if not user_row:
-                        response = {"status": "error", "message": f"User '{username}' not found."}
-                    elif not group_row:
-                        response = {"status": "error", "message": f"Group '{group_name}' not found."}
-                    else:
-                        user_id = user_row[0]
-                        group_id = group_row[0]
-                        
-                        cursor.execute("SELECT created_by FROM groups WHERE id = %s", (group_id,))
-                        creator_id = cursor.fetchone()[0]
-                        if creator_id == user_id:
-                            response = {"status": "error", "message": "Group creator cannot leave. You must delete the group instead."}
-                        else:
-                            cursor.execute("DELETE FROM group_members WHERE group_id = %s AND user_id = %s",
-                                        (group_id, user_id))
-                            conn.commit()
-                            if cursor.rowcount > 0:
-                                response = {"status": "ok", "message": f"Successfully left group '{group_name}'."}
-                            else:
-                                response = {"status": "error", "message": f"User '{username}' is not a member of this group."}
-                await websocket.send(json.dumps(response))
-                
-            elif action == "group_read_status":
-                message_id = data.get("message_id")
-                if not message_id:
-                    response = {"status": "error", "message": "Message ID not provided."}
-                else:
-                    query = """
-                        SELECT u.username, gr.read_at
-                        FROM group_read_receipts gr
-                        JOIN users u ON gr.reader_id = u.id
-                        WHERE gr.message_id = %s
-                        ORDER BY gr.read_at ASC
-                    """
-                    cursor.execute(query, (message_id,))
-                    readers = cursor.fetchall()
-                    readers_data = [
-                        {"username": row[0], "read_at": str(row[1])}
-                        for row in readers
-                    ]
-                    
-                    query = """
-                        SELECT u.username
-                        FROM group_members gm
-                        JOIN users u ON gm.user_id = u.id
-                        JOIN group_messages gms ON gms.group_id = gm.group_id
-                        WHERE gms.id = %s
-                        AND NOT EXISTS (
-                            SELECT 1 FROM group_read_receipts gr 
-                            WHERE gr.message_id = %s AND gr.reader_id = gm.user_id
-                        )
-                        AND gm.user_id != (SELECT sender_id FROM group_messages WHERE id = %s)
-                    """
-                    cursor.execute(query, (message_id, message_id, message_id))
-                    unread = cursor.fetchall()
-                    unread_data = [row[0] for row in unread]
-                    
-                    response = {
-                        "status": "ok", 
-                        "read_by": readers_data,
-                        "not_read_by": unread_data
-                    }
-                await websocket.send(json.dumps(response))
-            
+            if request_id is not None and dispatcher.can_overlap(data):
+                #Stop reading while the connection is at its limit
+                await slots.acquire()
+                task = asyncio.create_task(process_pipelined(data, request_id))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
             else:
-                response = {"status": "error", "message": "Unknown action."}
-                await websocket.send(json.dumps(response))
+                #Untagged requests keep the lockstep order, after anything still running
+                if in_flight:
+                    await asyncio.wait(in_flight)
+                await process(data, request_id)
     except websockets.exceptions.ConnectionClosed:
         print("Client disconnected.")
+    finally:
+        connections_active.dec()
+        outbox.close()
+        sessions.remove(websocket)
+
+#Workers
+
+async def on_bus_message(message):
+    if "push" in message:
+        usernames, event = message["push"]
+        sessions.push(usernames, event)
+    elif "members_changed" in message:
+        storage.forget_members(message["members_changed"])
+    elif "history_changed" in message:
+        storage.forget_history(message["history_changed"])
+    elif "archive_changed" in message:
+        storage.forget_archive()
+
+async def purge_tombstones():
+    """Remove deleted messages a small batch at a time, off the request path."""
+    while True:
+        try:
+            purged = await storage.purge_deleted(purge_config['batch_size'])
+        except StorageError as err:
+            print(f"Purging deleted messages failed: {err.msg}")
+            purged = 0
+        purged_messages.inc(purged)
+        if purged >= purge_config['batch_size']:
+            await asyncio.sleep(purge_config['interval'])
+        else:
+            await asyncio.sleep(purge_config['idle_interval'])
+
+async def archive_old_history():
+    """Move history past the configured age into the archive, a batch at a time."""
+    max_age = archive_config['max_age_days'] * 86400
+    while True:
+        try:
+            archived = await storage.archive_history(max_age, archive_config['batch_size'])
+        except StorageError as err:
+            print(f"Archiving old history failed: {err.msg}")
+            archived = 0
+        except OSError as err:
+            print(f"Archiving old history failed: {err}")
+            archived = 0
+        archived_messages.inc(archived)
+        if archived:
+            #The other workers read the new index lines on their next archive page
+            bus.publish({"archive_changed": True})
+        if archived >= archive_config['batch_size']:
+            await asyncio.sleep(archive_config['interval'])
+        else:
+            await asyncio.sleep(archive_config['idle_interval'])
+
+def configure(args):
+    write_batch_config['write_batch_size'] = args.write_batch_size
+    write_batch_config['write_batch_delay'] = args.write_batch_delay_ms / 1000
+    metrics_config['port'] = args.metrics_port
+    outbox_config['policy'] = args.slow_consumer
+    archive_config['path'] = args.archive_path
+    archive_config['max_age_days'] = args.archive_after_days
+    if args.no_compression:
+        compression_config['enabled'] = False
+
+def websocket_options():
+    options = {
+        "subprotocols": subprotocols(),
+        "max_size": inbound_config['max_frame_bytes'],
+        "max_queue": inbound_config['max_queue']
+    }
+    if compression_config['enabled']:
+        bits = compression_config['max_window_bits']
+        options["extensions"] = [ServerPerMessageDeflateFactory(
+            server_max_window_bits=bits,
+            client_max_window_bits=bits,
+            compress_settings={"memLevel": compression_config['mem_level']}
+        )]
+    else:
+        options["compression"] = None
+    return options
+
+def start(loop, args, worker=None, bus_address=None):
+    """Open storage, the bus, metrics and the websocket listener on ``loop``.
+
+    A worker (``worker`` is its index) shares the port with its siblings via
+    SO_REUSEPORT, so the kernel spreads connections across them.
+    """
+    global storage, bus
+    configure(args)
+    storage = build_storage(args.storage, args.db_path)
+    storage.add_timing_hook(record_db_timing)
+    storage.add_invalidation_hook(lambda group_id: bus.publish({"members_changed": group_id}))
+    storage.add_history_hook(lambda key: bus.publish({"history_changed": key}))
+    if worker is None:
+        loop.run_until_complete(storage.setup_database())
+    else:
+        bus = SocketEndpoint(*bus_address)
+    loop.run_until_complete(bus.start(on_bus_message))
+    #One process runs the background jobs; the others only write tombstones and read the archive
+    if worker in (None, 0):
+        loop.create_task(purge_tombstones())
+        if archive_config['max_age_days'] > 0:
+            loop.create_task(archive_old_history())
+
+    name = "Server" if worker is None else f"Worker {worker}"
+    if metrics_config['port']:
+        #Each worker scrapes separately, on consecutive ports
+        port = metrics_config['port'] + (worker or 0)
+        loop.run_until_complete(serve_metrics(metrics, metrics_config['host'], port))
+        print(f"{name} metrics on http://{metrics_config['host']}:{port}/metrics")
+
+    start_server = websockets.serve(handle_message, args.host, args.port, reuse_port=worker is not None,
+                                    **websocket_options())
+    server = loop.run_until_complete(start_server)
+    print(f"{name} started on ws://{args.host}:{args.port} ({args.storage} storage)")
+    return server
+
+async def shutdown(server):
+    """Stop accepting, let open handlers finish, then commit queued writes before the pool closes."""
+    server.close()
+    await server.wait_closed()
+    await storage.flush()
+    await bus.close()
+    storage.close()
+
+def serve(loop, args, worker=None, bus_address=None):
+    """Run a server until SIGTERM or Ctrl-C, then shut it down cleanly."""
+    server = start(loop, args, worker, bus_address)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(shutdown(server))
+
+def set_password(args):
+    """Give an account a new password from the command line (--set-password)."""
+    configure(args)
+    admin_storage = build_storage(args.storage, args.db_path)
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(admin_storage.setup_database())
+        user_id = loop.run_until_complete(admin_storage.get_user_id(args.set_password))
+        if user_id is None:
+            return f"User '{args.set_password}' not found."
+        password = getpass.getpass(f"New password for '{args.set_password}': ")
+        if not password or password != getpass.getpass("Repeat it: "):
+            return "Passwords are empty or do not match."
+        loop.run_until_complete(admin_storage.set_password_hash(user_id, hash_password(password)))
+        print(f"Password set for '{args.set_password}'.")
+    finally:
+        admin_storage.close()
+
+def run_worker(args, worker, bus_address):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    serve(loop, args, worker, bus_address)
+
+def run_supervisor(args):
+    """Migrate once, start the bus hub, then keep ``args.workers`` workers running."""
+    loop = asyncio.get_event_loop()
+    configure(args)
+    setup_storage = build_storage(args.storage, args.db_path)
+    loop.run_until_complete(setup_storage.setup_database())
+    setup_storage.close()
+
+    hub = BusHub()
+    bus_address = loop.run_until_complete(hub.start())
+    context = multiprocessing.get_context("spawn")
+
+    def spawn(worker):
+        process = context.Process(target=run_worker, args=(args, worker, bus_address), daemon=True)
+        process.start()
+        return process
+
+    async def supervise():
+        processes = [spawn(worker) for worker in range(args.workers)]
+        while True:
+            await asyncio.sleep(1.0)
+            for worker, process in enumerate(processes):
+                if not process.is_alive():
+                    print(f"Worker {worker} exited with code {process.exitcode}; restarting it.")
+                    processes[worker] = spawn(worker)
+
+    print(f"Supervisor running {args.workers} workers; bus on {bus_address[0]}:{bus_address[1]}")
+    supervisor = loop.create_task(supervise())
+    #A plain kill must not leave the workers serving the port on their own
+    loop.add_signal_handler(signal.SIGTERM, supervisor.cancel)
+    try:
+        loop.run_until_complete(supervisor)
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        for process in multiprocessing.active_children():
+            process.terminate()
+            process.join()
+        loop.run_until_complete(hub.close())
 
 if __name__ == "__main__":
-    setup_database()
-    
-    start_server = websockets.serve(handle_message, "localhost", 8765)
-    print("Server started on ws://localhost:8765")
-    
-    asyncio.get_event_loop().run_until_complete(start_server)
-    asyncio.get_event_loop().run_forever()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Peer-to-peer chat websocket server")
+    parser.add_argument("--storage", choices=["mysql", "sqlite"], default=storage_backend)
+    parser.add_argument("--db-path", help="SQLite database file, or :memory:")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the port (needs SO_REUSEPORT)")
+    parser.add_argument("--metrics-port", type=int, default=metrics_config['port'],
+                        help="Port for the /metrics endpoint (0 = off)")
+    parser.add_argument("--slow-consumer", choices=Outbox.POLICIES, default=outbox_config['policy'],
+                        help="What to do with pushes for a connection whose outbox is full")
+    parser.add_argument("--no-compression", action="store_true", help="Turn off permessage-deflate")
+    parser.add_argument("--write-batch-size", type=int, default=write_batch_config['write_batch_size'],
+                        help="Group-commit up to this many message inserts (0 = commit each one)")
+    parser.add_argument("--write-batch-delay-ms", type=float,
+                        default=write_batch_config['write_batch_delay'] * 1000,
+                        help="Longest a message waits for its batch to fill")
+    parser.add_argument("--archive-path", default=archive_config['path'],
+                        help="Directory of the cold history archive")
+    parser.add_argument("--archive-after-days", type=float, default=archive_config['max_age_days'],
+                        help="Archive messages older than this many days (0 = never)")
+    parser.add_argument("--set-password", metavar="USERNAME",
+                        help="Prompt for a new password for USERNAME, store it and exit")
+    args = parser.parse_args()
+
+    if args.set_password:
+        sys.exit(set_password(args))
+
+    if args.workers > 1:
+        if not hasattr(socket, "SO_REUSEPORT"):
+            parser.error("--workers needs SO_REUSEPORT, which this platform does not have.")
+        if args.storage == "sqlite" and args.db_path == ":memory:":
+            parser.error("Workers cannot share an in-memory database; use a file.")
+        run_supervisor(args)
+    else:
+        serve(asyncio.get_event_loop(), args)
@@ -0,0 +1,233 @@
+import asyncio
+from collections import deque
+
+import websockets.exceptions
+
+from codec import codec_for
+
+
+class ClientContext:
+    """Per-connection state. ``user_id``/``username`` are set once by login or register."""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.user_id = None
+        self.username = None
+
+    def request(self):
+        return RequestContext(self)
+
+
+class RequestContext:
+    """What a handler gets: its connection's login plus a push list of its own,
+    so requests running side by side on one connection keep their pushes apart."""
+
+    def __init__(self, client):
+        self.client = client
+        self._pushes = []
+
+    @property
+    def websocket(self):
+        return self.client.websocket
+
+    @property
+    def user_id(self):
+        return self.client.user_id
+
+    @user_id.setter
+    def user_id(self, value):
+        self.client.user_id = value
+
+    @property
+    def username(self):
+        return self.client.username
+
+    @username.setter
+    def username(self, value):
+        self.client.username = value
+
+    def defer_push(self, usernames, event):
+        """Queue an event to push once the reply to this request is sent."""
+        self._pushes.append((usernames, event))
+
+    def take_pushes(self):
+        pushes, self._pushes = self._pushes, []
+        return pushes
+
+
+class Outbox:
+    """Bounded queue of outgoing frames for one connection, drained by one writer task.
+
+    Replies wait for room, which in turn stops the connection's read loop, so
+    a client that does not read its replies only stalls itself. Pushes never
+    wait. When the queue is full, ``policy`` decides what happens to them:
+    "drop" discards the push; "coalesce" discards it but queues a single
+    ``{"event": "missed", "count": n}`` notice once there is room, so the
+    client knows to resync; "disconnect" closes the connection.
+    """
+
+    POLICIES = ("drop", "coalesce", "disconnect")
+
+    def __init__(self, websocket, codec, max_frames=256, max_bytes=1048576, policy="coalesce",
+                 on_overflow=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown slow consumer policy '{policy}'.")
+        self.websocket = websocket
+        self.codec = codec
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.on_overflow = on_overflow
+        self.queued_bytes = 0
+        self.closed = False
+        self._frames = deque()
+        self._missed = 0
+        self._ready = asyncio.Event()
+        self._room = asyncio.Event()
+        self._room.set()
+        self._task = None
+
+    def __len__(self):
+        return len(self._frames)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._write())
+
+    def _full(self):
+        #A single frame is always accepted, however large, so big replies still go out
+        return bool(self._frames) and (len(self._frames) >= self.max_frames or self.queued_bytes >= self.max_bytes)
+
+    def _append(self, frame):
+        self._frames.append(frame)
+        self.queued_bytes += len(frame)
+        self._ready.set()
+        if self._full():
+            self._room.clear()
+
+    async def send(self, frame):
+        """Queue a reply, waiting while the queue is full."""
+        while self._full() and not self.closed:
+            await self._room.wait()
+        if not self.closed:
+            self._append(frame)
+
+    def push(self, frame):
+        """Queue a pushed event without waiting; apply the policy if it does not fit."""
+        if self.closed:
+            return
+        if not self._full():
+            self._append(frame)
+            return
+        if self.on_overflow is not None:
+            self.on_overflow(self.policy)
+        if self.policy == "coalesce":
+            self._missed += 1
+        elif self.policy == "disconnect":
+            self.close()
+            asyncio.get_running_loop().create_task(self.websocket.close(code=1008, reason="Slow consumer."))
+
+    async def _write(self):
+        try:
+            while True:
+                while not self._frames:
+                    self._ready.clear()
+                    await self._ready.wait()
+                frame = self._frames.popleft()
+                self.queued_bytes -= len(frame)
+                if not self._full():
+                    self._room.set()
+                    if self._missed:
+                        self._append(self.codec.encode({"event": "missed", "count": self._missed}))
+                        self._missed = 0
+                await self.websocket.send(frame)
+        except websockets.exceptions.ConnectionClosed:
+            self.close()
+
+    def close(self):
+        self.closed = True
+        self._frames.clear()
+        self.queued_bytes = 0
+        #Wake replies still waiting for room; they are dropped
+        self._room.set()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+
+class SessionRegistry:
+    """Tracks which websockets are online for each user and pushes events to them.
+
+    Pushed frames carry an ``event`` key instead of ``status`` so clients can
+    tell them apart from responses to their own requests, and are encoded
+    with each socket's negotiated codec. They go through the socket's
+    :class:`Outbox`, so pushing never waits on a slow recipient.
+    """
+
+    def __init__(self):
+        self._by_user = {}
+        self._by_socket = {}
+        self._outboxes = {}
+        self.send_hooks = []
+
+    def add_send_hook(self, hook):
+        """Call ``hook(frame_bytes, recipients)`` for every pushed frame."""
+        self.send_hooks.append(hook)
+
+    def connection_count(self):
+        return len(self._outboxes)
+
+    def user_count(self):
+        return len(self._by_user)
+
+    def queued_frames(self):
+        return sum(len(outbox) for outbox in self._outboxes.values())
+
+    def write_buffer_bytes(self):
+        """Outbound bytes not yet taken by the kernel: queued frames plus transport buffers."""
+        total = 0
+        for websocket, outbox in self._outboxes.items():
+            total += outbox.queued_bytes
+            transport = getattr(websocket, "transport", None)
+            if transport is not None:
+                total += transport.get_write_buffer_size()
+        return total
+
+    def connect(self, websocket, outbox):
+        self._outboxes[websocket] = outbox
+
+    def add(self, username, websocket):
+        previous = self._by_socket.get(websocket)
+        if previous == username:
+            return
+        if previous is not None:
+            self._log_out(websocket)
+        self._by_user.setdefault(username, set()).add(websocket)
+        self._by_socket[websocket] = username
+
+    def remove(self, websocket):
+        self._outboxes.pop(websocket, None)
+        self._log_out(websocket)
+
+    def _log_out(self, websocket):
+        username = self._by_socket.pop(websocket, None)
+        if username is None:
+            return
+        sockets = self._by_user.get(username)
+        if sockets is not None:
+            sockets.discard(websocket)
+            if not sockets:
+                del self._by_user[username]
+
+    def push(self, usernames, event):
+        targets = [ws for u in usernames for ws in self._by_user.get(u, ()) if ws in self._outboxes]
+        if not targets:
+            return
+        #Encode once per wire format in use among the recipients
+        by_codec = {}
+        for ws in targets:
+            by_codec.setdefault(codec_for(ws.subprotocol), []).append(ws)
+        for codec, sockets in by_codec.items():
+            frame = codec.encode(event)
+            for hook in self.send_hooks:
+                hook(len(frame), len(sockets))
+            for ws in sockets:
+                self._outboxes[ws].push(frame)
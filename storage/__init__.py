@@ -0,0 +1,18 @@
+from storage.base import DuplicateError, Storage, StorageError
+
+
+def create_storage(backend, **options):
+    """Build the storage backend named in the server config.
+
+    Drivers are imported here so a deployment only needs the one it uses.
+    """
+    if backend == "mysql":
+        from storage.mysql_backend import MySQLStorage
+        return MySQLStorage(**options)
+    if backend == "sqlite":
+        from storage.sqlite_backend import SQLiteStorage
+        return SQLiteStorage(**options)
+    raise ValueError(f"Unknown storage backend '{backend}'.")
+
+
+__all__ = ["DuplicateError", "Storage", "StorageError", "create_storage"]
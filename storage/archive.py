@@ -0,0 +1,168 @@
+"""Cold history in compressed, append-only segment files.
+
+The archive job moves the oldest messages out of the database a batch at a
+time. A batch is appended to the current segment as one zlib-compressed
+JSON block per history stream (a user's received direct messages, or one
+group's messages), and each block gets a line in the segment's index file:
+
+    <stream> <first id> <last id> <rows> <offset> <length>
+
+Segments roll over once they reach ``segment_bytes``, so each covers one
+range of ids. A stream's blocks cover increasing ids, so a page of old
+history is found by bisecting its block list and reading only the blocks
+the page spans. Only the archive job writes; every process keeps the index
+in memory and reads the lines appended since it last looked only once it
+is told the job appended (``invalidate``).
+"""
+import bisect
+import json
+import os
+import threading
+import zlib
+
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+
+
+class HistoryArchive:
+    def __init__(self, path, segment_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        #stream -> [(first_id, last_id, rows, segment, offset, length)] in id order,
+        #and the last ids alone for bisecting
+        self._blocks = {}
+        self._last_ids = {}
+        #Highest archived id per kind of stream ("direct" or "group")
+        self._high = {}
+        #Index file name -> bytes of it already loaded
+        self._loaded = {}
+        #Set until the index files are read, and again when the job appends
+        self.stale = True
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def stream(key):
+        """Stream name of a history key: ("direct", receiver id) or ("group", group id)."""
+        return f"{key[0]}-{key[1]}"
+
+    def invalidate(self):
+        """Note that the archive job appended, so the next read loads the new index lines."""
+        self.stale = True
+
+    def refresh(self):
+        """Load the index lines appended since the last call, by this process or another."""
+        with self._lock:
+            #Cleared first, so an invalidation arriving while this reads is kept
+            self.stale = False
+            if not os.path.isdir(self.path):
+                return
+            for name in sorted(n for n in os.listdir(self.path) if n.endswith(INDEX_SUFFIX)):
+                index_path = os.path.join(self.path, name)
+                done = self._loaded.get(name, 0)
+                if os.path.getsize(index_path) <= done:
+                    continue
+                with open(index_path, "rb") as index:
+                    index.seek(done)
+                    data = index.read()
+                #A line still being written is picked up next time
+                end = data.rfind(b"\n") + 1
+                for line in data[:end].decode().splitlines():
+                    self._add(name[:-len(INDEX_SUFFIX)], line)
+                self._loaded[name] = done + end
+
+    def _add(self, segment, line):
+        stream, first_id, last_id, rows, offset, length = line.split()
+        block = (int(first_id), int(last_id), int(rows), segment, int(offset), int(length))
+        self._blocks.setdefault(stream, []).append(block)
+        self._last_ids.setdefault(stream, []).append(block[1])
+        kind = stream.split("-")[0]
+        self._high[kind] = max(self._high.get(kind, 0), block[1])
+
+    def high_id(self, kind):
+        """Every message of this kind with an id up to this one has left the database."""
+        if self.stale:
+            self.refresh()
+        return self._high.get(kind, 0)
+
+    def page(self, key, since_id=None, before_id=None, limit=50):
+        """A page of one stream's archived rows, paged like the database history queries.
+
+        Returns (rows oldest first, has_more). ``limit`` may be 0 to only ask
+        whether there is anything in range.
+        """
+        if self.stale:
+            self.refresh()
+        stream = self.stream(key)
+        blocks = self._blocks.get(stream, [])
+        rows = []
+        if since_id is not None:
+            start = bisect.bisect_right(self._last_ids.get(stream, []), since_id)
+            for block in blocks[start:]:
+                if before_id is not None and block[0] >= before_id:
+                    break
+                rows.extend(row for row in self._read(block)
+                            if row[0] > since_id and (before_id is None or row[0] < before_id))
+                if len(rows) > limit:
+                    break
+            return rows[:limit], len(rows) > limit
+
+        end = len(blocks)
+        if before_id is not None:
+            #Blocks wholly below before_id, plus the one it falls in
+            end = min(bisect.bisect_left(self._last_ids.get(stream, []), before_id) + 1, end)
+        for block in reversed(blocks[:end]):
+            rows[:0] = [row for row in self._read(block) if before_id is None or row[0] < before_id]
+            if len(rows) > limit:
+                break
+        has_more = len(rows) > limit
+        return rows[len(rows) - limit:] if has_more else rows, has_more
+
+    def _read(self, block):
+        _, _, _, segment, offset, length = block
+        with open(os.path.join(self.path, segment + SEGMENT_SUFFIX), "rb") as segment_file:
+            segment_file.seek(offset)
+            data = segment_file.read(length)
+        return [tuple(row) for row in json.loads(zlib.decompress(data))]
+
+    def append(self, streams):
+        """Archive {key: rows in id order} as one block per stream.
+
+        The blocks are synced before the index lines that point at them, and
+        both before the caller deletes the rows from the database, so a crash
+        at any point loses nothing; at worst some rows are in both places.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        segment = self._current_segment()
+        entries = []
+        with open(os.path.join(self.path, segment + SEGMENT_SUFFIX), "ab") as segment_file:
+            offset = segment_file.seek(0, os.SEEK_END)
+            for key, rows in streams.items():
+                data = zlib.compress(json.dumps(rows).encode())
+                segment_file.write(data)
+                entries.append(f"{self.stream(key)} {rows[0][0]} {rows[-1][0]} {len(rows)} {offset} {len(data)}\n")
+                offset += len(data)
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+
+        index_path = os.path.join(self.path, segment + INDEX_SUFFIX)
+        with open(index_path, "a+b") as index:
+            #Drop a line left half written by a crash, or the next one would be glued to it
+            size = index.seek(0, os.SEEK_END)
+            if size:
+                index.seek(size - 1)
+                if index.read(1) != b"\n":
+                    index.seek(0)
+                    index.truncate(index.read().rfind(b"\n") + 1)
+            index.write("".join(entries).encode())
+            index.flush()
+            os.fsync(index.fileno())
+        self.refresh()
+
+    def _current_segment(self):
+        segments = sorted(n[:-len(SEGMENT_SUFFIX)] for n in os.listdir(self.path) if n.endswith(SEGMENT_SUFFIX))
+        if not segments:
+            return "000001"
+        segment = segments[-1]
+        if os.path.getsize(os.path.join(self.path, segment + SEGMENT_SUFFIX)) >= self.segment_bytes:
+            segment = f"{int(segment) + 1:06d}"
+        return segment
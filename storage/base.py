@@ -0,0 +1,1243 @@
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import LRUCache, RecentMessages
+from pool import ConnectionPool, PoolTimeout
+from storage.archive import HistoryArchive
+from storage.batching import WriteBatcher
+from storage.migrations import migrate
+
+
+#Characters of the latest message kept in the inbox summary rows
+PREVIEW_LENGTH = 100
+
+#Readers of group message gm: members other than the sender whose watermark has
+#reached it, a range of idx_group_read_state_progress
+GROUP_READ_COUNT = """(SELECT COUNT(*) FROM group_read_state rs
+    WHERE rs.group_id = gm.group_id AND rs.last_read_id >= gm.id AND rs.user_id != gm.sender_id)"""
+
+
+class StorageError(Exception):
+    """A database error, independent of the backend that raised it."""
+
+    def __init__(self, msg):
+        super().__init__(msg)
+        self.msg = msg
+
+
+class DuplicateError(StorageError):
+    """An insert hit a unique key (username, group name, membership...)."""
+
+
+def page_clause(column, since_id, before_id):
+    """Keyset filter for an id-ordered page of history.
+
+    Returns extra ``AND`` conditions, their params and the scan direction:
+    forward from ``since_id`` when syncing, backward from ``before_id`` (or
+    from the newest row) otherwise.
+    """
+    clause, params = "", []
+    if since_id is not None:
+        clause += f" AND {column} > %s"
+        params.append(since_id)
+    if before_id is not None:
+        clause += f" AND {column} < %s"
+        params.append(before_id)
+    return clause, params, "ASC" if since_id is not None else "DESC"
+
+
+def trim_page(rows, limit, order):
+    """Split the ``limit + 1`` rows fetched for a page into (oldest-first rows, has_more)."""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == "DESC":
+        rows.reverse()
+    return rows, has_more
+
+
+def run_in_db_thread(method):
+    """Turn a blocking ``method(self, cursor, *args)`` into a coroutine.
+
+    The wrapped method runs on the storage executor inside its own
+    transaction, so the event loop never waits on the database.
+    """
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        return await self._run(method, *args, **kwargs)
+    return wrapper
+
+
+class Storage:
+    """Async facade over the chat database.
+
+    Every query the server needs lives here. Handlers await these methods
+    and only ever touch the socket themselves. The SQL is shared by all
+    backends and written with ``%s`` placeholders; a backend supplies the
+    driver (``connect``/``is_healthy``), its error types, its migrations and
+    the few statements whose syntax differs between dialects.
+    """
+
+    dialect = None
+    driver_errors = ()
+
+    #Inserts the (message_id, reader_id) {values} that are not there yet; rowcount
+    #is how many were
+    READ_RECEIPT_INSERT = None
+    #Adds to a direct conversation's unread count and moves its latest message forward only
+    INBOX_DIRECT_UPSERT = None
+    #Creates the conversation for (user_low, user_high) unless it already exists;
+    #rowcount is 1 only when this statement created it, and lastrowid is then its id
+    CONVERSATION_INSERT = None
+    #The time %s seconds ago, comparable with message timestamps
+    ARCHIVE_CUTOFF = None
+
+    def __init__(self, connect, is_healthy, min_size=1, max_size=10, acquire_timeout=5.0,
+                 health_check_interval=30.0, cache_size=10000, cache_ttl=300.0,
+                 recent_cache_bytes=16 * 1024 * 1024, recent_per_conversation=200,
+                 write_batch_size=0, write_batch_delay=0.005,
+                 archive_path=None, archive_segment_bytes=64 * 1024 * 1024):
+        self.pool = ConnectionPool(
+            connect,
+            is_healthy,
+            min_size=min_size,
+            max_size=max_size,
+            acquire_timeout=acquire_timeout,
+            health_check_interval=health_check_interval,
+        )
+        #One worker per pooled connection, so queries run concurrently up to max_size
+        self._executor = ThreadPoolExecutor(max_workers=max_size, thread_name_prefix="db")
+
+        #Identity caches: username -> id, group name -> id, group id -> creator id,
+        #group id -> {member id: username}
+        self._user_ids = LRUCache(cache_size, cache_ttl)
+        self._group_ids = LRUCache(cache_size, cache_ttl)
+        self._group_creators = LRUCache(cache_size, cache_ttl)
+        self._group_members = LRUCache(cache_size, cache_ttl)
+
+        #Newest history pages: ("direct", receiver id) for show, ("group", group id)
+        #for show_group_messages. Rows are in the shape the fetch methods return.
+        self._recent = RecentMessages(recent_cache_bytes, recent_per_conversation)
+        #group id -> {user id: the member's read watermark, as last seen by this process};
+        #dropped with the membership list, since joining resets the watermark
+        self._read_marks = LRUCache(cache_size, cache_ttl)
+        #History too old to keep in the database, read when a page runs past its oldest rows
+        self._archive = HistoryArchive(archive_path, archive_segment_bytes) if archive_path else None
+
+        #Message inserts are group-committed when write_batch_size > 0. Senders
+        #wait up to write_batch_delay seconds longer, but share one commit per batch.
+        self._timing_hooks = []
+        self._invalidation_hooks = []
+        self._history_hooks = []
+        self._write_batcher = None
+        if write_batch_size > 0:
+            self._write_batcher = WriteBatcher(self._insert_messages, write_batch_size, write_batch_delay)
+
+    def add_timing_hook(self, hook):
+        """Call ``hook(name, wait, query, commit)`` after every transaction.
+
+        ``name`` is the storage method, ``wait`` the time spent waiting for a
+        pooled connection, ``query`` the statements and ``commit`` the commit,
+        all in seconds. Hooks run on the database threads.
+        """
+        self._timing_hooks.append(hook)
+
+    def add_invalidation_hook(self, hook):
+        """Call ``hook(group_id)`` whenever this process changes a group's members.
+
+        Identities never change once written, so group membership is the only
+        cached data other workers have to be told about.
+        """
+        self._invalidation_hooks.append(hook)
+
+    def add_history_hook(self, hook):
+        """Call ``hook(key)`` whenever this process writes or deletes a message.
+
+        ``key`` names the cached history the message belongs to, as a list,
+        for :meth:`forget_history` in other workers.
+        """
+        self._history_hooks.append(hook)
+
+    def history_cache(self):
+        """The recent-message cache, for its hit counts and size."""
+        return self._recent
+
+    def write_queue_depth(self):
+        """Messages waiting for the write batcher to commit them."""
+        return self._write_batcher.depth() if self._write_batcher is not None else 0
+
+    def _cursor(self, conn):
+        return conn.cursor()
+
+    def _translate_error(self, err):
+        return StorageError(str(err))
+
+    def _text_match(self, table, alias):
+        """Full-text search on ``table`` (aliased ``alias``) as
+        (score expression, extra joins, match condition), each ``%s`` taking the query."""
+        raise NotImplementedError
+
+    def _search_query(self, terms):
+        return " ".join(terms)
+
+    def _first_insert_id(self, cursor, row_count):
+        """Id of the first row written by the last multi-row INSERT."""
+        raise NotImplementedError
+
+    def _transaction(self, method, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            with self.pool.connection() as conn:
+                acquired = time.perf_counter()
+                cursor = self._cursor(conn)
+                try:
+                    result = method(self, cursor, *args, **kwargs)
+                    executed = time.perf_counter()
+                    conn.commit()
+                    committed = time.perf_counter()
+                    for hook in self._timing_hooks:
+                        hook(method.__name__.lstrip("_"), acquired - started, executed - acquired, committed - executed)
+                    return result
+                except Exception as err:
+                    try:
+                        conn.rollback()
+                    except self.driver_errors:
+                        pass
+                    if isinstance(err, self.driver_errors):
+                        raise self._translate_error(err) from err
+                    raise
+                finally:
+                    cursor.close()
+        #Waiting for a connection, or opening one, fails before the method runs
+        except PoolTimeout as err:
+            raise StorageError(str(err)) from err
+        except self.driver_errors as err:
+            raise self._translate_error(err) from err
+
+    async def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(self._transaction, method, *args, **kwargs)
+        )
+
+    async def flush(self):
+        """Wait for queued message inserts to be committed."""
+        if self._write_batcher is not None:
+            await self._write_batcher.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.pool.close()
+
+    @run_in_db_thread
+    def setup_database(self, cursor):
+        migrate(cursor, self.dialect)
+
+    #Message writes
+
+    async def _write_message(self, item):
+        if self._write_batcher is not None:
+            return await self._write_batcher.submit(item)
+        return (await self._insert_messages([item]))[0]
+
+    @run_in_db_thread
+    def _insert_messages(self, cursor, items):
+        """Write ("direct", sender_id, receiver_id, text) and ("group", group_id,
+        sender_id, text) items in one transaction.
+
+        Returns (id, timestamp) per item, in order.
+        """
+        results = [None] * len(items)
+        direct = [i for i, item in enumerate(items) if item[0] == "direct"]
+        group = [i for i, item in enumerate(items) if item[0] == "group"]
+
+        if direct:
+            conversation_ids = {}
+            for i in direct:
+                pair = self._pair(items[i][1], items[i][2])
+                if pair not in conversation_ids:
+                    conversation_ids[pair] = self._conversation_id(cursor, *pair)
+            rows = [(conversation_ids[self._pair(items[i][1], items[i][2])], *items[i][1:]) for i in direct]
+            columns = ("conversation_id", "sender_id", "recipient_id", "message")
+            written = self._insert_rows(cursor, "messages", columns, rows)
+            for i, row in zip(direct, written):
+                results[i] = row
+            self._summarise_direct(cursor, [items[i] for i in direct], written)
+
+        if group:
+            rows = [items[i][1:] for i in group]
+            written = self._insert_rows(cursor, "group_messages", ("group_id", "sender_id", "message"), rows)
+            for i, row in zip(group, written):
+                results[i] = row
+            self._summarise_group(cursor, [items[i] for i in group], written)
+        return results
+
+    def _summarise_direct(self, cursor, items, written):
+        #Both sides of each conversation see the new message; only the receiver gains an unread one
+        updates = {}
+        for (_, sender_id, receiver_id, text), (message_id, timestamp) in zip(items, written):
+            latest = (message_id, sender_id, text[:PREVIEW_LENGTH], timestamp)
+            for user_id, peer_id in ((sender_id, receiver_id), (receiver_id, sender_id)):
+                unread = updates.get((user_id, peer_id), (0,))[0]
+                if user_id == receiver_id and user_id != sender_id:
+                    unread += 1
+                updates[(user_id, peer_id)] = (unread, *latest)
+        values = ", ".join(["(%s, %s, %s, %s, %s, %s, %s)"] * len(updates))
+        cursor.execute(self.INBOX_DIRECT_UPSERT.format(values=values),
+                       [p for key, update in updates.items() for p in (*key, *update)])
+
+    def _summarise_group(self, cursor, items, written):
+        sent = {}
+        latest = {}
+        for (_, group_id, sender_id, text), (message_id, timestamp) in zip(items, written):
+            sent[(group_id, sender_id)] = sent.get((group_id, sender_id), 0) + 1
+            latest[group_id] = (message_id, sender_id, text[:PREVIEW_LENGTH], timestamp)
+        #Every other member gains the messages through the group's count; only the
+        #sender's offset moves, so they do not see their own messages as unread
+        for (group_id, sender_id), count in sent.items():
+            cursor.execute("UPDATE group_summary SET message_count = message_count + %s WHERE group_id = %s",
+                           (count, group_id))
+            cursor.execute("""
+                UPDATE group_members SET unread_offset = unread_offset + %s
+                WHERE group_id = %s AND user_id = %s
+            """, (count, group_id, sender_id))
+        for group_id, (message_id, sender_id, preview, timestamp) in latest.items():
+            cursor.execute("""
+                UPDATE group_summary
+                SET last_message_id = %s, last_sender_id = %s, last_preview = %s, last_activity = %s
+                WHERE group_id = %s AND (last_message_id IS NULL OR last_message_id < %s)
+            """, (message_id, sender_id, preview, timestamp, group_id, message_id))
+
+    @staticmethod
+    def _pair(user_id, peer_id):
+        #A direct conversation is stored once per unordered pair of users
+        return min(user_id, peer_id), max(user_id, peer_id)
+
+    def _conversation_id(self, cursor, user_low, user_high):
+        cursor.execute("SELECT id FROM conversations WHERE user_low = %s AND user_high = %s",
+                       (user_low, user_high))
+        row = cursor.fetchone()
+        if row:
+            return row[0]
+        #A concurrent first message may create it between the SELECT and here
+        cursor.execute(self.CONVERSATION_INSERT, (user_low, user_high))
+        if cursor.rowcount != 1:
+            cursor.execute("SELECT id FROM conversations WHERE user_low = %s AND user_high = %s",
+                           (user_low, user_high))
+            return cursor.fetchone()[0]
+        conversation_id = cursor.lastrowid
+        for user_id in sorted({user_low, user_high}):
+            cursor.execute("INSERT INTO conversation_participants (conversation_id, user_id) VALUES (%s, %s)",
+                           (conversation_id, user_id))
+        return conversation_id
+
+    def _insert_rows(self, cursor, table, columns, rows):
+        """Multi-row INSERT into an auto-increment table; returns [(id, timestamp)].
+
+        The ids of one INSERT are consecutive on both backends, so they are read
+        back as a range from the first one.
+        """
+        values = ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(rows))
+        cursor.execute(f"INSERT INTO {table} ({', '.join(columns)}) VALUES {values}",
+                       [p for row in rows for p in row])
+        first_id = self._first_insert_id(cursor, len(rows))
+        cursor.execute(f"SELECT id, timestamp FROM {table} WHERE id BETWEEN %s AND %s ORDER BY id",
+                       (first_id, first_id + len(rows) - 1))
+        written = cursor.fetchall()
+        if len(written) != len(rows):
+            raise StorageError(f"Could not read back {len(rows)} new rows from {table}.")
+        return [tuple(row) for row in written]
+
+    #Users
+
+    async def register_user(self, username, password_hash):
+        user_id = await self._insert_user(username, password_hash)
+        self._user_ids.set(username, user_id)
+        return user_id
+
+    async def get_user_id(self, username):
+        return await self._user_ids.get_or_load(username, lambda: self._load_user_id(username))
+
+    @run_in_db_thread
+    def _insert_user(self, cursor, username, password_hash):
+        cursor.execute("INSERT INTO users (username, password_hash) VALUES (%s, %s)", (username, password_hash))
+        return cursor.lastrowid
+
+    @run_in_db_thread
+    def get_password_hash(self, cursor, user_id):
+        #Not cached: only login reads it
+        cursor.execute("SELECT password_hash FROM users WHERE id = %s", (user_id,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    @run_in_db_thread
+    def set_password_hash(self, cursor, user_id, password_hash):
+        """Replace a user's password hash; only the administrator command calls this."""
+        cursor.execute("UPDATE users SET password_hash = %s WHERE id = %s", (password_hash, user_id))
+        return cursor.rowcount == 1
+
+    @run_in_db_thread
+    def _load_user_id(self, cursor, username):
+        cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    #Direct messages
+
+    async def send_message(self, sender_id, receiver_id, msg_text, sender_name=None):
+        message_id, timestamp = await self._write_message(("direct", sender_id, receiver_id, msg_text))
+        row = None
+        if sender_name is not None:
+            row = (message_id, msg_text, timestamp, sender_name)
+        self._history_written(("direct", receiver_id), row)
+        return message_id, timestamp
+
+    async def fetch_messages(self, user_id, since_id=None, before_id=None, limit=50):
+        key = ("direct", user_id)
+        page = self._recent.page(key, since_id, before_id, limit)
+        if page is not None:
+            return page
+        token = self._recent.token()
+        messages_list, has_more = await self._history_page(
+            key, lambda *page: self._fetch_messages(user_id, *page), since_id, before_id, limit)
+        if since_id is None and before_id is None:
+            self._recent.fill(key, messages_list, not has_more, token)
+        return messages_list, has_more
+
+    def _history_written(self, key, row):
+        #Without the sender's name the row cannot be cached, so drop the stale buffer
+        if row is not None:
+            self._recent.append(key, row)
+        else:
+            self._recent.invalidate(key)
+        for hook in self._history_hooks:
+            hook(list(key))
+
+    def _history_deleted(self, key):
+        self._recent.invalidate(key)
+        for hook in self._history_hooks:
+            hook(list(key))
+
+    def forget_history(self, key):
+        """Drop cached history another worker has written to."""
+        self._recent.invalidate(tuple(key))
+
+    def forget_archive(self):
+        """Reload the archive index on the next read; another worker's archive job appended."""
+        if self._archive is not None:
+            self._archive.invalidate()
+
+    async def _history_page(self, key, fetch, since_id, before_id, limit):
+        """A page of history from ``fetch(since_id, before_id, limit)``, continued into the archive.
+
+        Archived ids are all below the ones left in the database, so a sync
+        forward reads the archive first and scrolling back reads it last.
+        """
+        if self._archive is None:
+            return await fetch(since_id, before_id, limit)
+        if since_id is None:
+            rows, has_more = await fetch(since_id, before_id, limit)
+            if has_more:
+                return rows, has_more
+            #Read after the database, so rows archived in between are already indexed
+            older, has_more = await self._in_archive(self._archive.page, key, None,
+                                                     rows[0][0] if rows else before_id, limit - len(rows))
+            return older + rows, has_more
+        while True:
+            high = await self._archive_high(key[0])
+            older = []
+            if since_id < high:
+                older, has_more = await self._in_archive(self._archive.page, key, since_id, before_id, limit)
+                if has_more:
+                    return older, has_more
+            rows, has_more = await fetch(older[-1][0] if older else since_id, before_id, limit - len(older))
+            #Rows archived between the two reads would be in neither; read the page again
+            if await self._archive_high(key[0]) == high:
+                return older + rows, has_more
+
+    async def _archive_high(self, kind):
+        #The index is only read from disk after the archive job appended
+        if self._archive.stale:
+            await self._in_archive(self._archive.refresh)
+        return self._archive.high_id(kind)
+
+    async def _in_archive(self, method, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(method, *args))
+
+    @run_in_db_thread
+    def _fetch_messages(self, cursor, user_id, since_id=None, before_id=None, limit=50):
+        clause, params, order = page_clause("m.id", since_id, before_id)
+        #Everything written to the user, including notes to self, walked in id order
+        #along idx_messages_recipient whichever conversation it is in
+        cursor.execute(f"""
+            SELECT m.id, m.message, m.timestamp, u.username AS sender
+            FROM messages m
+            JOIN users u ON m.sender_id = u.id
+            WHERE m.recipient_id = %s AND m.deleted_at IS NULL{clause}
+            ORDER BY m.id {order}
+            LIMIT %s
+        """, (user_id, *params, limit + 1))
+        return trim_page(cursor.fetchall(), limit, order)
+
+    @run_in_db_thread
+    def mark_read(self, cursor, user_id, message_id):
+        #Check if message sent to this user
+        cursor.execute("""
+            SELECT u.username, m.sender_id FROM messages m
+            JOIN conversation_participants p ON p.conversation_id = m.conversation_id AND p.user_id = %s
+            JOIN users u ON m.sender_id = u.id
+            WHERE m.id = %s AND m.sender_id != %s AND m.deleted_at IS NULL
+        """, (user_id, message_id, user_id))
+        sender_row = cursor.fetchone()
+        if not sender_row:
+            return None
+
+        _, read_at = self._insert_read_receipts(cursor, user_id, [(message_id, *sender_row)])
+        return sender_row[0], read_at
+
+    @run_in_db_thread
+    def mark_read_batch(self, cursor, user_id, message_ids):
+        placeholders = ", ".join(["%s"] * len(message_ids))
+        cursor.execute(f"""
+            SELECT m.id, u.username, m.sender_id FROM messages m
+            JOIN conversation_participants p ON p.conversation_id = m.conversation_id AND p.user_id = %s
+            JOIN users u ON m.sender_id = u.id
+            WHERE m.id IN ({placeholders}) AND m.sender_id != %s AND m.deleted_at IS NULL
+        """, (user_id, *message_ids, user_id))
+        return self._insert_read_receipts(cursor, user_id, cursor.fetchall())
+
+    @run_in_db_thread
+    def mark_read_up_to(self, cursor, user_id, sender_id, up_to_id):
+        #Only messages from this sender that the user has not read yet
+        cursor.execute("""
+            SELECT m.id, u.username, m.sender_id FROM conversations c
+            JOIN messages m ON m.conversation_id = c.id
+            JOIN users u ON m.sender_id = u.id
+            LEFT JOIN read_receipts r ON r.message_id = m.id AND r.reader_id = %s
+            WHERE c.user_low = %s AND c.user_high = %s AND m.sender_id = %s AND m.sender_id != %s
+            AND m.id <= %s AND r.id IS NULL AND m.deleted_at IS NULL
+        """, (user_id, *self._pair(user_id, sender_id), sender_id, user_id, up_to_id))
+        return self._insert_read_receipts(cursor, user_id, cursor.fetchall())
+
+    def _insert_read_receipts(self, cursor, user_id, rows):
+        """Record receipts for validated (message_id, sender, sender_id) rows.
+
+        Returns (message_id, sender) rows and the read_at time they were stamped with.
+        """
+        if not rows:
+            return [], None
+
+        #Only first reads take a message off the unread count. The unique key
+        #decides which reads are first, so concurrent marks cannot both count one.
+        by_sender = {}
+        for message_id, _, sender_id in rows:
+            by_sender.setdefault(sender_id, []).append(message_id)
+        inserted = 0
+        for sender_id, message_ids in by_sender.items():
+            values = ", ".join(["(%s, %s)"] * len(message_ids))
+            cursor.execute(self.READ_RECEIPT_INSERT.format(values=values),
+                           [p for message_id in message_ids for p in (message_id, user_id)])
+            if cursor.rowcount > 0:
+                self._take_unread(cursor, user_id, sender_id, cursor.rowcount)
+                inserted += cursor.rowcount
+
+        placeholders = ", ".join(["%s"] * len(rows))
+        message_ids = [row[0] for row in rows]
+        if inserted:
+            #Recounted rather than incremented; the receipts are only read once this
+            #transaction is writing, so the count includes every committed reader
+            cursor.execute(f"""
+                UPDATE messages SET read_count = (
+                    SELECT COUNT(*) FROM read_receipts r WHERE r.message_id = messages.id
+                )
+                WHERE id IN ({placeholders})
+            """, message_ids)
+        if inserted < len(rows):
+            #A repeat read refreshes read_at
+            cursor.execute(f"""
+                UPDATE read_receipts SET read_at = CURRENT_TIMESTAMP
+                WHERE reader_id = %s AND message_id IN ({placeholders})
+            """, (user_id, *message_ids))
+        cursor.execute("SELECT CURRENT_TIMESTAMP")
+        return [row[:2] for row in rows], cursor.fetchone()[0]
+
+    def _take_unread(self, cursor, user_id, peer_id, count):
+        cursor.execute("""
+            UPDATE inbox_direct
+            SET unread_count = CASE WHEN unread_count > %s THEN unread_count - %s ELSE 0 END
+            WHERE user_id = %s AND peer_id = %s
+        """, (count, count, user_id, peer_id))
+
+    @run_in_db_thread
+    def read_status(self, cursor, user_id, since_id=None, before_id=None, limit=100):
+        """A page of receipts on the user's messages, keyed by message id like history pages."""
+        clause, params, order = page_clause("m.id", since_id, before_id)
+        #Messages nobody has read are skipped on their counter, without probing receipts
+        cursor.execute(f"""
+            SELECT r.message_id, u.username AS reader, r.read_at
+            FROM messages m
+            JOIN read_receipts r ON r.message_id = m.id
+            JOIN users u ON r.reader_id = u.id
+            WHERE m.sender_id = %s AND m.read_count > 0 AND m.deleted_at IS NULL{clause}
+            ORDER BY m.id {order}, r.reader_id
+            LIMIT %s
+        """, (user_id, *params, limit + 1))
+        return trim_page(cursor.fetchall(), limit, order)
+
+    @run_in_db_thread
+    def read_counts(self, cursor, user_id, since_id=None, before_id=None, limit=100):
+        """A page of the user's messages as (id, read, unread) from the maintained counters."""
+        clause, params, order = page_clause("m.id", since_id, before_id)
+        cursor.execute(f"""
+            SELECT m.id, m.read_count,
+            (SELECT COUNT(*) FROM conversation_participants p
+             WHERE p.conversation_id = m.conversation_id AND p.user_id != m.sender_id)
+            FROM messages m
+            WHERE m.sender_id = %s AND m.deleted_at IS NULL{clause}
+            ORDER BY m.id {order}
+            LIMIT %s
+        """, (user_id, *params, limit + 1))
+        rows, has_more = trim_page(cursor.fetchall(), limit, order)
+        return [(message_id, read, max(recipients - read, 0)) for message_id, read, recipients in rows], has_more
+
+    @run_in_db_thread
+    def get_message_sender(self, cursor, message_id):
+        cursor.execute("SELECT sender_id FROM messages WHERE id = %s AND deleted_at IS NULL", (message_id,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    async def delete_message(self, message_id):
+        deleted, receiver_id = await self._delete_message(message_id)
+        if deleted:
+            self._history_deleted(("direct", receiver_id))
+        return deleted
+
+    @run_in_db_thread
+    def _delete_message(self, cursor, message_id):
+        """Tombstone a message; :meth:`purge_deleted` removes it and its receipts later."""
+        cursor.execute("""
+            SELECT m.sender_id, CASE WHEN c.user_low = m.sender_id THEN c.user_high ELSE c.user_low END,
+            m.conversation_id
+            FROM messages m
+            JOIN conversations c ON c.id = m.conversation_id
+            WHERE m.id = %s AND m.deleted_at IS NULL
+        """, (message_id,))
+        message_row = cursor.fetchone()
+        if not message_row:
+            return 0, None
+        cursor.execute("UPDATE messages SET deleted_at = CURRENT_TIMESTAMP WHERE id = %s AND deleted_at IS NULL",
+                       (message_id,))
+        #A concurrent delete may have got there first; only one of them adjusts the counters
+        deleted = cursor.rowcount
+        if not deleted:
+            return 0, None
+        sender_id, receiver_id, conversation_id = message_row
+        cursor.execute("SELECT 1 FROM read_receipts WHERE message_id = %s AND reader_id = %s",
+                       (message_id, receiver_id))
+        if cursor.fetchone() is None and receiver_id != sender_id:
+            self._take_unread(cursor, receiver_id, sender_id, 1)
+        self._refresh_direct_latest(cursor, conversation_id, sender_id, receiver_id, message_id)
+        return deleted, receiver_id
+
+    def _refresh_direct_latest(self, cursor, conversation_id, user_id, peer_id, deleted_id):
+        """Point both sides of a conversation whose latest message was deleted at the one before it."""
+        cursor.execute("""
+            SELECT id, sender_id, message, timestamp FROM messages
+            WHERE conversation_id = %s AND deleted_at IS NULL
+            ORDER BY id DESC
+            LIMIT 1
+        """, (conversation_id,))
+        latest = cursor.fetchone()
+        message_id, sender_id, text, timestamp = latest if latest else (None, None, None, None)
+        cursor.execute("""
+            UPDATE inbox_direct
+            SET last_message_id = %s, last_sender_id = %s, last_preview = %s,
+            last_activity = COALESCE(%s, last_activity)
+            WHERE ((user_id = %s AND peer_id = %s) OR (user_id = %s AND peer_id = %s)) AND last_message_id = %s
+        """, (message_id, sender_id, text[:PREVIEW_LENGTH] if text else None, timestamp,
+              user_id, peer_id, peer_id, user_id, deleted_id))
+
+    #Groups
+
+    async def get_group_id(self, group_name):
+        async def load():
+            group_row = await self._load_group(group_name)
+            if group_row is None:
+                return None
+            #The creator comes with the same row, so leave_group needs no second query
+            self._group_creators.set(group_row[0], group_row[1])
+            return group_row[0]
+        return await self._group_ids.get_or_load(group_name, load)
+
+    async def get_group_creator(self, group_id):
+        return await self._group_creators.get_or_load(group_id, lambda: self._load_group_creator(group_id))
+
+    async def create_group(self, group_name, creator_id):
+        group_id = await self._insert_group(group_name, creator_id)
+        self._group_ids.set(group_name, group_id)
+        self._group_creators.set(group_id, creator_id)
+        self._invalidate_members(group_id)
+        return group_id
+
+    async def is_member(self, group_id, user_id):
+        return user_id in await self._members(group_id)
+
+    async def group_member_names(self, group_id):
+        return list((await self._members(group_id)).values())
+
+    async def add_member(self, group_id, user_id):
+        try:
+            await self._insert_member(group_id, user_id)
+        finally:
+            self._invalidate_members(group_id)
+
+    async def remove_member(self, group_id, user_id):
+        try:
+            return await self._delete_member(group_id, user_id)
+        finally:
+            self._invalidate_members(group_id)
+
+    def _invalidate_members(self, group_id):
+        self._group_members.invalidate(group_id)
+        self._read_marks.invalidate(group_id)
+        for hook in self._invalidation_hooks:
+            hook(group_id)
+
+    def forget_members(self, group_id):
+        """Drop a membership list another worker has changed."""
+        self._group_members.invalidate(group_id)
+        self._read_marks.invalidate(group_id)
+
+    async def _members(self, group_id):
+        return await self._group_members.get_or_load(group_id, lambda: self._load_members(group_id))
+
+    @run_in_db_thread
+    def _load_group(self, cursor, group_name):
+        cursor.execute("SELECT id, created_by FROM groups WHERE name = %s", (group_name,))
+        return cursor.fetchone()
+
+    @run_in_db_thread
+    def _load_group_creator(self, cursor, group_id):
+        cursor.execute("SELECT created_by FROM groups WHERE id = %s", (group_id,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    @run_in_db_thread
+    def _load_members(self, cursor, group_id):
+        cursor.execute("""
+            SELECT u.id, u.username FROM group_members gm
+            JOIN users u ON gm.user_id = u.id
+            WHERE gm.group_id = %s
+        """, (group_id,))
+        return dict(cursor.fetchall())
+
+    @run_in_db_thread
+    def _insert_group(self, cursor, group_name, creator_id):
+        cursor.execute("INSERT INTO groups (name, created_by) VALUES (%s, %s)",
+                       (group_name, creator_id))
+        group_id = cursor.lastrowid
+        cursor.execute("INSERT INTO group_members (group_id, user_id) VALUES (%s, %s)",
+                       (group_id, creator_id))
+        cursor.execute("INSERT INTO group_read_state (group_id, user_id, last_read_id) VALUES (%s, %s, 0)",
+                       (group_id, creator_id))
+        cursor.execute("INSERT INTO group_summary (group_id, member_count) VALUES (%s, 1)", (group_id,))
+        return group_id
+
+    @run_in_db_thread
+    def _insert_member(self, cursor, group_id, user_id):
+        #A new member has read nothing yet, the same as group_read_status reports;
+        #only messages they wrote before leaving are not unread
+        cursor.execute("""
+            INSERT INTO group_members (group_id, user_id, unread_offset)
+            SELECT %s, %s, COUNT(*) FROM group_messages WHERE group_id = %s AND sender_id = %s
+        """, (group_id, user_id, group_id, user_id))
+        #Every member has a watermark row, so non-readers can be found through the index
+        cursor.execute("INSERT INTO group_read_state (group_id, user_id, last_read_id) VALUES (%s, %s, 0)",
+                       (group_id, user_id))
+        cursor.execute("UPDATE group_summary SET member_count = member_count + 1 WHERE group_id = %s",
+                       (group_id,))
+
+    @run_in_db_thread
+    def _delete_member(self, cursor, group_id, user_id):
+        cursor.execute("DELETE FROM group_members WHERE group_id = %s AND user_id = %s",
+                       (group_id, user_id))
+        removed = cursor.rowcount
+        if removed:
+            cursor.execute("UPDATE group_summary SET member_count = member_count - %s WHERE group_id = %s",
+                           (removed, group_id))
+            #Read counts come from the watermarks, so dropping this one takes back the reads
+            cursor.execute("DELETE FROM group_read_state WHERE group_id = %s AND user_id = %s",
+                           (group_id, user_id))
+        return removed
+
+    @run_in_db_thread
+    def list_groups(self, cursor, user_id):
+        #Driven from the caller's memberships so only their groups are read
+        cursor.execute("""
+            SELECT g.id, g.name, g.created_at, s.member_count
+            FROM group_members mine
+            JOIN groups g ON g.id = mine.group_id
+            JOIN group_summary s ON s.group_id = g.id
+            WHERE mine.user_id = %s
+            ORDER BY g.created_at DESC
+        """, (user_id,))
+        return cursor.fetchall()
+
+    @run_in_db_thread
+    def list_members(self, cursor, group_id):
+        cursor.execute("""
+            SELECT u.username, gm.joined_at,
+            (SELECT username FROM users WHERE id = g.created_by) as created_by
+            FROM group_members gm
+            JOIN users u ON gm.user_id = u.id
+            JOIN groups g ON gm.group_id = g.id
+            WHERE gm.group_id = %s
+            ORDER BY gm.joined_at ASC
+        """, (group_id,))
+        return cursor.fetchall()
+
+    #Group messages
+
+    async def send_group_message(self, group_id, sender_id, msg_text, sender_name=None):
+        message_id, timestamp = await self._write_message(("group", group_id, sender_id, msg_text))
+        row = None
+        if sender_name is not None:
+            row = (message_id, msg_text, timestamp, sender_name, sender_id)
+        self._history_written(("group", group_id), row)
+        return message_id, timestamp
+
+    async def fetch_group_messages(self, group_id, user_id, since_id=None, before_id=None, limit=50):
+        """Return a page of a group's history and whether it moved the reader's watermark."""
+        key = ("group", group_id)
+        #Only trusted while it is still the cached one; a membership change replaces it
+        marks = self._read_marks.get(group_id)
+        if marks is None:
+            marks = {}
+            self._read_marks.set(group_id, marks)
+        page = self._recent.page(key, since_id, before_id, limit)
+        if page is None:
+            token = self._recent.token()
+            moved = []
+
+            async def fetch(*page):
+                rows, more, advanced = await self._fetch_group_messages(group_id, user_id, *page)
+                moved.append(advanced)
+                return rows, more
+            messages_list, has_more = await self._history_page(key, fetch, since_id, before_id, limit)
+            advanced = any(moved)
+            if since_id is None and before_id is None:
+                self._recent.fill(key, messages_list, not has_more, token)
+        else:
+            messages_list, has_more = page
+            #Served from memory, so only touch the database when the watermark moves
+            advanced = False
+            if messages_list and messages_list[-1][0] > marks.get(user_id, 0):
+                advanced = await self._advance_group_read(group_id, user_id, messages_list[-1][0])
+        if messages_list and self._read_marks.get(group_id) is marks:
+            marks[user_id] = max(messages_list[-1][0], marks.get(user_id, 0))
+        return messages_list, has_more, advanced
+
+    @run_in_db_thread
+    def _fetch_group_messages(self, cursor, group_id, user_id, since_id=None, before_id=None, limit=50):
+        clause, params, order = page_clause("gm.id", since_id, before_id)
+        cursor.execute(f"""
+            SELECT gm.id, gm.message, gm.timestamp, u.username AS sender, gm.sender_id
+            FROM group_messages gm
+            JOIN users u ON gm.sender_id = u.id
+            WHERE gm.group_id = %s AND gm.deleted_at IS NULL{clause}
+            ORDER BY gm.id {order}
+            LIMIT %s
+        """, (group_id, *params, limit + 1))
+        messages_list, has_more = trim_page(cursor.fetchall(), limit, order)
+        advanced = False
+        if messages_list:
+            advanced = self._move_group_watermark(cursor, group_id, user_id, messages_list[-1][0])
+        return messages_list, has_more, advanced
+
+    @run_in_db_thread
+    def _advance_group_read(self, cursor, group_id, user_id, up_to_id):
+        return self._move_group_watermark(cursor, group_id, user_id, up_to_id)
+
+    def _move_group_watermark(self, cursor, group_id, user_id, up_to_id):
+        #Messages are not touched: read counts are derived from the watermarks.
+        #One watermark update per page, whatever its length; it only ever moves forward
+        cursor.execute("""
+            UPDATE group_read_state SET last_read_id = %s, updated_at = CURRENT_TIMESTAMP
+            WHERE group_id = %s AND user_id = %s AND last_read_id < %s
+        """, (up_to_id, group_id, user_id, up_to_id))
+        advanced = cursor.rowcount > 0
+        if advanced:
+            #Only what is left past the new watermark is still unread; tombstones
+            #count until purge_deleted takes them out
+            cursor.execute("""
+                UPDATE group_members SET unread_offset = (
+                    SELECT message_count FROM group_summary WHERE group_id = %s
+                ) - (
+                    SELECT COUNT(*) FROM group_messages
+                    WHERE group_id = %s AND id > %s AND sender_id != %s
+                )
+                WHERE group_id = %s AND user_id = %s
+            """, (group_id, group_id, up_to_id, user_id, group_id, user_id))
+        return advanced
+
+    @run_in_db_thread
+    def get_group_message(self, cursor, message_id):
+        cursor.execute("""
+            SELECT gm.sender_id, gm.group_id, g.created_by
+            FROM group_messages gm
+            JOIN groups g ON gm.group_id = g.id
+            WHERE gm.id = %s AND gm.deleted_at IS NULL
+        """, (message_id,))
+        return cursor.fetchone()
+
+    async def delete_group_message(self, message_id):
+        deleted, group_id = await self._delete_group_message(message_id)
+        if deleted:
+            self._history_deleted(("group", group_id))
+        return deleted
+
+    @run_in_db_thread
+    def _delete_group_message(self, cursor, message_id):
+        """Tombstone a group message; :meth:`purge_deleted` removes it later."""
+        cursor.execute("SELECT group_id FROM group_messages WHERE id = %s AND deleted_at IS NULL", (message_id,))
+        message_row = cursor.fetchone()
+        if not message_row:
+            return 0, None
+        cursor.execute("""
+            UPDATE group_messages SET deleted_at = CURRENT_TIMESTAMP WHERE id = %s AND deleted_at IS NULL
+        """, (message_id,))
+        deleted = cursor.rowcount
+        if deleted:
+            group_id = message_row[0]
+            #Unread counts keep the tombstone until purge_deleted takes it out, so
+            #deleting costs the same however large the group is
+            cursor.execute("""
+                SELECT id, sender_id, message, timestamp FROM group_messages
+                WHERE group_id = %s AND deleted_at IS NULL ORDER BY id DESC LIMIT 1
+            """, (group_id,))
+            latest = cursor.fetchone()
+            latest_id, latest_sender, text, timestamp = latest if latest else (None, None, None, None)
+            cursor.execute("""
+                UPDATE group_summary
+                SET last_message_id = %s, last_sender_id = %s, last_preview = %s,
+                last_activity = COALESCE(%s, last_activity)
+                WHERE group_id = %s AND last_message_id = %s
+            """, (latest_id, latest_sender, text[:PREVIEW_LENGTH] if text else None, timestamp,
+                  group_id, message_id))
+            return deleted, group_id
+        return deleted, None
+
+    @run_in_db_thread
+    def group_read_status(self, cursor, message_id, lists=("read", "unread"), limit=100,
+                          read_after=None, unread_after=None):
+        """Read counts of one group message and a page of each requested member list.
+
+        Returns None for an unknown message, else ((group_id, read, unread),
+        {"read": (rows, has_more), "unread": (rows, has_more)}). Rows are
+        (username, read_at, last_read_id, user_id); the last two make the
+        ``*_after`` cursor of the next page.
+        """
+        cursor.execute(f"""
+            SELECT gm.group_id, gm.sender_id, {GROUP_READ_COUNT}, s.member_count,
+            (SELECT COUNT(*) FROM group_members sm WHERE sm.group_id = gm.group_id AND sm.user_id = gm.sender_id)
+            FROM group_messages gm
+            JOIN group_summary s ON s.group_id = gm.group_id
+            WHERE gm.id = %s AND gm.deleted_at IS NULL
+        """, (message_id,))
+        message_row = cursor.fetchone()
+        if not message_row:
+            return None
+        group_id, sender_id, read, member_count, sender_is_member = message_row
+        counts = (group_id, read, max(member_count - sender_is_member - read, 0))
+
+        #A member has read the message once their watermark has reached it. Both
+        #lists walk idx_group_read_state_progress, so a page costs its own length.
+        pages = {}
+        for name, after, condition in (("read", read_after, "s.last_read_id >= %s"),
+                                       ("unread", unread_after, "s.last_read_id < %s")):
+            if name not in lists:
+                continue
+            after_clause, after_params = "", []
+            if after is not None:
+                after_clause = " AND (s.last_read_id > %s OR (s.last_read_id = %s AND s.user_id > %s))"
+                after_params = [after[0], after[0], after[1]]
+            cursor.execute(f"""
+                SELECT u.username, s.updated_at, s.last_read_id, s.user_id
+                FROM group_read_state s
+                JOIN users u ON s.user_id = u.id
+                WHERE s.group_id = %s AND {condition} AND s.user_id != %s{after_clause}
+                ORDER BY s.last_read_id, s.user_id
+                LIMIT %s
+            """, (group_id, message_id, sender_id, *after_params, limit + 1))
+            rows = cursor.fetchall()
+            pages[name] = (rows[:limit], len(rows) > limit)
+        return counts, pages
+
+    @run_in_db_thread
+    def group_read_counts(self, cursor, group_id, since_id=None, before_id=None, limit=100):
+        """A page of a group's messages as (id, sender, read, unread), counted from the watermarks."""
+        cursor.execute("SELECT member_count FROM group_summary WHERE group_id = %s", (group_id,))
+        row = cursor.fetchone()
+        member_count = row[0] if row else 0
+        clause, params, order = page_clause("gm.id", since_id, before_id)
+        cursor.execute(f"""
+            SELECT gm.id, u.username, {GROUP_READ_COUNT},
+            (SELECT COUNT(*) FROM group_members sm WHERE sm.group_id = gm.group_id AND sm.user_id = gm.sender_id)
+            FROM group_messages gm
+            JOIN users u ON gm.sender_id = u.id
+            WHERE gm.group_id = %s AND gm.deleted_at IS NULL{clause}
+            ORDER BY gm.id {order}
+            LIMIT %s
+        """, (group_id, *params, limit + 1))
+        rows, has_more = trim_page(cursor.fetchall(), limit, order)
+        return [(message_id, sender, read, max(member_count - sender_is_member - read, 0))
+                for message_id, sender, read, sender_is_member in rows], has_more
+
+    #Tombstones
+
+    @run_in_db_thread
+    def purge_deleted(self, cursor, batch_size=200):
+        """Remove up to ``batch_size`` tombstoned messages and their receipts, oldest deletions first.
+
+        Returns how many were removed; fewer than ``batch_size`` means none are left.
+        """
+        purged = 0
+        for table, receipts in (("messages", "read_receipts"), ("group_messages", "group_read_receipts")):
+            if purged >= batch_size:
+                break
+            cursor.execute(f"""
+                SELECT id FROM {table} WHERE deleted_at IS NOT NULL
+                ORDER BY deleted_at
+                LIMIT %s
+            """, (batch_size - purged,))
+            message_ids = [row[0] for row in cursor.fetchall()]
+            if not message_ids:
+                continue
+            if table == "group_messages":
+                self._uncount_group_tombstones(cursor, message_ids)
+            placeholders = ", ".join(["%s"] * len(message_ids))
+            cursor.execute(f"DELETE FROM {receipts} WHERE message_id IN ({placeholders})", message_ids)
+            cursor.execute(f"DELETE FROM {table} WHERE id IN ({placeholders})", message_ids)
+            purged += cursor.rowcount
+        return purged
+
+    def _uncount_group_tombstones(self, cursor, message_ids):
+        #The group count still includes each tombstone, and so do the offsets of
+        #the members who read it or wrote it
+        placeholders = ", ".join(["%s"] * len(message_ids))
+        cursor.execute(f"SELECT id, group_id, sender_id FROM group_messages WHERE id IN ({placeholders})",
+                       message_ids)
+        for message_id, group_id, sender_id in cursor.fetchall():
+            cursor.execute("UPDATE group_summary SET message_count = message_count - 1 WHERE group_id = %s",
+                           (group_id,))
+            cursor.execute("""
+                UPDATE group_members SET unread_offset = unread_offset - 1
+                WHERE group_id = %s AND (user_id = %s OR user_id IN (
+                    SELECT user_id FROM group_read_state WHERE group_id = %s AND last_read_id >= %s
+                ))
+            """, (group_id, sender_id, group_id, message_id))
+
+    #Archive
+
+    async def archive_history(self, max_age, batch_size=1000):
+        """Move up to ``batch_size`` of the oldest direct and of the oldest group
+        messages, if older than ``max_age`` seconds, into the archive.
+
+        Returns how many rows left the database. Tombstones in the range are
+        dropped rather than archived. Archived history is read-only: it is
+        still paged by show and show_group_messages, but no longer searched,
+        marked read, deleted or counted as unread.
+        """
+        if self._archive is None:
+            return 0
+        return (await self._archive_messages(max_age, batch_size)
+                + await self._archive_group_messages(max_age, batch_size))
+
+    def _archivable(self, rows, kind):
+        #The oldest rows up to the first one still too young. Rows already in the
+        #archive are the leftovers of a run whose DELETE did not commit.
+        high = self._archive.high_id(kind)
+        taken = []
+        for row in rows:
+            if row[0] > high and not row[-1]:
+                break
+            taken.append(row)
+        return taken, high
+
+    def _delete_archived(self, cursor, table, receipts, message_ids):
+        placeholders = ", ".join(["%s"] * len(message_ids))
+        cursor.execute(f"DELETE FROM {receipts} WHERE message_id IN ({placeholders})", message_ids)
+        cursor.execute(f"DELETE FROM {table} WHERE id IN ({placeholders})", message_ids)
+
+    @run_in_db_thread
+    def _archive_messages(self, cursor, max_age, batch_size):
+        cursor.execute(f"""
+            SELECT m.id, m.message, m.timestamp, u.username, m.sender_id,
+            CASE WHEN c.user_low = m.sender_id THEN c.user_high ELSE c.user_low END,
+            m.read_count, m.deleted_at IS NOT NULL, m.timestamp < {self.ARCHIVE_CUTOFF}
+            FROM messages m
+            JOIN conversations c ON c.id = m.conversation_id
+            JOIN users u ON m.sender_id = u.id
+            ORDER BY m.id
+            LIMIT %s
+        """, (max_age, batch_size))
+        rows, high = self._archivable(cursor.fetchall(), "direct")
+        if not rows:
+            return 0
+
+        #Streams are keyed like the history cache: show pages are the receiver's
+        streams = {}
+        unread = {}
+        for message_id, text, timestamp, sender, sender_id, receiver_id, read_count, deleted, _ in rows:
+            if deleted:
+                continue
+            if message_id > high:
+                streams.setdefault(("direct", receiver_id), []).append((message_id, text, str(timestamp), sender))
+            if not read_count and receiver_id != sender_id:
+                unread[(receiver_id, sender_id)] = unread.get((receiver_id, sender_id), 0) + 1
+        if streams:
+            self._archive.append(streams)
+        for (receiver_id, sender_id), count in unread.items():
+            self._take_unread(cursor, receiver_id, sender_id, count)
+        self._delete_archived(cursor, "messages", "read_receipts", [row[0] for row in rows])
+        return len(rows)
+
+    @run_in_db_thread
+    def _archive_group_messages(self, cursor, max_age, batch_size):
+        cursor.execute(f"""
+            SELECT gm.id, gm.message, gm.timestamp, u.username, gm.sender_id, gm.group_id,
+            gm.deleted_at IS NOT NULL, gm.timestamp < {self.ARCHIVE_CUTOFF}
+            FROM group_messages gm
+            JOIN users u ON gm.sender_id = u.id
+            ORDER BY gm.id
+            LIMIT %s
+        """, (max_age, batch_size))
+        rows, high = self._archivable(cursor.fetchall(), "group")
+        if not rows:
+            return 0
+
+        streams = {}
+        #Rows leaving each group, tombstones included, and the newest of them
+        removed = {}
+        for message_id, text, timestamp, sender, sender_id, group_id, deleted, _ in rows:
+            removed[group_id] = (removed.get(group_id, (0,))[0] + 1, message_id)
+            if deleted:
+                continue
+            if message_id > high:
+                streams.setdefault(("group", group_id), []).append(
+                    (message_id, text, str(timestamp), sender, sender_id))
+        if streams:
+            self._archive.append(streams)
+        self._delete_archived(cursor, "group_messages", "group_read_receipts", [row[0] for row in rows])
+        for group_id, (count, message_id) in removed.items():
+            cursor.execute("UPDATE group_summary SET message_count = message_count - %s WHERE group_id = %s",
+                           (count, group_id))
+            #Members who had read past all of them counted every one in their offset
+            cursor.execute("""
+                UPDATE group_members SET unread_offset = unread_offset - %s
+                WHERE group_id = %s AND user_id IN (
+                    SELECT user_id FROM group_read_state WHERE group_id = %s AND last_read_id >= %s
+                )
+            """, (count, group_id, group_id, message_id))
+            #The rest counted only the ones they had read or written
+            cursor.execute("""
+                UPDATE group_members SET unread_offset = (
+                    SELECT message_count FROM group_summary s WHERE s.group_id = group_members.group_id
+                ) - (
+                    SELECT COUNT(*) FROM group_messages gm
+                    WHERE gm.group_id = group_members.group_id AND gm.sender_id != group_members.user_id
+                    AND gm.id > (
+                        SELECT last_read_id FROM group_read_state s
+                        WHERE s.group_id = group_members.group_id AND s.user_id = group_members.user_id
+                    )
+                )
+                WHERE group_id = %s AND user_id IN (
+                    SELECT user_id FROM group_read_state WHERE group_id = %s AND last_read_id < %s
+                )
+            """, (group_id, group_id, message_id))
+        return len(rows)
+
+    #Inbox
+
+    @run_in_db_thread
+    def inbox_summary(self, cursor, user_id):
+        """Read the caller's maintained summary rows; no message history is scanned.
+
+        Returns direct rows (peer, unread, last_id, last_sender, preview,
+        last_activity) and group rows (name, unread, last_id, last_sender,
+        preview, last_activity, member_count), most recently active first.
+        """
+        cursor.execute("""
+            SELECT peer.username, i.unread_count, i.last_message_id, su.username, i.last_preview, i.last_activity
+            FROM inbox_direct i
+            JOIN users peer ON peer.id = i.peer_id
+            LEFT JOIN users su ON su.id = i.last_sender_id
+            WHERE i.user_id = %s
+            ORDER BY i.last_activity DESC
+        """, (user_id,))
+        direct = cursor.fetchall()
+        cursor.execute("""
+            SELECT g.name,
+            CASE WHEN s.message_count > mine.unread_offset THEN s.message_count - mine.unread_offset ELSE 0 END,
+            s.last_message_id, su.username, s.last_preview,
+            s.last_activity, s.member_count
+            FROM group_members mine
+            JOIN groups g ON g.id = mine.group_id
+            JOIN group_summary s ON s.group_id = mine.group_id
+            LEFT JOIN users su ON su.id = s.last_sender_id
+            WHERE mine.user_id = %s
+            ORDER BY s.last_activity DESC
+        """, (user_id,))
+        return direct, cursor.fetchall()
+
+    #Search
+
+    @run_in_db_thread
+    def search_messages(self, cursor, user_id, terms, group_id=None, scope="all", limit=20, offset=0):
+        """Rank the caller's direct and group messages by relevance to ``terms``.
+
+        Direct messages are those in chats the user sends or receives in;
+        group messages those in groups they belong to (only ``group_id`` if
+        given). Returns ([(kind, id, message, timestamp, sender, group_name,
+        score)], has_more).
+        """
+        query = self._search_query(terms)
+        parts, params = [], []
+        if scope in ("all", "direct") and group_id is None:
+            score, join, match = self._text_match("messages", "m")
+            parts.append(f"""
+                SELECT 'direct' AS kind, m.id, m.message, m.timestamp, u.username AS sender,
+                NULL AS group_name, {score} AS score
+                FROM messages m {join}
+                JOIN conversation_participants mine ON mine.conversation_id = m.conversation_id AND mine.user_id = %s
+                JOIN users u ON m.sender_id = u.id
+                WHERE {match} AND m.deleted_at IS NULL
+            """)
+            params += [query] * score.count("%s") + [user_id] + [query] * match.count("%s")
+        if scope in ("all", "group"):
+            score, join, match = self._text_match("group_messages", "gm")
+            group_clause = " AND gm.group_id = %s" if group_id is not None else ""
+            parts.append(f"""
+                SELECT 'group' AS kind, gm.id, gm.message, gm.timestamp, u.username AS sender,
+                g.name AS group_name, {score} AS score
+                FROM group_messages gm {join}
+                JOIN group_members mine ON mine.group_id = gm.group_id AND mine.user_id = %s
+                JOIN groups g ON g.id = gm.group_id
+                JOIN users u ON gm.sender_id = u.id
+                WHERE {match} AND gm.deleted_at IS NULL{group_clause}
+            """)
+            params += [query] * score.count("%s") + [user_id] + [query] * match.count("%s")
+            if group_id is not None:
+                params.append(group_id)
+        if not parts:
+            return [], False
+
+        cursor.execute(f"""
+            SELECT * FROM ({" UNION ALL ".join(parts)}) hits
+            ORDER BY score DESC, id DESC
+            LIMIT %s OFFSET %s
+        """, (*params, limit + 1, offset))
+        rows = cursor.fetchall()
+        return rows[:limit], len(rows) > limit
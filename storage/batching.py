@@ -0,0 +1,101 @@
+import asyncio
+
+#Queued by close() to make the background task exit after its last batch
+_STOP = object()
+
+
+class WriteBatcher:
+    """Group commit for message inserts.
+
+    ``submit`` queues an item and waits for it to be written. A single
+    background task collects items until ``max_batch`` are queued or
+    ``max_delay`` seconds have passed since the first one, then hands the
+    whole batch to ``flush``, which writes it in one transaction and returns
+    one result per item. Callers are only resumed once their batch has been
+    committed. While a batch is being written new items keep queueing, so
+    the next batch fills up on its own under load.
+    """
+
+    def __init__(self, flush, max_batch=100, max_delay=0.005):
+        self._flush = flush
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = None
+        self._task = None
+        self._stopping = False
+
+    def depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+        future = loop.create_future()
+        self._queue.put_nowait((item, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        deadline = None
+        while len(batch) < self.max_batch:
+            if not self._queue.empty() or deadline is None:
+                entry = await self._queue.get()
+            else:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if entry is _STOP:
+                self._stopping = True
+                break
+            batch.append(entry)
+            if deadline is None:
+                deadline = loop.time() + self.max_delay
+        return batch
+
+    async def _run(self):
+        while not self._stopping:
+            batch = await self._collect()
+            if not batch:
+                continue
+            try:
+                results = await self._flush([item for item, _ in batch])
+            except Exception as err:
+                if len(batch) == 1:
+                    _settle(batch[0][1], exception=err)
+                    continue
+                #One bad row must not fail everyone else's messages, so retry them one by one
+                for item, future in batch:
+                    try:
+                        _settle(future, result=(await self._flush([item]))[0])
+                    except Exception as item_err:
+                        _settle(future, exception=item_err)
+                continue
+            for (_, future), result in zip(batch, results):
+                _settle(future, result=result)
+
+    async def close(self):
+        """Write out everything queued so far, then stop the background task."""
+        if self._task is None or self._task.done():
+            return
+        self._queue.put_nowait(_STOP)
+        await self._task
+        self._task = None
+        self._stopping = False
+
+
+def _settle(future, result=None, exception=None):
+    #The sender may have disconnected and cancelled its wait; the row is written either way
+    if future.done():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
@@ -0,0 +1,829 @@
+"""Versioned schema migrations for the chat database.
+
+Each migration is applied once and recorded in ``schema_migrations``. Every
+backend has its own list with the same version numbers. MySQL commits DDL
+implicitly, so every step is written to be safe to re-run if a previous
+attempt stopped half way. SQLite migrations run with foreign key enforcement
+off, so a table can be rebuilt in place, and the keys are checked before
+each one commits.
+"""
+
+
+def index_exists(cursor, table, index_name):
+    cursor.execute("""
+        SELECT 1 FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        LIMIT 1
+    """, (table, index_name))
+    return cursor.fetchone() is not None
+
+
+def column_exists(cursor, table, column):
+    cursor.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        LIMIT 1
+    """, (table, column))
+    return cursor.fetchone() is not None
+
+
+def foreign_key_name(cursor, table, column):
+    cursor.execute("""
+        SELECT constraint_name FROM information_schema.key_column_usage
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        AND referenced_table_name IS NOT NULL
+        LIMIT 1
+    """, (table, column))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def add_index(cursor, table, index_name, columns):
+    if not index_exists(cursor, table, index_name):
+        cursor.execute(f"CREATE INDEX {index_name} ON {table} ({columns})")
+
+
+def create_base_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            username VARCHAR(100) NOT NULL UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS userChats (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            sender_id INT NOT NULL,
+            receiver_id INT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sender_id) REFERENCES users(id),
+            FOREIGN KEY (receiver_id) REFERENCES users(id)
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            chat_id INT NOT NULL,
+            sender_id INT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (chat_id) REFERENCES userChats(id),
+            FOREIGN KEY (sender_id) REFERENCES users(id)
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS groups (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(100) NOT NULL UNIQUE,
+            created_by INT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (created_by) REFERENCES users(id)
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS group_members (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            group_id INT NOT NULL,
+            user_id INT NOT NULL,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (group_id) REFERENCES groups(id),
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            UNIQUE KEY unique_member (group_id, user_id)
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS group_messages (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            group_id INT NOT NULL,
+            sender_id INT NOT NULL,
+            message TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (group_id) REFERENCES groups(id),
+            FOREIGN KEY (sender_id) REFERENCES users(id)
+        )
+    """)
+
+    #Normal read_receipts
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS read_receipts (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            message_id INT NOT NULL,
+            reader_id INT NOT NULL,
+            read_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (message_id) REFERENCES messages(id),
+            FOREIGN KEY (reader_id) REFERENCES users(id),
+            UNIQUE KEY unique_read (message_id, reader_id)
+        )
+    """)
+
+    #group_read_receipts
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS group_read_receipts (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            message_id INT NOT NULL,
+            reader_id INT NOT NULL,
+            read_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (message_id) REFERENCES group_messages(id),
+            FOREIGN KEY (reader_id) REFERENCES users(id),
+            UNIQUE KEY unique_group_read (message_id, reader_id)
+        )
+    """)
+
+
+def create_group_read_state(cursor):
+    #Per-member group read watermark: everything up to last_read_id has been read
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS group_read_state (
+            group_id INT NOT NULL,
+            user_id INT NOT NULL,
+            last_read_id INT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (group_id, user_id),
+            KEY idx_group_read_state_last (group_id, last_read_id),
+            FOREIGN KEY (group_id) REFERENCES groups(id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    """)
+
+    #Carry over receipts written before the watermark existed
+    cursor.execute("""
+        INSERT IGNORE INTO group_read_state (group_id, user_id, last_read_id, updated_at)
+        SELECT gm.group_id, gr.reader_id, MAX(gr.message_id), MAX(gr.read_at)
+        FROM group_read_receipts gr
+        JOIN group_messages gm ON gr.message_id = gm.id
+        GROUP BY gm.group_id, gr.reader_id
+    """)
+
+
+def add_hot_path_indexes(cursor):
+    #send: find the chat for a (sender, receiver) pair; show: chats where the user receives
+    add_index(cursor, "userChats", "idx_userchats_pair", "sender_id, receiver_id")
+    add_index(cursor, "userChats", "idx_userchats_receiver", "receiver_id")
+    #show / fetch pages: a chat's messages in id order
+    add_index(cursor, "messages", "idx_messages_chat", "chat_id, id")
+    #read_status and ownership checks: messages written by a user
+    add_index(cursor, "messages", "idx_messages_sender", "sender_id")
+    #show_group_messages pages: a group's messages in id order
+    add_index(cursor, "group_messages", "idx_group_messages_group", "group_id, id")
+    #read receipts written by a reader
+    add_index(cursor, "read_receipts", "idx_read_receipts_reader", "reader_id")
+    #list_groups: groups a user belongs to
+    add_index(cursor, "group_members", "idx_group_members_user", "user_id, group_id")
+
+
+def add_search_indexes(cursor):
+    #search_messages: InnoDB FULLTEXT indexes on the message text
+    for table, index_name in [("messages", "ft_messages_message"),
+                              ("group_messages", "ft_group_messages_message")]:
+        if not index_exists(cursor, table, index_name):
+            cursor.execute(f"ALTER TABLE {table} ADD FULLTEXT INDEX {index_name} (message)")
+
+
+def create_inbox_summaries(cursor):
+    #One row per (user, peer) direct conversation, updated on send, read and delete
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS inbox_direct (
+            user_id INT NOT NULL,
+            peer_id INT NOT NULL,
+            unread_count INT NOT NULL DEFAULT 0,
+            last_message_id INT NULL,
+            last_sender_id INT NULL,
+            last_preview VARCHAR(100) NULL,
+            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, peer_id),
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (peer_id) REFERENCES users(id)
+        )
+    """)
+
+    #One row per group: its latest message and member count
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS group_summary (
+            group_id INT PRIMARY KEY,
+            member_count INT NOT NULL DEFAULT 0,
+            last_message_id INT NULL,
+            last_sender_id INT NULL,
+            last_preview VARCHAR(100) NULL,
+            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (group_id) REFERENCES groups(id)
+        )
+    """)
+
+    #Each member's unread count lives on their membership row
+    if not column_exists(cursor, "group_members", "unread_count"):
+        cursor.execute("ALTER TABLE group_members ADD COLUMN unread_count INT NOT NULL DEFAULT 0")
+
+    backfill_inbox_summaries(cursor)
+
+
+def backfill_inbox_summaries(cursor):
+    """Build the summary rows from the history written before they existed."""
+    cursor.execute("DELETE FROM inbox_direct")
+    #Both sides of every conversation, with its newest message
+    cursor.execute("""
+        INSERT INTO inbox_direct (user_id, peer_id, last_message_id)
+        SELECT pair.user_id, pair.peer_id, MAX(m.id)
+        FROM (
+            SELECT id, sender_id AS user_id, receiver_id AS peer_id FROM userChats
+            UNION ALL
+            SELECT id, receiver_id AS user_id, sender_id AS peer_id FROM userChats
+        ) pair
+        JOIN messages m ON m.chat_id = pair.id
+        GROUP BY pair.user_id, pair.peer_id
+    """)
+    cursor.execute("""
+        UPDATE inbox_direct SET
+            last_sender_id = (SELECT sender_id FROM messages WHERE id = inbox_direct.last_message_id),
+            last_preview = (SELECT SUBSTR(message, 1, 100) FROM messages WHERE id = inbox_direct.last_message_id),
+            last_activity = (SELECT timestamp FROM messages WHERE id = inbox_direct.last_message_id),
+            unread_count = (
+                SELECT COUNT(*) FROM messages m
+                JOIN userChats uc ON m.chat_id = uc.id
+                WHERE uc.sender_id = inbox_direct.peer_id AND uc.receiver_id = inbox_direct.user_id
+                AND m.sender_id != inbox_direct.user_id
+                AND NOT EXISTS (
+                    SELECT 1 FROM read_receipts r
+                    WHERE r.message_id = m.id AND r.reader_id = inbox_direct.user_id
+                )
+            )
+    """)
+
+    cursor.execute("DELETE FROM group_summary")
+    cursor.execute("""
+        INSERT INTO group_summary (group_id, member_count, last_message_id, last_activity)
+        SELECT g.id,
+        (SELECT COUNT(*) FROM group_members gm WHERE gm.group_id = g.id),
+        (SELECT MAX(id) FROM group_messages msg WHERE msg.group_id = g.id),
+        g.created_at
+        FROM groups g
+    """)
+    cursor.execute("""
+        UPDATE group_summary SET
+            last_sender_id = (SELECT sender_id FROM group_messages WHERE id = group_summary.last_message_id),
+            last_preview = (SELECT SUBSTR(message, 1, 100) FROM group_messages WHERE id = group_summary.last_message_id),
+            last_activity = COALESCE(
+                (SELECT timestamp FROM group_messages WHERE id = group_summary.last_message_id),
+                last_activity)
+    """)
+
+    #Everything past a member's read watermark that someone else wrote
+    cursor.execute("""
+        UPDATE group_members SET unread_count = (
+            SELECT COUNT(*) FROM group_messages msg
+            WHERE msg.group_id = group_members.group_id
+            AND msg.sender_id != group_members.user_id
+            AND msg.id > COALESCE((
+                SELECT s.last_read_id FROM group_read_state s
+                WHERE s.group_id = group_members.group_id AND s.user_id = group_members.user_id
+            ), 0)
+        )
+    """)
+
+
+def create_conversations(cursor):
+    #One conversation per unordered pair of users. The pair columns stay NULL for
+    #conversations with more than two participants.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_low INT NULL,
+            user_high INT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY unique_pair (user_low, user_high),
+            FOREIGN KEY (user_low) REFERENCES users(id),
+            FOREIGN KEY (user_high) REFERENCES users(id)
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_participants (
+            conversation_id INT NOT NULL,
+            user_id INT NOT NULL,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (conversation_id, user_id),
+            KEY idx_participants_user (user_id, conversation_id),
+            FOREIGN KEY (conversation_id) REFERENCES conversations(id),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    """)
+
+    if column_exists(cursor, "messages", "chat_id"):
+        #A->B and B->A chats merge into one conversation, which keeps the older chat's id
+        cursor.execute("""
+            INSERT IGNORE INTO conversations (id, user_low, user_high, created_at)
+            SELECT MIN(id), LEAST(sender_id, receiver_id), GREATEST(sender_id, receiver_id), MIN(created_at)
+            FROM userChats
+            GROUP BY LEAST(sender_id, receiver_id), GREATEST(sender_id, receiver_id)
+        """)
+        cursor.execute("""
+            INSERT IGNORE INTO conversation_participants (conversation_id, user_id, joined_at)
+            SELECT id, user_low, created_at FROM conversations
+            UNION
+            SELECT id, user_high, created_at FROM conversations
+        """)
+
+        if not column_exists(cursor, "messages", "conversation_id"):
+            cursor.execute("ALTER TABLE messages ADD COLUMN conversation_id INT NULL")
+        cursor.execute("""
+            UPDATE messages m
+            JOIN userChats uc ON m.chat_id = uc.id
+            JOIN conversations c ON c.user_low = LEAST(uc.sender_id, uc.receiver_id)
+            AND c.user_high = GREATEST(uc.sender_id, uc.receiver_id)
+            SET m.conversation_id = c.id
+        """)
+
+        constraint = foreign_key_name(cursor, "messages", "chat_id")
+        if constraint:
+            cursor.execute(f"ALTER TABLE messages DROP FOREIGN KEY {constraint}")
+        if index_exists(cursor, "messages", "idx_messages_chat"):
+            cursor.execute("DROP INDEX idx_messages_chat ON messages")
+        cursor.execute("""
+            ALTER TABLE messages
+            DROP COLUMN chat_id,
+            MODIFY conversation_id INT NOT NULL,
+            ADD FOREIGN KEY (conversation_id) REFERENCES conversations(id)
+        """)
+
+    #show and fetch pages: a conversation's messages in id order
+    add_index(cursor, "messages", "idx_messages_conversation", "conversation_id, id")
+    cursor.execute("DROP TABLE IF EXISTS userChats")
+
+
+def add_read_counters(cursor):
+    #Receipts per message, maintained as reads happen
+    for table in ("messages", "group_messages"):
+        if not column_exists(cursor, table, "read_count"):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN read_count INT NOT NULL DEFAULT 0")
+    backfill_read_state(cursor)
+
+    #Readers and non-readers of a group message are both ranges of this index
+    add_index(cursor, "group_read_state", "idx_group_read_state_progress", "group_id, last_read_id, user_id")
+    if index_exists(cursor, "group_read_state", "idx_group_read_state_last"):
+        cursor.execute("DROP INDEX idx_group_read_state_last ON group_read_state")
+
+
+def add_message_tombstones(cursor):
+    #Deleted messages are hidden at once and purged with their receipts later
+    for table in ("messages", "group_messages"):
+        if not column_exists(cursor, table, "deleted_at"):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN deleted_at TIMESTAMP NULL DEFAULT NULL")
+        add_index(cursor, table, f"idx_{table}_deleted", "deleted_at")
+
+
+def add_user_passwords(cursor):
+    #NULL for accounts made before passwords; they cannot log in until --set-password gives them one
+    if not column_exists(cursor, "users", "password_hash"):
+        cursor.execute("ALTER TABLE users ADD COLUMN password_hash VARCHAR(255) NULL DEFAULT NULL")
+
+
+def add_group_message_counts(cursor):
+    #A member's unread count is the group's message_count minus their unread_offset,
+    #so sending to a group writes no membership rows
+    if not column_exists(cursor, "group_summary", "message_count"):
+        cursor.execute("ALTER TABLE group_summary ADD COLUMN message_count INT NOT NULL DEFAULT 0")
+    if not column_exists(cursor, "group_members", "unread_offset"):
+        cursor.execute("ALTER TABLE group_members ADD COLUMN unread_offset INT NOT NULL DEFAULT 0")
+    backfill_group_message_counts(cursor)
+    if column_exists(cursor, "group_members", "unread_count"):
+        cursor.execute("ALTER TABLE group_members DROP COLUMN unread_count")
+
+
+def add_message_recipients(cursor):
+    #The newest page of a user's inbox is a range of one index instead of a sort
+    #over all their conversations
+    if not column_exists(cursor, "messages", "recipient_id"):
+        cursor.execute("ALTER TABLE messages ADD COLUMN recipient_id INT NULL")
+    backfill_message_recipients(cursor)
+    if not foreign_key_name(cursor, "messages", "recipient_id"):
+        cursor.execute("""
+            ALTER TABLE messages
+            MODIFY recipient_id INT NOT NULL,
+            ADD FOREIGN KEY (recipient_id) REFERENCES users(id)
+        """)
+    add_index(cursor, "messages", "idx_messages_recipient", "recipient_id, id")
+
+
+def backfill_message_recipients(cursor):
+    """Point every message at the other user of its conversation, or the sender for notes to self."""
+    cursor.execute("""
+        UPDATE messages SET recipient_id = (
+            SELECT CASE WHEN c.user_low = messages.sender_id THEN c.user_high ELSE c.user_low END
+            FROM conversations c WHERE c.id = messages.conversation_id
+        )
+        WHERE recipient_id IS NULL
+    """)
+
+
+def backfill_group_message_counts(cursor):
+    """Count each group's rows and set every offset so the unread counts stay what they were."""
+    cursor.execute("""
+        UPDATE group_summary SET message_count = (
+            SELECT COUNT(*) FROM group_messages gm WHERE gm.group_id = group_summary.group_id
+        )
+    """)
+    #The offset covers what the member has read or wrote themselves
+    cursor.execute("""
+        UPDATE group_members SET unread_offset = COALESCE((
+            SELECT s.message_count FROM group_summary s WHERE s.group_id = group_members.group_id
+        ), 0) - (
+            SELECT COUNT(*) FROM group_messages msg
+            WHERE msg.group_id = group_members.group_id
+            AND msg.sender_id != group_members.user_id
+            AND msg.id > COALESCE((
+                SELECT s.last_read_id FROM group_read_state s
+                WHERE s.group_id = group_members.group_id AND s.user_id = group_members.user_id
+            ), 0)
+        )
+    """)
+
+
+def backfill_read_state(cursor):
+    """Give every member a watermark row, drop those of former members and count the reads."""
+    cursor.execute("""
+        DELETE FROM group_read_state
+        WHERE NOT EXISTS (
+            SELECT 1 FROM group_members gm
+            WHERE gm.group_id = group_read_state.group_id AND gm.user_id = group_read_state.user_id
+        )
+    """)
+    cursor.execute("""
+        INSERT INTO group_read_state (group_id, user_id, last_read_id, updated_at)
+        SELECT gm.group_id, gm.user_id, 0, gm.joined_at
+        FROM group_members gm
+        WHERE NOT EXISTS (
+            SELECT 1 FROM group_read_state s
+            WHERE s.group_id = gm.group_id AND s.user_id = gm.user_id
+        )
+    """)
+    cursor.execute("""
+        UPDATE messages SET read_count = (
+            SELECT COUNT(*) FROM read_receipts r WHERE r.message_id = messages.id
+        )
+    """)
+    cursor.execute("""
+        UPDATE group_messages SET read_count = (
+            SELECT COUNT(*) FROM group_read_state s
+            WHERE s.group_id = group_messages.group_id AND s.last_read_id >= group_messages.id
+            AND s.user_id != group_messages.sender_id
+        )
+    """)
+
+
+def sqlite_create_base_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username VARCHAR(100) NOT NULL UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS userChats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id INTEGER NOT NULL REFERENCES users(id),
+            receiver_id INTEGER NOT NULL REFERENCES users(id),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL REFERENCES userChats(id),
+            sender_id INTEGER NOT NULL REFERENCES users(id),
+            message TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS groups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name VARCHAR(100) NOT NULL UNIQUE,
+            created_by INTEGER NOT NULL REFERENCES users(id),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS group_members (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER NOT NULL REFERENCES groups(id),
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (group_id, user_id)
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS group_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER NOT NULL REFERENCES groups(id),
+            sender_id INTEGER NOT NULL REFERENCES users(id),
+            message TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS read_receipts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER NOT NULL REFERENCES messages(id),
+            reader_id INTEGER NOT NULL REFERENCES users(id),
+            read_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (message_id, reader_id)
+        )
+    """)
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS group_read_receipts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER NOT NULL REFERENCES group_messages(id),
+            reader_id INTEGER NOT NULL REFERENCES users(id),
+            read_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (message_id, reader_id)
+        )
+    """)
+
+
+def sqlite_create_group_read_state(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS group_read_state (
+            group_id INTEGER NOT NULL REFERENCES groups(id),
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            last_read_id INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (group_id, user_id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_group_read_state_last ON group_read_state (group_id, last_read_id)")
+
+
+def sqlite_add_hot_path_indexes(cursor):
+    for index_name, table, columns in [
+        ("idx_userchats_pair", "userChats", "sender_id, receiver_id"),
+        ("idx_userchats_receiver", "userChats", "receiver_id"),
+        ("idx_messages_chat", "messages", "chat_id, id"),
+        ("idx_messages_sender", "messages", "sender_id"),
+        ("idx_group_messages_group", "group_messages", "group_id, id"),
+        ("idx_read_receipts_reader", "read_receipts", "reader_id"),
+        ("idx_group_members_user", "group_members", "user_id, group_id"),
+    ]:
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({columns})")
+
+
+def sqlite_add_search_indexes(cursor):
+    #search_messages: FTS5 indexes over the message text, kept in step by triggers
+    for table in ("messages", "group_messages"):
+        cursor.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts
+            USING fts5(message, content='{table}', content_rowid='id')
+        """)
+        sqlite_create_fts_triggers(cursor, table)
+        #Index the history written before this migration
+        cursor.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+
+
+def sqlite_create_fts_triggers(cursor, table):
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {table}_fts (rowid, message) VALUES (new.id, new.message);
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF message ON {table} BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, message) VALUES ('delete', old.id, old.message);
+            INSERT INTO {table}_fts (rowid, message) VALUES (new.id, new.message);
+        END
+    """)
+
+
+def sqlite_create_inbox_summaries(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS inbox_direct (
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            peer_id INTEGER NOT NULL REFERENCES users(id),
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            last_message_id INTEGER,
+            last_sender_id INTEGER,
+            last_preview VARCHAR(100),
+            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, peer_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS group_summary (
+            group_id INTEGER PRIMARY KEY REFERENCES groups(id),
+            member_count INTEGER NOT NULL DEFAULT 0,
+            last_message_id INTEGER,
+            last_sender_id INTEGER,
+            last_preview VARCHAR(100),
+            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("PRAGMA table_info(group_members)")
+    if "unread_count" not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE group_members ADD COLUMN unread_count INTEGER NOT NULL DEFAULT 0")
+
+    backfill_inbox_summaries(cursor)
+
+
+def sqlite_create_conversations(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_low INTEGER REFERENCES users(id),
+            user_high INTEGER REFERENCES users(id),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (user_low, user_high)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_participants (
+            conversation_id INTEGER NOT NULL REFERENCES conversations(id),
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (conversation_id, user_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_participants_user
+        ON conversation_participants (user_id, conversation_id)
+    """)
+
+    cursor.execute("""
+        INSERT OR IGNORE INTO conversations (id, user_low, user_high, created_at)
+        SELECT MIN(id), MIN(sender_id, receiver_id), MAX(sender_id, receiver_id), MIN(created_at)
+        FROM userChats
+        GROUP BY MIN(sender_id, receiver_id), MAX(sender_id, receiver_id)
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO conversation_participants (conversation_id, user_id, joined_at)
+        SELECT id, user_low, created_at FROM conversations
+        UNION
+        SELECT id, user_high, created_at FROM conversations
+    """)
+
+    #SQLite cannot change a column's foreign key, so messages is rebuilt with the same ids
+    cursor.execute("DROP TABLE IF EXISTS messages_new")
+    cursor.execute("""
+        CREATE TABLE messages_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER NOT NULL REFERENCES conversations(id),
+            sender_id INTEGER NOT NULL REFERENCES users(id),
+            message TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        INSERT INTO messages_new (id, conversation_id, sender_id, message, timestamp)
+        SELECT m.id, c.id, m.sender_id, m.message, m.timestamp
+        FROM messages m
+        JOIN userChats uc ON m.chat_id = uc.id
+        JOIN conversations c ON c.user_low = MIN(uc.sender_id, uc.receiver_id)
+        AND c.user_high = MAX(uc.sender_id, uc.receiver_id)
+    """)
+    #Keep the id sequence, so ids of deleted messages are not handed out again
+    cursor.execute("""
+        UPDATE sqlite_sequence SET seq = (SELECT seq FROM sqlite_sequence WHERE name = 'messages')
+        WHERE name = 'messages_new' AND EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'messages')
+    """)
+    cursor.execute("DROP TABLE messages")
+    cursor.execute("ALTER TABLE messages_new RENAME TO messages")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_id, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (sender_id)")
+    sqlite_create_fts_triggers(cursor, "messages")
+    cursor.execute("DROP TABLE userChats")
+
+
+def sqlite_add_read_counters(cursor):
+    for table in ("messages", "group_messages"):
+        cursor.execute(f"PRAGMA table_info({table})")
+        if "read_count" not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN read_count INTEGER NOT NULL DEFAULT 0")
+    backfill_read_state(cursor)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_group_read_state_progress
+        ON group_read_state (group_id, last_read_id, user_id)
+    """)
+    cursor.execute("DROP INDEX IF EXISTS idx_group_read_state_last")
+
+
+def sqlite_add_message_tombstones(cursor):
+    for table in ("messages", "group_messages"):
+        cursor.execute(f"PRAGMA table_info({table})")
+        if "deleted_at" not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN deleted_at TIMESTAMP NULL")
+        #Only tombstones are indexed, so the purge finds them without a scan
+        cursor.execute(f"""
+            CREATE INDEX IF NOT EXISTS idx_{table}_deleted ON {table} (deleted_at)
+            WHERE deleted_at IS NOT NULL
+        """)
+
+
+def sqlite_add_user_passwords(cursor):
+    cursor.execute("PRAGMA table_info(users)")
+    if "password_hash" not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE users ADD COLUMN password_hash VARCHAR(255) NULL")
+
+
+def sqlite_add_group_message_counts(cursor):
+    for table, column in (("group_summary", "message_count"), ("group_members", "unread_offset")):
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+    backfill_group_message_counts(cursor)
+    cursor.execute("PRAGMA table_info(group_members)")
+    if "unread_count" in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE group_members DROP COLUMN unread_count")
+
+
+def sqlite_add_message_recipients(cursor):
+    cursor.execute("PRAGMA table_info(messages)")
+    if "recipient_id" not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE messages ADD COLUMN recipient_id INTEGER REFERENCES users(id)")
+    backfill_message_recipients(cursor)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_recipient ON messages (recipient_id, id)")
+
+
+MIGRATIONS = {
+    "mysql": [
+        (1, "base tables", create_base_tables),
+        (2, "group read watermark", create_group_read_state),
+        (3, "hot path indexes", add_hot_path_indexes),
+        (4, "message search indexes", add_search_indexes),
+        (5, "inbox summaries", create_inbox_summaries),
+        (6, "conversations", create_conversations),
+        (7, "read counters", add_read_counters),
+        (8, "message tombstones", add_message_tombstones),
+        (9, "user passwords", add_user_passwords),
+        (10, "group message counts", add_group_message_counts),
+        (11, "message recipients", add_message_recipients),
+    ],
+    "sqlite": [
+        (1, "base tables", sqlite_create_base_tables),
+        (2, "group read watermark", sqlite_create_group_read_state),
+        (3, "hot path indexes", sqlite_add_hot_path_indexes),
+        (4, "message search indexes", sqlite_add_search_indexes),
+        (5, "inbox summaries", sqlite_create_inbox_summaries),
+        (6, "conversations", sqlite_create_conversations),
+        (7, "read counters", sqlite_add_read_counters),
+        (8, "message tombstones", sqlite_add_message_tombstones),
+        (9, "user passwords", sqlite_add_user_passwords),
+        (10, "group message counts", sqlite_add_group_message_counts),
+        (11, "message recipients", sqlite_add_message_recipients),
+    ],
+}
+
+
+def migrate(cursor, dialect):
+    """Apply every migration that has not been recorded yet, in version order."""
+    if dialect == "mysql":
+        #Serialise concurrent server starts against the same database
+        cursor.execute("SELECT GET_LOCK('chatdb_migrations', 60)")
+        if cursor.fetchone()[0] != 1:
+            raise RuntimeError("Timed out waiting for the schema migration lock.")
+    else:
+        #Only takes effect outside a transaction
+        cursor.execute("PRAGMA foreign_keys = OFF")
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INT PRIMARY KEY,
+                name VARCHAR(100) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("SELECT version FROM schema_migrations")
+        applied = {row[0] for row in cursor.fetchall()}
+
+        for version, name, apply in MIGRATIONS[dialect]:
+            if version in applied:
+                continue
+            apply(cursor)
+            if dialect == "sqlite":
+                cursor.execute("PRAGMA foreign_key_check")
+                if cursor.fetchall():
+                    raise RuntimeError(f"Migration {version} left rows with broken foreign keys.")
+            cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                           (version, name))
+            cursor.execute("COMMIT")
+            print(f"Applied migration {version}: {name}")
+    finally:
+        if dialect == "mysql":
+            cursor.execute("SELECT RELEASE_LOCK('chatdb_migrations')")
+            cursor.fetchone()
+        else:
+            cursor.execute("PRAGMA foreign_keys = ON")
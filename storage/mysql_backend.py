@@ -0,0 +1,72 @@
+import mysql.connector
+
+from storage.base import DuplicateError, Storage, StorageError
+
+#MySQL error raised when an insert collides with a unique key
+ER_DUP_ENTRY = 1062
+
+
+class MySQLStorage(Storage):
+    dialect = "mysql"
+    driver_errors = (mysql.connector.Error,)
+
+    READ_RECEIPT_INSERT = "INSERT IGNORE INTO read_receipts (message_id, reader_id) VALUES {values}"
+    #Updating nothing on a duplicate leaves rowcount at 0 (the connector does not set CLIENT_FOUND_ROWS)
+    CONVERSATION_INSERT = """
+        INSERT INTO conversations (user_low, user_high) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)
+    """
+    #Same left-to-right rule: last_message_id is compared before it is overwritten
+    INBOX_DIRECT_UPSERT = """
+        INSERT INTO inbox_direct
+        (user_id, peer_id, unread_count, last_message_id, last_sender_id, last_preview, last_activity)
+        VALUES {values}
+        ON DUPLICATE KEY UPDATE
+            unread_count = unread_count + VALUES(unread_count),
+            last_sender_id = IF(last_message_id IS NULL OR VALUES(last_message_id) > last_message_id,
+                                VALUES(last_sender_id), last_sender_id),
+            last_preview = IF(last_message_id IS NULL OR VALUES(last_message_id) > last_message_id,
+                              VALUES(last_preview), last_preview),
+            last_activity = IF(last_message_id IS NULL OR VALUES(last_message_id) > last_message_id,
+                               VALUES(last_activity), last_activity),
+            last_message_id = IF(last_message_id IS NULL OR VALUES(last_message_id) > last_message_id,
+                                 VALUES(last_message_id), last_message_id)
+    """
+    ARCHIVE_CUTOFF = "CURRENT_TIMESTAMP - INTERVAL %s SECOND"
+
+    def __init__(self, db_config, min_size=1, max_size=10, acquire_timeout=5.0,
+                 health_check_interval=30.0, cache_size=10000, cache_ttl=300.0,
+                 recent_cache_bytes=16 * 1024 * 1024, recent_per_conversation=200,
+                 write_batch_size=0, write_batch_delay=0.005,
+                 archive_path=None, archive_segment_bytes=64 * 1024 * 1024):
+        self.db_config = db_config
+        super().__init__(
+            lambda: mysql.connector.connect(**db_config),
+            lambda conn: conn.is_connected(),
+            min_size=min_size,
+            max_size=max_size,
+            acquire_timeout=acquire_timeout,
+            health_check_interval=health_check_interval,
+            cache_size=cache_size,
+            cache_ttl=cache_ttl,
+            recent_cache_bytes=recent_cache_bytes,
+            recent_per_conversation=recent_per_conversation,
+            write_batch_size=write_batch_size,
+            write_batch_delay=write_batch_delay,
+            archive_path=archive_path,
+            archive_segment_bytes=archive_segment_bytes,
+        )
+
+    def _first_insert_id(self, cursor, row_count):
+        #LAST_INSERT_ID() is the first row of a multi-row INSERT. InnoDB reserves
+        #all ids of a simple INSERT at once, in every innodb_autoinc_lock_mode.
+        return cursor.lastrowid
+
+    def _text_match(self, table, alias):
+        match = f"MATCH({alias}.message) AGAINST (%s IN NATURAL LANGUAGE MODE)"
+        return match, "", match
+
+    def _translate_error(self, err):
+        if err.errno == ER_DUP_ENTRY:
+            return DuplicateError(err.msg)
+        return StorageError(err.msg or str(err))
@@ -0,0 +1,120 @@
+import functools
+import sqlite3
+
+from storage.base import DuplicateError, Storage, StorageError
+
+
+@functools.lru_cache(maxsize=512)
+def to_qmark(sql):
+    return sql.replace("%s", "?")
+
+
+class PlaceholderCursor(sqlite3.Cursor):
+    """Cursor that accepts the ``%s`` placeholders the shared SQL is written with."""
+
+    def execute(self, sql, params=()):
+        return super().execute(to_qmark(sql), params)
+
+
+class SQLiteStorage(Storage):
+    """Embedded backend: no server to run, one file (or memory) per database.
+
+    File databases use WAL so readers never wait on the writer. ``:memory:``
+    keeps everything in a single shared connection, since every new
+    connection to it would open a separate empty database.
+    """
+
+    dialect = "sqlite"
+    driver_errors = (sqlite3.Error,)
+
+    READ_RECEIPT_INSERT = """
+        INSERT INTO read_receipts (message_id, reader_id) VALUES {values}
+        ON CONFLICT (message_id, reader_id) DO NOTHING
+    """
+    CONVERSATION_INSERT = """
+        INSERT INTO conversations (user_low, user_high) VALUES (%s, %s)
+        ON CONFLICT (user_low, user_high) DO NOTHING
+    """
+    INBOX_DIRECT_UPSERT = """
+        INSERT INTO inbox_direct
+        (user_id, peer_id, unread_count, last_message_id, last_sender_id, last_preview, last_activity)
+        VALUES {values}
+        ON CONFLICT (user_id, peer_id) DO UPDATE SET
+            unread_count = inbox_direct.unread_count + excluded.unread_count,
+            last_message_id = CASE WHEN inbox_direct.last_message_id IS NULL
+                OR excluded.last_message_id > inbox_direct.last_message_id
+                THEN excluded.last_message_id ELSE inbox_direct.last_message_id END,
+            last_sender_id = CASE WHEN inbox_direct.last_message_id IS NULL
+                OR excluded.last_message_id > inbox_direct.last_message_id
+                THEN excluded.last_sender_id ELSE inbox_direct.last_sender_id END,
+            last_preview = CASE WHEN inbox_direct.last_message_id IS NULL
+                OR excluded.last_message_id > inbox_direct.last_message_id
+                THEN excluded.last_preview ELSE inbox_direct.last_preview END,
+            last_activity = CASE WHEN inbox_direct.last_message_id IS NULL
+                OR excluded.last_message_id > inbox_direct.last_message_id
+                THEN excluded.last_activity ELSE inbox_direct.last_activity END
+    """
+    #Timestamps are stored as UTC text, which compares in time order
+    ARCHIVE_CUTOFF = "datetime('now', '-' || %s || ' seconds')"
+
+    def __init__(self, path="chatdb.sqlite3", max_size=4, acquire_timeout=5.0,
+                 busy_timeout=5.0, cache_size=10000, cache_ttl=300.0,
+                 recent_cache_bytes=16 * 1024 * 1024, recent_per_conversation=200,
+                 write_batch_size=0, write_batch_delay=0.005,
+                 archive_path=None, archive_segment_bytes=64 * 1024 * 1024):
+        self.path = path
+        in_memory = path == ":memory:"
+
+        def connect():
+            conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+            conn.execute("PRAGMA foreign_keys = ON")
+            if not in_memory:
+                conn.execute("PRAGMA journal_mode = WAL")
+                conn.execute("PRAGMA synchronous = NORMAL")
+            return conn
+
+        super().__init__(
+            connect,
+            self._is_healthy,
+            min_size=1,
+            max_size=1 if in_memory else max_size,
+            acquire_timeout=acquire_timeout,
+            health_check_interval=float("inf"),
+            cache_size=cache_size,
+            cache_ttl=cache_ttl,
+            recent_cache_bytes=recent_cache_bytes,
+            recent_per_conversation=recent_per_conversation,
+            write_batch_size=write_batch_size,
+            write_batch_delay=write_batch_delay,
+            archive_path=archive_path,
+            archive_segment_bytes=archive_segment_bytes,
+        )
+
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            conn.execute("SELECT 1")
+            return True
+        except sqlite3.ProgrammingError:
+            return False
+
+    def _cursor(self, conn):
+        return conn.cursor(PlaceholderCursor)
+
+    def _first_insert_id(self, cursor, row_count):
+        #lastrowid is the last row of a multi-row INSERT; the single writer keeps them consecutive
+        return cursor.lastrowid - row_count + 1
+
+    def _text_match(self, table, alias):
+        index = f"{table}_fts"
+        #bm25() is lower for better matches
+        return f"-bm25({index})", f"JOIN {index} ON {index}.rowid = {alias}.id", f"{index} MATCH %s"
+
+    def _search_query(self, terms):
+        #Quote every word so FTS5 syntax typed by the user is searched for literally
+        return " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+    def _translate_error(self, err):
+        if isinstance(err, sqlite3.IntegrityError) and "UNIQUE" in str(err):
+            return DuplicateError(str(err))
+        return StorageError(str(err))
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bus import MemoryBus
+from storage import create_storage
+
+
+class Workers:
+    """Storages on one SQLite file, wired to a MemoryBus the way server.start
+    wires a worker, so each one stands in for a server process."""
+
+    def __init__(self, path):
+        self.path = path
+        self.bus = MemoryBus()
+        self.storages = []
+        self.endpoints = []
+
+    async def start(self, count, **options):
+        for _ in range(count):
+            storage = create_storage("sqlite", path=self.path, **options)
+            endpoint = self.bus.endpoint()
+            storage.add_invalidation_hook(lambda group_id, endpoint=endpoint:
+                                          endpoint.publish({"members_changed": group_id}))
+            storage.add_history_hook(lambda key, endpoint=endpoint: endpoint.publish({"history_changed": key}))
+
+            async def on_message(message, storage=storage):
+                if "members_changed" in message:
+                    storage.forget_members(message["members_changed"])
+                elif "history_changed" in message:
+                    storage.forget_history(message["history_changed"])
+            await endpoint.start(on_message)
+            self.storages.append(storage)
+            self.endpoints.append(endpoint)
+        await self.storages[0].setup_database()
+        return self.storages
+
+    async def close(self):
+        for endpoint in self.endpoints:
+            await endpoint.close()
+        for storage in self.storages:
+            storage.close()
+
+
+def query(workers, sql, params=()):
+    """Read the workers' database directly, for checking what the storage wrote."""
+    with sqlite3.connect(workers.path) as db:
+        return db.execute(sql, params).fetchall()
+
+
+async def group_unread(storage, user_id):
+    """Unread counts of the user's groups, as the inbox summary reports them."""
+    _, groups = await storage.inbox_summary(user_id)
+    return [row[1] for row in groups]
+
+
+async def settle():
+    """Let the bus deliver everything published so far."""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+def run(tmp_path):
+    """Run ``scenario(workers)`` against a fresh database and close it after."""
+    def run(scenario):
+        async def main():
+            workers = Workers(str(tmp_path / "chat.sqlite3"))
+            try:
+                await scenario(workers)
+            finally:
+                await workers.close()
+        asyncio.run(main())
+    return run
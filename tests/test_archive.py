@@ -0,0 +1,97 @@
+import os
+
+from conftest import query
+from storage.archive import INDEX_SUFFIX, HistoryArchive
+
+
+def rows(first, last):
+    return [(message_id, f"m{message_id}", "2020-01-01 00:00:00", "alice") for message_id in range(first, last + 1)]
+
+
+def ids(page):
+    found, has_more = page
+    return [row[0] for row in found], has_more
+
+
+def test_pages_span_blocks_and_segments_in_both_directions(tmp_path):
+    archive = HistoryArchive(str(tmp_path), segment_bytes=1)
+    key = ("direct", 2)
+    for first in (1, 4, 7):
+        archive.append({key: rows(first, first + 2), ("direct", 3): rows(100 + first, 100 + first)})
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith(INDEX_SUFFIX)) == [
+        "000001.idx", "000002.idx", "000003.idx"]
+    assert archive.high_id("direct") == 107 and archive.high_id("group") == 0
+
+    assert ids(archive.page(key, limit=4)) == ([6, 7, 8, 9], True)
+    assert ids(archive.page(key, before_id=6, limit=4)) == ([2, 3, 4, 5], True)
+    assert ids(archive.page(key, before_id=2, limit=4)) == ([1], False)
+    assert ids(archive.page(key, since_id=0, limit=4)) == ([1, 2, 3, 4], True)
+    assert ids(archive.page(key, since_id=4, before_id=8, limit=10)) == ([5, 6, 7], False)
+    assert ids(archive.page(("group", 2), limit=4)) == ([], False)
+
+
+def test_other_processes_see_appends_once_told(tmp_path):
+    writer = HistoryArchive(str(tmp_path))
+    reader = HistoryArchive(str(tmp_path))
+    key = ("group", 5)
+    writer.append({key: rows(1, 2)})
+    assert ids(reader.page(key)) == ([1, 2], False)
+    writer.append({key: rows(3, 4)})
+    assert ids(reader.page(key)) == ([1, 2], False)
+    reader.invalidate()
+    assert ids(reader.page(key)) == ([1, 2, 3, 4], False)
+
+
+def test_a_half_written_index_line_is_skipped_and_then_dropped(tmp_path):
+    key = ("direct", 2)
+    HistoryArchive(str(tmp_path)).append({key: rows(1, 2)})
+    #A crash while writing the next batch's index line
+    with open(tmp_path / "000001.idx", "ab") as index:
+        index.write(b"direct-2 3 4 2 9")
+    archive = HistoryArchive(str(tmp_path))
+    assert ids(archive.page(key)) == ([1, 2], False)
+    assert archive.high_id("direct") == 2
+
+    archive.append({key: rows(3, 5)})
+    lines = (tmp_path / "000001.idx").read_bytes().decode().splitlines()
+    assert [line.split()[:3] for line in lines] == [["direct-2", "1", "2"], ["direct-2", "3", "5"]]
+    assert ids(HistoryArchive(str(tmp_path)).page(key)) == ([1, 2, 3, 4, 5], False)
+
+
+def test_history_pages_continue_from_the_database_into_the_archive(run, tmp_path):
+    async def scenario(workers):
+        storage, = await workers.start(1, archive_path=str(tmp_path / "archive"))
+        alice = await storage.register_user("alice", None)
+        bob = await storage.register_user("bob", None)
+        group_id = await storage.create_group("team", alice)
+        direct = [(await storage.send_message(alice, bob, f"d{i}"))[0] for i in range(7)]
+        group = [(await storage.send_group_message(group_id, alice, f"g{i}", "alice"))[0] for i in range(7)]
+        for table, archived in (("messages", direct[:4]), ("group_messages", group[:4])):
+            query(workers, f"UPDATE {table} SET timestamp = datetime('now', '-2 days') WHERE id <= ?", (archived[-1],))
+        assert await storage.archive_history(86400) == 8
+        assert query(workers, "SELECT COUNT(*) FROM messages") == [(3,)]
+
+        for fetch, expected in ((lambda **page: storage.fetch_messages(bob, **page), direct),
+                                (lambda **page: storage.fetch_group_messages(group_id, alice, **page), group)):
+            #Scrolling back from the newest page
+            seen, before = [], None
+            while True:
+                page = await fetch(before_id=before, limit=3)
+                seen[:0] = [row[0] for row in page[0]]
+                if not page[1]:
+                    break
+                before = page[0][0][0]
+            assert seen == expected
+            #Syncing forward from the start
+            seen, since = [], 0
+            while True:
+                page = await fetch(since_id=since, limit=3)
+                seen += [row[0] for row in page[0]]
+                if not page[1]:
+                    break
+                since = page[0][-1][0]
+            assert seen == expected
+            #A page straddling the boundary
+            page = await fetch(since_id=expected[1], before_id=expected[6], limit=10)
+            assert [row[0] for row in page[0]] == expected[2:6]
+    run(scenario)
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from conftest import query
+from storage.batching import WriteBatcher
+
+
+class Writer:
+    """Flush callback that records each batch and fails any batch holding a bad item."""
+
+    def __init__(self, bad=()):
+        self.bad = set(bad)
+        self.batches = []
+
+    async def __call__(self, items):
+        self.batches.append(list(items))
+        await asyncio.sleep(0)
+        if self.bad & set(items):
+            raise ValueError(f"bad row in {items}")
+        return [item * 10 for item in items]
+
+
+def test_items_queued_together_share_one_flush_up_to_the_batch_size():
+    async def main():
+        writer = Writer()
+        batcher = WriteBatcher(writer, max_batch=3, max_delay=0.01)
+        results = await asyncio.gather(*(batcher.submit(item) for item in range(5)))
+        assert results == [0, 10, 20, 30, 40]
+        assert writer.batches == [[0, 1, 2], [3, 4]]
+        await batcher.close()
+    asyncio.run(main())
+
+
+def test_a_failed_batch_is_retried_one_item_at_a_time():
+    async def main():
+        writer = Writer(bad={2})
+        batcher = WriteBatcher(writer, max_batch=10, max_delay=0.01)
+        results = await asyncio.gather(*(batcher.submit(item) for item in range(4)), return_exceptions=True)
+        assert results[:2] == [0, 10] and results[3] == 30
+        assert isinstance(results[2], ValueError)
+        assert writer.batches == [[0, 1, 2, 3], [0], [1], [2], [3]]
+
+        #A lone item is not retried
+        with pytest.raises(ValueError):
+            await batcher.submit(2)
+        assert writer.batches[-1] == [2]
+        await batcher.close()
+    asyncio.run(main())
+
+
+def test_close_writes_what_is_queued_and_stops():
+    async def main():
+        writer = Writer()
+        batcher = WriteBatcher(writer, max_batch=100, max_delay=60)
+        pending = [asyncio.ensure_future(batcher.submit(item)) for item in range(3)]
+        await asyncio.sleep(0.01)
+        assert writer.batches == []
+        await batcher.close()
+        assert [task.result() for task in pending] == [0, 10, 20]
+        assert writer.batches == [[0, 1, 2]]
+
+        #A later submit starts a new background task
+        batcher.max_delay = 0
+        assert await batcher.submit(7) == 70
+        await batcher.close()
+    asyncio.run(main())
+
+
+def test_storage_flush_commits_messages_still_waiting_for_their_batch(run):
+    async def scenario(workers):
+        storage, = await workers.start(1, write_batch_size=50, write_batch_delay=60)
+        alice = await storage.register_user("alice", None)
+        bob = await storage.register_user("bob", None)
+        sends = [asyncio.ensure_future(storage.send_message(alice, bob, f"m{i}")) for i in range(3)]
+        await asyncio.sleep(0.01)
+        assert query(workers, "SELECT COUNT(*) FROM messages") == [(0,)]
+        await storage.flush()
+        assert query(workers, "SELECT message FROM messages ORDER BY id") == [("m0",), ("m1",), ("m2",)]
+        assert [(await send)[0] for send in sends] == [1, 2, 3]
+    run(scenario)
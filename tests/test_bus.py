@@ -0,0 +1,53 @@
+import asyncio
+
+from bus import BusHub, MemoryBus, SocketEndpoint
+from conftest import settle
+
+
+def received(endpoints):
+    inboxes = [[] for _ in endpoints]
+
+    async def start():
+        for endpoint, inbox in zip(endpoints, inboxes):
+            async def on_message(message, inbox=inbox):
+                inbox.append(message)
+            await endpoint.start(on_message)
+    return inboxes, start
+
+
+def test_memory_bus_fans_out_to_every_other_endpoint_in_order():
+    async def main():
+        bus = MemoryBus()
+        endpoints = [bus.endpoint() for _ in range(3)]
+        inboxes, start = received(endpoints)
+        await start()
+        endpoints[0].publish({"push": [["bob"], {"n": 1}]})
+        endpoints[0].publish({"push": [["bob"], {"n": 2}]})
+        endpoints[2].publish({"members_changed": 7})
+        await settle()
+        assert inboxes[0] == [{"members_changed": 7}]
+        assert inboxes[1] == [{"push": [["bob"], {"n": 1}]}, {"push": [["bob"], {"n": 2}]}, {"members_changed": 7}]
+        assert inboxes[2] == [{"push": [["bob"], {"n": 1}]}, {"push": [["bob"], {"n": 2}]}]
+        for endpoint in endpoints:
+            await endpoint.close()
+    asyncio.run(main())
+
+
+def test_socket_bus_fans_out_through_the_hub():
+    async def main():
+        hub = BusHub()
+        host, port = await hub.start()
+        endpoints = [SocketEndpoint(host, port) for _ in range(3)]
+        inboxes, start = received(endpoints)
+        await start()
+        #The hub only relays to workers whose connection it has accepted
+        while len(hub._writers) < len(endpoints):
+            await asyncio.sleep(0.01)
+        endpoints[1].publish({"history_changed": ["group", 3]})
+        while not (inboxes[0] and inboxes[2]):
+            await asyncio.sleep(0.01)
+        assert inboxes == [[{"history_changed": ["group", 3]}], [], [{"history_changed": ["group", 3]}]]
+        for endpoint in endpoints:
+            await endpoint.close()
+        await hub.close()
+    asyncio.run(main())
@@ -0,0 +1,51 @@
+import pytest
+
+import codec
+from codec import JSON, DecodeError, codec_for, columns, rows_from_columns
+
+MESSAGE = {"status": "ok", "messages": [{"id": 1, "message": "héllo 👋", "sender": "alice"}],
+           "has_more": False, "first_id": None, "request_id": 7}
+
+
+def test_json_round_trip():
+    frame = JSON.encode(MESSAGE)
+    assert isinstance(frame, str)
+    assert JSON.decode(frame) == MESSAGE
+
+
+def test_msgpack_round_trip_uses_binary_frames():
+    pytest.importorskip("msgpack")
+    msgpack_codec = codec_for("chat.msgpack")
+    assert msgpack_codec.name == "MessagePack"
+    frame = msgpack_codec.encode(MESSAGE)
+    assert isinstance(frame, bytes)
+    assert msgpack_codec.decode(frame) == MESSAGE
+    assert len(frame) < len(JSON.encode(MESSAGE).encode())
+
+
+@pytest.mark.parametrize("subprotocol", ["chat.json", None, "chat.unknown"])
+def test_clients_without_a_known_subprotocol_get_json(subprotocol):
+    assert codec_for(subprotocol) is JSON
+
+
+def test_subprotocols_prefer_msgpack_when_installed():
+    expected = (["chat.msgpack"] if codec.msgpack is not None else []) + ["chat.json"]
+    assert codec.subprotocols() == expected
+
+
+def test_undecodable_frames_raise_decode_error():
+    with pytest.raises(DecodeError):
+        JSON.decode("{not json")
+    with pytest.raises(DecodeError):
+        JSON.decode(b"\xff\xfe")
+    if codec.msgpack is not None:
+        with pytest.raises(DecodeError):
+            codec_for("chat.msgpack").decode(b"\xc1")
+
+
+def test_columnar_lists_round_trip():
+    rows = [[1, "one", "alice"], [2, "two", "bob"]]
+    table = columns(("id", "message", "sender"), rows)
+    assert table == {"columns": ["id", "message", "sender"], "rows": rows}
+    assert rows_from_columns(table) == [{"id": 1, "message": "one", "sender": "alice"},
+                                        {"id": 2, "message": "two", "sender": "bob"}]
@@ -0,0 +1,85 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from dispatch import Dispatcher, Field
+
+
+@pytest.mark.parametrize("field, value, error", [
+    (Field(str), "", "'f' must be a non-empty string."),
+    (Field(str), 3, "'f' must be a non-empty string."),
+    (Field(int), True, "'f' must be an integer."),
+    (Field(int), "3", "'f' must be an integer."),
+    (Field(int, min_value=1), 0, "'f' must be at least 1."),
+    (Field(int, max_value=5), 6, "'f' must be at most 5."),
+    (Field(bool), 1, "'f' must be true or false."),
+    (Field(list, items=int), [], "'f' must be a non-empty list."),
+    (Field(list, items=int, max_items=2), [1, 2, 3], "'f' may hold at most 2 items."),
+    (Field(list, items=int), [1, "2"], "'f' must only contain int values."),
+    (Field(list, items=int, min_value=1), [1, 0], "'f' must only contain int values."),
+])
+def test_field_rejects(field, value, error):
+    assert field.check("f", value) == error
+
+
+@pytest.mark.parametrize("field, value", [
+    (Field(str), "x"),
+    (Field(int, min_value=1, max_value=5), 5),
+    (Field(bool), False),
+    (Field(list, items=int, max_items=2, min_value=1), [1, 2]),
+])
+def test_field_accepts(field, value):
+    assert field.check("f", value) is None
+
+
+def dispatcher():
+    dispatcher = Dispatcher()
+
+    @dispatcher.action("echo", actor="username", text=Field(str), limit=Field(int, required=False, default=10))
+    async def echo(ctx, req):
+        return {"status": "ok", "request": req}
+
+    @dispatcher.action("login", public=True, username=Field(str))
+    async def login(ctx, req):
+        return {"status": "ok"}
+
+    @dispatcher.action("broken")
+    async def broken(ctx, req):
+        raise RuntimeError("bug")
+    return dispatcher
+
+
+def dispatch(data, user_id=1, username="alice"):
+    ctx = SimpleNamespace(user_id=user_id, username=username)
+    return asyncio.run(dispatcher().dispatch(ctx, data))
+
+
+def test_validated_request_holds_only_declared_fields_with_defaults():
+    response = dispatch({"action": "echo", "text": "hi", "extra": 1})
+    assert response == {"status": "ok", "request": {"text": "hi", "limit": 10}}
+
+
+def test_missing_and_invalid_fields_are_reported():
+    assert dispatch({"action": "echo"}) == {"status": "error", "message": "Missing text."}
+    assert dispatch({"action": "echo", "text": "hi", "limit": "5"}) == {
+        "status": "error", "message": "'limit' must be an integer."}
+
+
+def test_login_and_identity_are_checked_before_the_handler():
+    assert dispatch({"action": "nope"})["message"] == "Unknown action."
+    assert dispatch({"action": "echo", "text": "hi"}, user_id=None)["message"] == "Please log in first."
+    assert dispatch({"action": "login", "username": "bob"}, user_id=None)["status"] == "ok"
+    assert dispatch({"action": "echo", "text": "hi", "username": "bob"})["message"] == "You are logged in as 'alice'."
+    assert dispatch({"action": "echo", "text": "hi", "username": "alice"})["status"] == "ok"
+
+
+def test_handler_errors_become_an_internal_error_and_are_timed(capsys):
+    timings = []
+    actions = dispatcher()
+    actions.add_timing_hook(lambda action, seconds, status: timings.append((action, status)))
+    ctx = SimpleNamespace(user_id=1, username="alice")
+    response = asyncio.run(actions.dispatch(ctx, {"action": "broken"}))
+    assert response == {"status": "error", "message": "Internal server error."}
+    assert timings == [("broken", "error")]
+    assert "RuntimeError: bug" in capsys.readouterr().err
@@ -0,0 +1,63 @@
+from conftest import group_unread, query
+
+
+def test_sending_to_a_group_only_touches_the_senders_membership(run):
+    async def scenario(workers):
+        storage, = await workers.start(1)
+        alice = await storage.register_user("alice", None)
+        bob = await storage.register_user("bob", None)
+        carol = await storage.register_user("carol", None)
+        group_id = await storage.create_group("team", alice)
+        await storage.add_member(group_id, bob)
+        await storage.add_member(group_id, carol)
+        members = "SELECT user_id, unread_offset FROM group_members ORDER BY user_id"
+        assert query(workers, members) == [(alice, 0), (bob, 0), (carol, 0)]
+
+        for i in range(3):
+            await storage.send_group_message(group_id, alice, f"m{i}", "alice")
+        assert query(workers, members) == [(alice, 3), (bob, 0), (carol, 0)]
+        assert [await group_unread(storage, user_id) for user_id in (alice, bob, carol)] == [[0], [3], [3]]
+
+        await storage.fetch_group_messages(group_id, bob)
+        await storage.send_group_message(group_id, carol, "reply", "carol")
+        assert [await group_unread(storage, user_id) for user_id in (alice, bob, carol)] == [[1], [1], [3]]
+    run(scenario)
+
+
+def test_rejoining_member_does_not_count_their_own_messages(run):
+    async def scenario(workers):
+        storage, = await workers.start(1)
+        alice = await storage.register_user("alice", None)
+        bob = await storage.register_user("bob", None)
+        group_id = await storage.create_group("team", alice)
+        await storage.add_member(group_id, bob)
+        for sender_id, name in ((bob, "bob"), (bob, "bob"), (alice, "alice")):
+            await storage.send_group_message(group_id, sender_id, "hi", name)
+        await storage.fetch_group_messages(group_id, bob)
+
+        await storage.remove_member(group_id, bob)
+        await storage.add_member(group_id, bob)
+        assert await group_unread(storage, bob) == [1]
+        assert await group_unread(storage, alice) == [2]
+    run(scenario)
+
+
+def test_archiving_takes_archived_messages_out_of_unread_counts(run, tmp_path):
+    async def scenario(workers):
+        storage, = await workers.start(1, archive_path=str(tmp_path / "archive"))
+        alice = await storage.register_user("alice", None)
+        bob = await storage.register_user("bob", None)
+        carol = await storage.register_user("carol", None)
+        group_id = await storage.create_group("team", alice)
+        await storage.add_member(group_id, bob)
+        await storage.add_member(group_id, carol)
+        ids = [(await storage.send_group_message(group_id, alice, f"m{i}", "alice"))[0] for i in range(4)]
+        #Bob has read the first two, carol nothing
+        await storage.fetch_group_messages(group_id, bob, since_id=0, limit=2)
+        assert [await group_unread(storage, user_id) for user_id in (alice, bob, carol)] == [[0], [2], [4]]
+
+        query(workers, "UPDATE group_messages SET timestamp = datetime('now', '-2 days') WHERE id <= ?", (ids[2],))
+        assert await storage.archive_history(86400) == 3
+        assert [await group_unread(storage, user_id) for user_id in (alice, bob, carol)] == [[0], [1], [1]]
+        assert query(workers, "SELECT message_count FROM group_summary") == [(1,)]
+    run(scenario)
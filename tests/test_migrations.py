@@ -0,0 +1,38 @@
+from conftest import query
+from storage.migrations import MIGRATIONS
+
+
+def test_conversations_merge_both_one_way_chats_of_a_pair(run, monkeypatch):
+    async def scenario(workers):
+        migrations = MIGRATIONS["sqlite"]
+        #A database from before conversations, with a chat row per direction
+        monkeypatch.setitem(MIGRATIONS, "sqlite", [m for m in migrations if m[0] < 6])
+        storage, = await workers.start(1)
+        query(workers, "INSERT INTO users (id, username) VALUES (1, 'alice'), (2, 'bob'), (3, 'carol')")
+        query(workers, "INSERT INTO userChats (id, sender_id, receiver_id) VALUES (1, 1, 2), (2, 2, 1), (3, 1, 3)")
+        query(workers, """
+            INSERT INTO messages (id, chat_id, sender_id, message)
+            VALUES (1, 1, 1, 'a1'), (2, 2, 2, 'b1'), (3, 1, 1, 'a2'), (4, 3, 1, 'c1')
+        """)
+        query(workers, "INSERT INTO read_receipts (message_id, reader_id) VALUES (2, 1)")
+
+        monkeypatch.setitem(MIGRATIONS, "sqlite", migrations)
+        await storage.setup_database()
+
+        assert query(workers, "SELECT id, user_low, user_high FROM conversations ORDER BY id") == [
+            (1, 1, 2), (3, 1, 3)]
+        assert query(workers, "SELECT conversation_id, user_id FROM conversation_participants ORDER BY 1, 2") == [
+            (1, 1), (1, 2), (3, 1), (3, 3)]
+        assert query(workers, "SELECT id, conversation_id, sender_id, recipient_id, read_count FROM messages") == [
+            (1, 1, 1, 2, 0), (2, 1, 2, 1, 1), (3, 1, 1, 2, 0), (4, 3, 1, 3, 0)]
+        assert query(workers, "SELECT name FROM sqlite_master WHERE name = 'userChats'") == []
+
+        rows, _ = await storage.fetch_messages(2)
+        assert [row[1] for row in rows] == ["a1", "a2"]
+        rows, _ = await storage.fetch_messages(1)
+        assert [row[1] for row in rows] == ["b1"]
+        #Either direction now writes to the one conversation, after the old ids
+        message_id, _ = await storage.send_message(2, 1, "b2")
+        assert query(workers, "SELECT conversation_id FROM messages WHERE id = ?", (message_id,)) == [(1,)]
+        assert message_id == 5
+    run(scenario)
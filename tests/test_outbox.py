@@ -0,0 +1,99 @@
+import asyncio
+
+from codec import JSON
+from sessions import Outbox
+
+
+class FakeSocket:
+    """Records what the outbox writes; ``open`` holds the writer back until set."""
+
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+        self.open = asyncio.Event()
+        self.open.set()
+
+    async def send(self, frame):
+        await self.open.wait()
+        self.sent.append(frame)
+
+    async def close(self, code=1000, reason=""):
+        self.closed_with = (code, reason)
+
+
+async def drain():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_pushes_past_the_limit_are_dropped():
+    async def main():
+        socket, overflows = FakeSocket(), []
+        outbox = Outbox(socket, JSON, max_frames=2, policy="drop", on_overflow=overflows.append)
+        for i in range(3):
+            outbox.push(f"p{i}")
+        assert len(outbox) == 2 and overflows == ["drop"]
+        outbox.start()
+        await drain()
+        assert socket.sent == ["p0", "p1"]
+        outbox.close()
+    asyncio.run(main())
+
+
+def test_coalesced_pushes_leave_one_missed_notice():
+    async def main():
+        socket = FakeSocket()
+        outbox = Outbox(socket, JSON, max_frames=2, policy="coalesce")
+        for i in range(4):
+            outbox.push(f"p{i}")
+        outbox.start()
+        await drain()
+        assert socket.sent == ["p0", "p1", JSON.encode({"event": "missed", "count": 2})]
+        outbox.close()
+    asyncio.run(main())
+
+
+def test_a_slow_consumer_is_disconnected():
+    async def main():
+        socket = FakeSocket()
+        outbox = Outbox(socket, JSON, max_frames=1, policy="disconnect")
+        outbox.push("p0")
+        outbox.push("p1")
+        await drain()
+        assert outbox.closed and len(outbox) == 0
+        assert socket.closed_with == (1008, "Slow consumer.")
+        #Nothing more is queued once closed
+        outbox.push("p2")
+        await outbox.send("reply")
+        assert len(outbox) == 0
+    asyncio.run(main())
+
+
+def test_replies_wait_for_room_instead_of_being_dropped():
+    async def main():
+        socket = FakeSocket()
+        socket.open.clear()
+        outbox = Outbox(socket, JSON, max_frames=2, policy="drop")
+        outbox.start()
+        await outbox.send("r0")
+        await outbox.send("r1")
+        await outbox.send("r2")
+        blocked = asyncio.ensure_future(outbox.send("r3"))
+        await drain()
+        assert not blocked.done()
+        socket.open.set()
+        await blocked
+        await drain()
+        assert socket.sent == ["r0", "r1", "r2", "r3"]
+        outbox.close()
+    asyncio.run(main())
+
+
+def test_the_byte_limit_still_lets_one_large_frame_through():
+    async def main():
+        outbox = Outbox(FakeSocket(), JSON, max_frames=10, max_bytes=5, policy="drop")
+        outbox.push("x" * 50)
+        assert len(outbox) == 1 and outbox.queued_bytes == 50
+        outbox.push("y")
+        assert len(outbox) == 1
+    asyncio.run(main())
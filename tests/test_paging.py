@@ -0,0 +1,81 @@
+import server
+from storage.base import page_clause, trim_page
+
+
+def test_page_clause_scans_forward_only_when_syncing():
+    assert page_clause("m.id", None, None) == ("", [], "DESC")
+    assert page_clause("m.id", None, 9) == (" AND m.id < %s", [9], "DESC")
+    assert page_clause("m.id", 3, None) == (" AND m.id > %s", [3], "ASC")
+    assert page_clause("m.id", 3, 9) == (" AND m.id > %s AND m.id < %s", [3, 9], "ASC")
+
+
+def test_trim_page_returns_oldest_first_and_whether_there_is_more():
+    assert trim_page([(5,), (4,), (3,)], 2, "DESC") == ([(4,), (5,)], True)
+    assert trim_page([(3,), (4,)], 2, "ASC") == ([(3,), (4,)], False)
+
+
+def test_cursors_of_an_empty_page_echo_the_request():
+    req = {"since_id": 7, "before_id": None, "columnar": False}
+    assert server.page_response(("id",), [], False, req) == {
+        "status": "ok", "messages": [], "has_more": False, "first_id": None, "last_id": 7}
+    req["columnar"] = True
+    response = server.page_response(("id", "message"), [(8, "hi"), (9, "yo")], True, req)
+    assert response["messages"] == {"columns": ["id", "message"], "rows": [(8, "hi"), (9, "yo")]}
+    assert (response["first_id"], response["last_id"], response["has_more"]) == (8, 9, True)
+
+
+async def walk_back(fetch, limit):
+    seen, before = [], None
+    while True:
+        rows, has_more = (await fetch(before_id=before, limit=limit))[:2]
+        seen[:0] = [row[0] for row in rows]
+        if not has_more:
+            return seen
+        before = rows[0][0]
+
+
+def test_direct_history_pages_back_and_syncs_forward(run):
+    async def scenario(workers):
+        storage, = await workers.start(1)
+        alice = await storage.register_user("alice", None)
+        bob = await storage.register_user("bob", None)
+        ids = [(await storage.send_message(alice, bob, f"m{i}"))[0] for i in range(7)]
+        #Bob's own messages are not in his inbox, and deleted ones are skipped
+        await storage.send_message(bob, alice, "reply")
+        await storage.delete_message(ids[3])
+        expected = ids[:3] + ids[4:]
+
+        def fetch(**page):
+            return storage.fetch_messages(bob, **page)
+        assert await walk_back(fetch, 2) == expected
+
+        rows, has_more = await fetch(limit=2)
+        assert [row[0] for row in rows] == expected[-2:] and has_more
+        newer = (await storage.send_message(alice, bob, "new"))[0]
+        rows, has_more = await fetch(since_id=expected[-1])
+        assert [row[0] for row in rows] == [newer] and not has_more
+        rows, has_more = await fetch(since_id=ids[0], before_id=ids[5], limit=10)
+        assert [row[0] for row in rows] == [ids[1], ids[2], ids[4]] and not has_more
+    run(scenario)
+
+
+def test_group_history_pages_back_and_syncs_forward(run):
+    async def scenario(workers):
+        storage, = await workers.start(1, recent_per_conversation=2)
+        alice = await storage.register_user("alice", None)
+        group_id = await storage.create_group("team", alice)
+        ids = [(await storage.send_group_message(group_id, alice, f"m{i}", "alice"))[0] for i in range(5)]
+
+        def fetch(**page):
+            return storage.fetch_group_messages(group_id, alice, **page)
+        assert await walk_back(fetch, 2) == ids
+
+        seen, since = [], 0
+        while True:
+            rows, has_more, _ = await fetch(since_id=since, limit=2)
+            seen += [row[0] for row in rows]
+            if not has_more:
+                break
+            since = rows[-1][0]
+        assert seen == ids
+    run(scenario)
@@ -0,0 +1,124 @@
+import asyncio
+import json
+
+import pytest
+import websockets
+
+import server
+from dispatch import Dispatcher, Field
+
+
+class Handlers:
+    """Actions whose replies the test releases one at a time."""
+
+    def __init__(self):
+        self.dispatcher = Dispatcher()
+        self.gates = {}
+        self.started = []
+
+        @self.dispatcher.action("login", public=True)
+        async def login(ctx, req):
+            ctx.user_id, ctx.username = 1, "alice"
+            return {"status": "ok"}
+
+        @self.dispatcher.action("wait", label=Field(str))
+        async def wait(ctx, req):
+            self.started.append(req["label"])
+            await self.gate(req["label"]).wait()
+            return {"status": "ok", "label": req["label"]}
+
+    def gate(self, name):
+        return self.gates.setdefault(name, asyncio.Event())
+
+
+@pytest.fixture
+def connect(monkeypatch):
+    """Run ``scenario(ws, handlers)`` against handle_message with test actions, logged in."""
+    def connect(scenario, max_in_flight=16):
+        handlers = Handlers()
+        monkeypatch.setattr(server, "dispatcher", handlers.dispatcher)
+        monkeypatch.setitem(server.pipeline_config, "max_in_flight", max_in_flight)
+
+        async def main():
+            async with websockets.serve(server.handle_message, "localhost", 0) as listener:
+                port = listener.sockets[0].getsockname()[1]
+                async with websockets.connect(f"ws://localhost:{port}") as ws:
+                    await send(ws, action="login")
+                    assert json.loads(await ws.recv())["status"] == "ok"
+                    await scenario(ws, handlers)
+        asyncio.run(main())
+    return connect
+
+
+async def send(ws, **request):
+    await ws.send(json.dumps(request))
+
+
+async def reply(ws):
+    response = json.loads(await asyncio.wait_for(ws.recv(), 5))
+    return response.get("request_id"), response.get("label")
+
+
+async def until(condition):
+    for _ in range(100):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("condition never became true")
+
+
+def test_tagged_requests_run_together_and_answer_as_they_finish(connect):
+    async def scenario(ws, handlers):
+        await send(ws, action="wait", label="slow", request_id=1)
+        await send(ws, action="wait", label="fast", request_id="two")
+        await until(lambda: handlers.started == ["slow", "fast"])
+        handlers.gate("fast").set()
+        assert await reply(ws) == ("two", "fast")
+        handlers.gate("slow").set()
+        assert await reply(ws) == (1, "slow")
+    connect(scenario)
+
+
+def test_untagged_requests_wait_for_everything_in_flight(connect):
+    async def scenario(ws, handlers):
+        await send(ws, action="wait", label="tagged", request_id=1)
+        await send(ws, action="wait", label="untagged")
+        handlers.gate("untagged").set()
+        await asyncio.sleep(0.05)
+        assert handlers.started == ["tagged"]
+        handlers.gate("tagged").set()
+        assert await reply(ws) == (1, "tagged")
+        assert await reply(ws) == (None, "untagged")
+    connect(scenario)
+
+
+def test_reading_stops_while_the_connection_is_at_its_limit(connect):
+    async def scenario(ws, handlers):
+        for i in range(3):
+            await send(ws, action="wait", label=f"r{i}", request_id=i)
+        await until(lambda: handlers.started == ["r0", "r1"])
+        await asyncio.sleep(0.05)
+        assert handlers.started == ["r0", "r1"]
+        handlers.gate("r1").set()
+        assert await reply(ws) == (1, "r1")
+        await until(lambda: handlers.started == ["r0", "r1", "r2"])
+        handlers.gate("r0").set()
+        handlers.gate("r2").set()
+        assert sorted([await reply(ws), await reply(ws)]) == [(0, "r0"), (2, "r2")]
+    connect(scenario, max_in_flight=2)
+
+
+def test_invalid_request_ids_are_refused(connect):
+    async def scenario(ws, handlers):
+        await send(ws, action="wait", label="x", request_id=True)
+        response = json.loads(await ws.recv())
+        assert response == {"status": "error", "message": "'request_id' must be a string or integer."}
+        assert handlers.started == []
+    connect(scenario)
+
+
+def test_only_logged_in_actions_may_overlap():
+    handlers = Handlers()
+    assert handlers.dispatcher.can_overlap({"action": "wait"})
+    assert not handlers.dispatcher.can_overlap({"action": "login"})
+    assert not handlers.dispatcher.can_overlap({"action": "nope"})
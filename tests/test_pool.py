@@ -0,0 +1,96 @@
+import threading
+
+import pytest
+
+from pool import ConnectionPool, PoolTimeout
+from storage import StorageError
+
+
+class FakeConnection:
+    def __init__(self, number):
+        self.number = number
+        self.healthy = True
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Connections:
+    """Stand-in driver that numbers the connections it opens."""
+
+    def __init__(self):
+        self.opened = []
+
+    def connect(self):
+        conn = FakeConnection(len(self.opened))
+        self.opened.append(conn)
+        return conn
+
+    @staticmethod
+    def is_healthy(conn):
+        return conn.healthy
+
+
+def test_acquire_times_out_when_every_connection_is_checked_out():
+    connections = Connections()
+    pool = ConnectionPool(connections.connect, connections.is_healthy, min_size=0, max_size=2,
+                          acquire_timeout=0.05)
+    held = [pool.acquire(), pool.acquire()]
+    with pytest.raises(PoolTimeout, match="after 0.05s"):
+        pool.acquire()
+
+    #A release hands the slot to a waiting caller
+    waiter = threading.Timer(0.01, pool.release, (held[1],))
+    waiter.start()
+    pool.acquire_timeout = 1.0
+    assert pool.acquire() is held[1]
+    waiter.join()
+    assert len(connections.opened) == 2
+
+
+def test_released_connections_are_reused_newest_first():
+    connections = Connections()
+    pool = ConnectionPool(connections.connect, connections.is_healthy, min_size=2, max_size=3)
+    first, second = pool.acquire(), pool.acquire()
+    pool.release(first)
+    pool.release(second)
+    assert pool.acquire() is second
+    assert pool.acquire() is first
+    assert len(connections.opened) == 2
+
+
+def test_idle_connections_past_the_check_interval_are_replaced_when_dropped():
+    connections = Connections()
+    pool = ConnectionPool(connections.connect, connections.is_healthy, min_size=1, max_size=1,
+                          health_check_interval=0.0)
+    conn = pool.acquire()
+    pool.release(conn)
+    conn.healthy = False
+    replacement = pool.acquire()
+    assert replacement is not conn and conn.closed
+    pool.release(replacement)
+    assert pool.acquire() is replacement
+
+
+def test_a_connection_that_broke_during_use_is_discarded():
+    connections = Connections()
+    pool = ConnectionPool(connections.connect, connections.is_healthy, min_size=0, max_size=1)
+    with pytest.raises(RuntimeError):
+        with pool.connection() as conn:
+            conn.healthy = False
+            raise RuntimeError("query failed")
+    assert conn.closed
+    with pool.connection() as again:
+        assert again is not conn
+
+
+def test_closed_pool_refuses_and_storage_reports_it_as_a_storage_error(run):
+    async def scenario(workers):
+        storage, = await workers.start(1)
+        storage.pool.close()
+        with pytest.raises(PoolTimeout, match="closed"):
+            storage.pool.acquire()
+        with pytest.raises(StorageError, match="closed"):
+            await storage.register_user("alice", None)
+    run(scenario)
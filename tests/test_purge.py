@@ -0,0 +1,82 @@
+from conftest import group_unread, query
+
+
+def test_purge_removes_tombstones_and_their_receipts_in_batches(run):
+    async def scenario(workers):
+        storage, = await workers.start(1)
+        alice = await storage.register_user("alice", None)
+        bob = await storage.register_user("bob", None)
+        ids = [(await storage.send_message(alice, bob, f"m{i}"))[0] for i in range(4)]
+        await storage.mark_read_batch(bob, ids)
+        for message_id in ids[:3]:
+            assert await storage.delete_message(message_id)
+        assert not await storage.delete_message(ids[0])
+
+        #Tombstones stay until the purge, but are no longer shown
+        rows, _ = await storage.fetch_messages(bob)
+        assert [row[0] for row in rows] == ids[3:]
+        assert len(query(workers, "SELECT id FROM messages")) == 4
+
+        assert await storage.purge_deleted(2) == 2
+        assert await storage.purge_deleted(2) == 1
+        assert await storage.purge_deleted(2) == 0
+        assert query(workers, "SELECT id FROM messages") == [(ids[3],)]
+        assert query(workers, "SELECT message_id FROM read_receipts") == [(ids[3],)]
+    run(scenario)
+
+
+def test_group_unread_counts_drop_a_deleted_message_at_the_purge(run):
+    async def scenario(workers):
+        storage, = await workers.start(1)
+        alice = await storage.register_user("alice", None)
+        bob = await storage.register_user("bob", None)
+        carol = await storage.register_user("carol", None)
+        group_id = await storage.create_group("team", alice)
+        await storage.add_member(group_id, bob)
+        await storage.add_member(group_id, carol)
+        ids = [(await storage.send_group_message(group_id, alice, f"m{i}", "alice"))[0] for i in range(3)]
+        #Carol has read everything, bob nothing
+        await storage.fetch_group_messages(group_id, carol)
+
+        assert await storage.delete_group_message(ids[1])
+        assert await group_unread(storage, bob) == [3]
+        assert await group_unread(storage, carol) == [0]
+        #A member joining before the purge counts the tombstone like everyone else
+        dave = await storage.register_user("dave", None)
+        await storage.add_member(group_id, dave)
+        assert await group_unread(storage, dave) == [3]
+
+        assert await storage.purge_deleted(10) == 1
+        assert await group_unread(storage, bob) == [2]
+        assert await group_unread(storage, carol) == [0]
+        assert await group_unread(storage, dave) == [2]
+        assert await group_unread(storage, alice) == [0]
+        rows, _, _ = await storage.fetch_group_messages(group_id, bob)
+        assert [row[0] for row in rows] == [ids[0], ids[2]]
+        assert await group_unread(storage, bob) == [0]
+    run(scenario)
+
+
+def test_a_purge_batch_spans_direct_and_group_tombstones(run):
+    async def scenario(workers):
+        storage, = await workers.start(1)
+        alice = await storage.register_user("alice", None)
+        bob = await storage.register_user("bob", None)
+        group_id = await storage.create_group("team", alice)
+        await storage.add_member(group_id, bob)
+        direct = [(await storage.send_message(alice, bob, f"d{i}"))[0] for i in range(2)]
+        group = [(await storage.send_group_message(group_id, alice, f"g{i}", "alice"))[0] for i in range(2)]
+        for message_id in direct:
+            await storage.delete_message(message_id)
+        for message_id in group:
+            await storage.delete_group_message(message_id)
+        rows, _, _ = await storage.fetch_group_messages(group_id, bob)
+        assert rows == []
+
+        assert await storage.purge_deleted(3) == 3
+        assert query(workers, "SELECT COUNT(*) FROM messages") == [(0,)]
+        assert query(workers, "SELECT COUNT(*) FROM group_messages") == [(1,)]
+        assert await storage.purge_deleted(3) == 1
+        assert query(workers, "SELECT COUNT(*) FROM group_messages") == [(0,)]
+        assert await group_unread(storage, bob) == [0]
+    run(scenario)
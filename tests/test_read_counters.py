@@ -0,0 +1,108 @@
+import asyncio
+
+from conftest import query
+
+
+def assert_direct_counters(workers):
+    #read_count is the receipt count and unread is what the receiver has no receipt for
+    assert query(workers, """
+        SELECT m.id FROM messages m
+        WHERE m.read_count != (SELECT COUNT(*) FROM read_receipts r WHERE r.message_id = m.id)
+    """) == []
+    assert query(workers, """
+        SELECT i.user_id, i.peer_id FROM inbox_direct i
+        WHERE i.unread_count != (
+            SELECT COUNT(*) FROM messages m
+            JOIN conversations c ON c.id = m.conversation_id
+            LEFT JOIN read_receipts r ON r.message_id = m.id AND r.reader_id = i.user_id
+            WHERE m.sender_id = i.peer_id AND i.user_id IN (c.user_low, c.user_high)
+            AND r.id IS NULL AND m.deleted_at IS NULL
+        )
+    """) == []
+
+
+async def unread_from(storage, user_id, peer):
+    direct, _ = await storage.inbox_summary(user_id)
+    return {row[0]: row[1] for row in direct}.get(peer)
+
+
+def test_repeated_marks_count_each_read_once(run):
+    async def scenario(workers):
+        storage, = await workers.start(1)
+        alice = await storage.register_user("alice", None)
+        bob = await storage.register_user("bob", None)
+        ids = [(await storage.send_message(alice, bob, f"m{i}"))[0] for i in range(4)]
+
+        for _ in range(3):
+            await storage.mark_read(bob, ids[0])
+            await storage.mark_read_batch(bob, ids[:2])
+        assert query(workers, "SELECT read_count FROM messages ORDER BY id") == [(1,), (1,), (0,), (0,)]
+        assert await unread_from(storage, bob, "alice") == 2
+
+        await storage.mark_read_up_to(bob, alice, ids[-1])
+        await storage.mark_read_batch(bob, ids)
+        assert await unread_from(storage, bob, "alice") == 0
+        assert_direct_counters(workers)
+    run(scenario)
+
+
+def test_concurrent_marks_from_two_workers_count_each_read_once(run):
+    async def scenario(workers):
+        first, second = await workers.start(2)
+        alice = await first.register_user("alice", None)
+        bob = await first.register_user("bob", None)
+        ids = [(await first.send_message(alice, bob, f"m{i}"))[0] for i in range(10)]
+
+        marks = []
+        for storage in (first, second):
+            for _ in range(5):
+                marks.append(storage.mark_read_batch(bob, ids[:6]))
+                marks.extend(storage.mark_read(bob, message_id) for message_id in ids[:6])
+        await asyncio.gather(*marks)
+
+        assert query(workers, "SELECT read_count FROM messages ORDER BY id") == [(1,)] * 6 + [(0,)] * 4
+        assert await unread_from(second, bob, "alice") == 4
+        assert_direct_counters(workers)
+    run(scenario)
+
+
+def test_leaving_gives_back_the_reads(run):
+    async def scenario(workers):
+        storage, = await workers.start(1)
+        alice = await storage.register_user("alice", None)
+        bob = await storage.register_user("bob", None)
+        group_id = await storage.create_group("team", alice)
+        await storage.add_member(group_id, bob)
+        message_id, _ = await storage.send_group_message(group_id, alice, "hello", "alice")
+        await storage.fetch_group_messages(group_id, bob)
+        (_, read, unread), _ = await storage.group_read_status(message_id)
+        assert (read, unread) == (1, 0)
+
+        await storage.remove_member(group_id, bob)
+        (_, read, unread), _ = await storage.group_read_status(message_id)
+        assert (read, unread) == (0, 0)
+        await storage.add_member(group_id, bob)
+        (_, read, unread), pages = await storage.group_read_status(message_id)
+        assert (read, unread) == (0, 1)
+        assert [row[0] for row in pages["unread"][0]] == ["bob"]
+    run(scenario)
+
+
+def test_reading_the_newest_page_leaves_older_messages_alone(run):
+    async def scenario(workers):
+        storage, = await workers.start(1)
+        alice = await storage.register_user("alice", None)
+        bob = await storage.register_user("bob", None)
+        carol = await storage.register_user("carol", None)
+        group_id = await storage.create_group("team", alice)
+        await storage.add_member(group_id, bob)
+        ids = [(await storage.send_group_message(group_id, alice, f"m{i}", "alice"))[0] for i in range(5)]
+        before = query(workers, "SELECT id, read_count FROM group_messages ORDER BY id")
+
+        #A member who joins late reads the whole history with one watermark move
+        await storage.add_member(group_id, carol)
+        await storage.fetch_group_messages(group_id, carol)
+        assert query(workers, "SELECT id, read_count FROM group_messages ORDER BY id") == before
+        counts, _ = await storage.group_read_counts(group_id)
+        assert [(row[0], row[2], row[3]) for row in counts] == [(message_id, 1, 1) for message_id in ids]
+    run(scenario)
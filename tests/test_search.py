@@ -0,0 +1,81 @@
+def kinds_and_texts(hits):
+    return sorted((row[0], row[2]) for row in hits)
+
+
+async def setup(storage):
+    alice = await storage.register_user("alice", None)
+    bob = await storage.register_user("bob", None)
+    carol = await storage.register_user("carol", None)
+    await storage.send_message(alice, bob, "lunch at noon?")
+    await storage.send_message(bob, carol, "lunch tomorrow")
+    team = await storage.create_group("team", alice)
+    await storage.add_member(team, bob)
+    other = await storage.create_group("other", carol)
+    await storage.send_group_message(team, alice, "team lunch on friday", "alice")
+    await storage.send_group_message(other, carol, "secret lunch plans", "carol")
+    return alice, bob, carol, team, other
+
+
+def test_scopes_cover_only_the_callers_chats_and_groups(run):
+    async def scenario(workers):
+        storage, = await workers.start(1)
+        alice, bob, carol, team, other = await setup(storage)
+
+        hits, more = await storage.search_messages(bob, ["lunch"])
+        assert kinds_and_texts(hits) == [("direct", "lunch at noon?"), ("direct", "lunch tomorrow"),
+                                         ("group", "team lunch on friday")]
+        assert not more
+        hits, _ = await storage.search_messages(bob, ["lunch"], scope="direct")
+        assert kinds_and_texts(hits) == [("direct", "lunch at noon?"), ("direct", "lunch tomorrow")]
+        hits, _ = await storage.search_messages(bob, ["lunch"], scope="group")
+        assert kinds_and_texts(hits) == [("group", "team lunch on friday")]
+        assert hits[0][5] == "team"
+
+        #Only alice's side of her chats, and no group she is not in
+        hits, _ = await storage.search_messages(alice, ["lunch"])
+        assert kinds_and_texts(hits) == [("direct", "lunch at noon?"), ("group", "team lunch on friday")]
+    run(scenario)
+
+
+def test_a_group_limits_the_search_to_that_group(run):
+    async def scenario(workers):
+        storage, = await workers.start(1)
+        alice, bob, carol, team, other = await setup(storage)
+        hits, _ = await storage.search_messages(carol, ["lunch"], group_id=other)
+        assert kinds_and_texts(hits) == [("group", "secret lunch plans")]
+        hits, _ = await storage.search_messages(carol, ["lunch"], group_id=other, scope="direct")
+        assert hits == []
+    run(scenario)
+
+
+def test_messages_matching_more_terms_rank_first_and_deleted_ones_are_not_found(run):
+    async def scenario(workers):
+        storage, = await workers.start(1)
+        alice, bob, carol, team, other = await setup(storage)
+        hits, _ = await storage.search_messages(bob, ["lunch", "friday"])
+        assert len(hits) == 3
+        assert hits[0][2] == "team lunch on friday"
+        assert hits[0][6] > hits[1][6]
+
+        await storage.delete_group_message(hits[0][1])
+        hits, _ = await storage.search_messages(bob, ["friday"])
+        assert hits == []
+    run(scenario)
+
+
+def test_results_page_by_offset(run):
+    async def scenario(workers):
+        storage, = await workers.start(1)
+        alice = await storage.register_user("alice", None)
+        bob = await storage.register_user("bob", None)
+        for i in range(5):
+            await storage.send_message(alice, bob, f"report {i}")
+        pages = []
+        offset, more = 0, True
+        while more:
+            hits, more = await storage.search_messages(bob, ["report"], limit=2, offset=offset)
+            pages.append([row[1] for row in hits])
+            offset += len(hits)
+        assert [len(page) for page in pages] == [2, 2, 1]
+        assert len({message_id for page in pages for message_id in page}) == 5
+    run(scenario)
@@ -0,0 +1,71 @@
+from conftest import settle
+
+
+def test_membership_change_reaches_the_other_worker(run):
+    async def scenario(workers):
+        first, second = await workers.start(2)
+        alice = await first.register_user("alice", None)
+        bob = await first.register_user("bob", None)
+        group_id = await first.create_group("team", alice)
+        await settle()
+
+        #Cached by the second worker before the change
+        assert not await second.is_member(group_id, bob)
+        await first.add_member(group_id, bob)
+        await settle()
+        assert await second.is_member(group_id, bob)
+        assert sorted(await second.group_member_names(group_id)) == ["alice", "bob"]
+
+        await first.remove_member(group_id, bob)
+        await settle()
+        assert not await second.is_member(group_id, bob)
+    run(scenario)
+
+
+def test_history_written_by_one_worker_drops_the_others_cached_page(run):
+    async def scenario(workers):
+        first, second = await workers.start(2)
+        alice = await first.register_user("alice", None)
+        bob = await first.register_user("bob", None)
+        await first.send_message(alice, bob, "one", "alice")
+        await settle()
+
+        rows, _ = await second.fetch_messages(bob)
+        assert [row[1] for row in rows] == ["one"]
+        await first.send_message(alice, bob, "two", "alice")
+        await settle()
+        rows, _ = await second.fetch_messages(bob)
+        assert [row[1] for row in rows] == ["one", "two"]
+    run(scenario)
+
+
+def test_rejoined_member_reads_again_on_a_worker_that_cached_their_watermark(run):
+    async def scenario(workers):
+        first, second = await workers.start(2)
+        alice = await first.register_user("alice", None)
+        bob = await first.register_user("bob", None)
+        group_id = await first.create_group("team", alice)
+        await first.add_member(group_id, bob)
+        for i in range(2):
+            message_id, _ = await first.send_group_message(group_id, alice, f"m{i}", "alice")
+        await settle()
+
+        #The second page comes from the recent-messages cache
+        for _ in range(2):
+            rows, _, _ = await second.fetch_group_messages(group_id, bob)
+        assert [row[0] for row in rows][-1] == message_id
+
+        await first.remove_member(group_id, bob)
+        await first.add_member(group_id, bob)
+        await settle()
+        _, groups = await second.inbox_summary(bob)
+        assert [row[1] for row in groups] == [2]
+
+        rows, _, advanced = await second.fetch_group_messages(group_id, bob)
+        assert advanced
+        _, groups = await second.inbox_summary(bob)
+        assert [row[1] for row in groups] == [0]
+        (_, read, unread), pages = await second.group_read_status(message_id)
+        assert (read, unread) == (1, 0)
+        assert [row[0] for row in pages["read"][0]] == ["bob"]
+    run(scenario)